@@ -51,7 +51,6 @@ K_LOCK = 15
 K_LOG_TO_EVENT_LOG = 16
 K_LOG_TO_PLUGIN_LOG = 17
 K_METHOD_TRACE = 18
-K_MONITORED_DEVICES = 19
 K_ON_OFF = 20
 K_PATH = 21
 K_PLUGIN_DISPLAY_NAME = 22
@@ -88,12 +87,34 @@ K_TP_DEVICE_NAME = 52
 K_TP_PLUGIN_INFO = 53
 K_TP_PLUGIN_VERSION = 54
 K_TP_SOCKET = 55
-K_MONITORED_VARIABLES = 56
 K_TP_USER_DATA_FOLDER_PATH = 57
 
 K_THREAD_READER = 56
 K_THREAD_HANDLER = 57
 K_INITIAL_DEVICE_CONFIG_VALUES = 58
+K_RECEIVE_BUFFER_SIZE = 59
+K_MAX_FRAME_SIZE = 60
+K_IO_ENGINE = 61
+K_SELECTOR = 62
+K_METRICS = 63
+K_RECONNECT_SCHEDULER = 64
+K_TCP_KEEPALIVE = 65
+K_TCP_NODELAY = 66
+K_LIVENESS_TIMEOUT = 67
+K_LAST_RECEIVED = 68
+K_LIVENESS_PROBE_SENT = 69
+K_QUEUE_CAPACITY = 70
+K_CAPTURE = 71
+K_INDIGO_WORKER_COUNT = 72
+K_INDIGO_WORKERS = 73
+K_COALESCE_COMMANDS = 74
+K_THREAD_WRITER = 75
+K_DESKTOP_STATES = 76
+K_TRACER = 77
+K_DUPLICATE_PRESS_MS = 78
+K_TP_REGISTRY = 79
+K_MONITOR_INDEX = 80
+K_SNAPSHOT_CACHE = 81
 
 TP_MONITOR_TP_DESKTOP_DEV_ID = 0
 TP_MONITOR_TP_STATE_ID = 1
@@ -115,6 +136,91 @@ TP_SHOW_VARIABLE_VALUE_DEFAULT = True
 TP_SOCKET_RETRY_DEFAULT = "15"
 TP_SOCKET_RETRY_SILENT_AFTER_DEFAULT = "10"
 TP_SOCKET_TIMEOUT_DEFAULT = 3
+TP_RECEIVE_BUFFER_SIZE_DEFAULT = "65536"
+TP_MAX_FRAME_SIZE_DEFAULT = "1048576"
+TP_IO_ENGINE_THREADS = "T"  # Reader thread per Touch Portal Desktop
+TP_IO_ENGINE_SELECTOR = "S"  # One shared select() loop for all Touch Portal Desktops
+TP_IO_ENGINE_DEFAULT = TP_IO_ENGINE_THREADS
+TP_METRICS_PUBLISH_SECONDS = 30  # How often performance figures are published as device states
+TP_RECONNECT_BACKOFF_BASE_SECONDS = 0.5  # First retry delay - doubled on each subsequent retry
+TP_RECONNECT_BACKOFF_CAP_SECONDS = 30  # Maximum delay between recoveries of a connection that keeps dropping
+TP_RECONNECT_STABLE_SECONDS = 60  # Connection up for at least this long resets the recovery backoff
+TP_TCP_KEEPALIVE_DEFAULT = True
+TP_TCP_KEEPALIVE_IDLE_SECONDS = 30  # Idle time before the first keepalive probe is sent
+TP_TCP_KEEPALIVE_INTERVAL_SECONDS = 10  # Time between unanswered keepalive probes
+TP_TCP_KEEPALIVE_COUNT = 3  # Unanswered keepalive probes before the connection is dropped
+TP_TCP_NODELAY_DEFAULT = True
+TP_LIVENESS_TIMEOUT_DEFAULT = "60"  # Seconds without hearing from Touch Portal Desktop before the connection is recovered (0 = off)
+TP_LIVENESS_CHECK_SECONDS = 5  # How often connections are checked for liveness
+TP_QUEUE_CAPACITY_DEFAULT = "256"  # Entries held in a Touch Portal device's receive from / send to queue
+TP_QUEUE_BLOCK_SECONDS = 1.0  # Longest wait for queue space under the 'block' overload policy
+TP_QUEUE_STALE_PRESS_SECONDS = 5  # Button presses queued for longer than this are shed rather than actioned
+TP_INDIGO_WORKERS_DEFAULT = "4"  # Threads running the Indigo commands of a Touch Portal device's actions
+TP_INDIGO_WORKERS_MAXIMUM = 16
+TP_INDIGO_WORKERS_STOP_SECONDS = 10  # Longest wait for Indigo commands already queued to finish when reconnecting
+TP_INDIGO_COMMAND_TYPE_DEVICE = "device"  # Indigo command types (metrics are published as 'indigo_<type>_wait_avg_ms' etc)
+TP_INDIGO_COMMAND_TYPE_ACTION_GROUP = "action_group"
+TP_INDIGO_COMMAND_TYPE_VARIABLE = "variable"
+TP_COALESCE_COMMANDS_DEFAULT = True  # Merge superseded brightness / brighten / dim / colour commands for the same device
+TP_COALESCE_BRIGHTNESS = "brightness"  # Coalesce keys: absolute brightness sets - latest wins
+TP_COALESCE_STEP = "step"  # Brighten / dim steps - summed
+TP_COALESCE_COLOUR = "colour"  # Colour sets - latest wins
+TP_OUTBOUND_LANE_INTERACTIVE = "interactive"  # Outbound lanes (metrics are published as 'outbound_<lane>_latency_avg_ms' etc)
+TP_OUTBOUND_LANE_BULK = "bulk"  # Refreshes of every state - only sent whilst no interactive messages are waiting
+TP_OUTBOUND_BULK_CHUNK = 25  # Bulk messages sent per write
+TP_OUTBOUND_BULK_PACE_SECONDS = 0.05  # Minimum time between bulk writes
+TP_HANDLER_BATCH_MAXIMUM = 32  # Queue entries processed by the TP Handler thread per wakeup (sharing one registry snapshot)
+TP_DUPLICATE_PRESS_MS_DEFAULT = "100"  # Identical toggles received within this many milliseconds are dropped (0 = off)
+TP_DUPLICATE_PRESS_MS_MAXIMUM = 2000
+TP_REGISTRY_MODE_DEVICE = "D"  # Modes of the published items in the 'tp_devices' plugin property (see tpRegistry)
+TP_REGISTRY_MODE_ACTION_GROUP = "A"
+TP_REGISTRY_MODE_VARIABLE = "V"
+TP_REGISTRY_ID_KEYS = {  # Mode: key of the item's Indigo id
+    TP_REGISTRY_MODE_DEVICE: "dev_id",
+    TP_REGISTRY_MODE_ACTION_GROUP: "action_group_id",
+    TP_REGISTRY_MODE_VARIABLE: "variable_id"}
+TP_REGISTRY_CAPABILITY_DEVICE_ON_OFF = "device_on_off"  # Registry indexes of the published items that support an action
+TP_REGISTRY_CAPABILITY_DEVICE_BRIGHTNESS = "device_brightness"
+TP_REGISTRY_CAPABILITY_DEVICE_RGB = "device_rgb"
+TP_REGISTRY_CAPABILITY_ACTION_GROUP = "action_group"
+TP_REGISTRY_CAPABILITY_VARIABLE_TEXT = "variable_text"
+TP_REGISTRY_CAPABILITY_VARIABLE_TRUE_FALSE = "variable_true_false"
+TP_REGISTRY_CHOICES = {  # Capability: (first choice, only choice if none published, last choice) of a Touch Portal list
+    TP_REGISTRY_CAPABILITY_DEVICE_ON_OFF: ("- Select Device -", "- No Devices Defined -", "- Refresh Devices -"),
+    TP_REGISTRY_CAPABILITY_DEVICE_BRIGHTNESS: ("- Select Device -", "- No Devices Defined -", "- Refresh Devices -"),
+    TP_REGISTRY_CAPABILITY_DEVICE_RGB: ("- Select Device -", "- No Devices Defined -", "- Refresh Devices -"),
+    TP_REGISTRY_CAPABILITY_ACTION_GROUP: ("- Select Action Group -", "- No Action Groups Defined -", "- Refresh Action Groups -"),
+    TP_REGISTRY_CAPABILITY_VARIABLE_TEXT: ("- Select Variable -", "- No Variables Defined -", "- Refresh Variables -"),
+    TP_REGISTRY_CAPABILITY_VARIABLE_TRUE_FALSE: ("- Select Variable -", "- No Variables Defined -", "- Refresh Variables -")}
+TP_SNAPSHOT_DEVICES = "devices"  # Indigo collections cached by tpSnapshots (named as the 'indigo' module attribute)
+TP_SNAPSHOT_VARIABLES = "variables"
+TP_SNAPSHOT_ACTION_GROUPS = "actionGroups"
+TP_SNAPSHOT_COLLECTIONS = (TP_SNAPSHOT_DEVICES, TP_SNAPSHOT_VARIABLES, TP_SNAPSHOT_ACTION_GROUPS)
+TP_TRACE_LATENCY_DEFAULT = False
+TP_TRACE_RING_SIZE = 1000  # Most recent action traces kept for the latency percentiles
+TP_TRACE_ECHO_SECONDS = 5  # Longest time after an Indigo command for its state update to count as the command's echo
+TP_TRACE_RECEIVED = 0  # Action trace stamps (see tpTrace) - received from the socket
+TP_TRACE_DECODED = 1  # JSON decoded (tpQueue.received_tp_message_entry)
+TP_TRACE_ENQUEUED = 2  # Put on the receive from / send to queue
+TP_TRACE_DEQUEUED = 3  # Taken from the queue by the TP Handler thread
+TP_TRACE_INDIGO_START = 4  # Indigo command started (TP Handler thread or Indigo command worker)
+TP_TRACE_INDIGO_END = 5  # Indigo command ended
+TP_TRACE_ECHOED = 6  # Resulting state update sent to Touch Portal Desktop (deviceUpdated / variableUpdated)
+TP_TRACE_STAMP_COUNT = 7
+TP_TRACE_STAGES = (  # Stage: from stamp, to stamp (published as 'trace_<stage>_p50_ms' etc)
+    ("decode", TP_TRACE_RECEIVED, TP_TRACE_DECODED),
+    ("enqueue", TP_TRACE_DECODED, TP_TRACE_ENQUEUED),
+    ("queue", TP_TRACE_ENQUEUED, TP_TRACE_DEQUEUED),
+    ("dispatch", TP_TRACE_DEQUEUED, TP_TRACE_INDIGO_START),
+    ("indigo", TP_TRACE_INDIGO_START, TP_TRACE_INDIGO_END),
+    ("echo", TP_TRACE_INDIGO_END, TP_TRACE_ECHOED),
+    ("total", TP_TRACE_RECEIVED, TP_TRACE_INDIGO_END))
+TP_CAPTURE_TRAFFIC_DEFAULT = False
+TP_CAPTURE_FILENAME = "touch_portal_capture_{0}.txt"  # Written to the plugin's Indigo log folder - {0} = Indigo device id
+TP_CAPTURE_MAX_BYTES = 5242880  # Capture file is rotated at this size
+TP_CAPTURE_BACKUP_COUNT = 3  # Rotated capture files kept
+TP_CAPTURE_INBOUND = "I"  # Received from Touch Portal Desktop
+TP_CAPTURE_OUTBOUND = "O"  # Sent to Touch Portal Desktop
 TP_RESOURCES_ICON_PATH_FILENAME = "Plugins/TouchPortal.indigoPlugin/Contents/Resources/Indigo Domotics/indigo_icon.png"
 TP_DESKTOP_VALIDITY_CHECK_FOLDER = "iconpacks"
 
@@ -139,6 +245,23 @@ TP_ENTRY_COMMAND_VARIABLE_TOGGLE = "indigo_variable_toggle"
 
 TP_ENTRY_COMMANDS_VARIABLE = (TP_ENTRY_COMMAND_VARIABLE_SET_TEXT, TP_ENTRY_COMMAND_VARIABLE_SET_TRUE, TP_ENTRY_COMMAND_VARIABLE_SET_FALSE, TP_ENTRY_COMMAND_VARIABLE_TOGGLE)
 
+# Actions which a duplicate press would undo - only these are ignored when received again within the duplicate press window
+TP_ENTRY_COMMANDS_DUPLICATE_PRESS = (TP_ENTRY_COMMAND_DEVICE_TOGGLE, TP_ENTRY_COMMAND_VARIABLE_TOGGLE)
+
+# Touch Portal action data ids from entry.tp (data id: TpActionParameters attribute)
+TP_ACTION_DATA_PARAMETERS = {}
+TP_ACTION_DATA_PARAMETERS["indigo_device_name_on_off"] = "device_name"
+TP_ACTION_DATA_PARAMETERS["indigo_device_name_brightness"] = "device_name"
+TP_ACTION_DATA_PARAMETERS["indigo_device_name_rgb"] = "device_name"
+TP_ACTION_DATA_PARAMETERS["indigo_device_brightness_value"] = "brightness_value"
+TP_ACTION_DATA_PARAMETERS["indigo_device_brighten_value"] = "brighten_value"
+TP_ACTION_DATA_PARAMETERS["indigo_device_dim_value"] = "dim_value"
+TP_ACTION_DATA_PARAMETERS["indigo_device_colour_value"] = "colour_value"
+TP_ACTION_DATA_PARAMETERS["indigo_action_group_name"] = "action_group_name"
+TP_ACTION_DATA_PARAMETERS["indigo_variable_name_text"] = "variable_name"
+TP_ACTION_DATA_PARAMETERS["indigo_variable_name_true_false"] = "variable_name"
+TP_ACTION_DATA_PARAMETERS["indigo_variable_value"] = "variable_value"
+
 # Touch Portal commands from entry.tp (translation)
 TP_ENTRY_TRANSLATION = {}
 TP_ENTRY_TRANSLATION[TP_ENTRY_COMMAND_DEVICE_TURN_ON] = "Device Turn On"
@@ -158,14 +281,52 @@ TP_ENTRY_TRANSLATION[TP_ENTRY_COMMAND_VARIABLE_TOGGLE] = "Variable Toggle"
 CMD_PROCESS_RECEIVED_TP_MESSAGE = 0
 CMD_PROCESS_SEND_TP_MESSAGE = 1
 CMD_PROCESS_REFRESH_TP_PLUGIN_STATES = 2
+CMD_STOP_THREAD = 3
 
 # Plugin Internal command(s) (translation)
 CMD_TRANSLATION = {}
 CMD_TRANSLATION[CMD_PROCESS_RECEIVED_TP_MESSAGE] = "PROCESS RECEIVED MESSAGE FROM TOUCH PORTAL"
 CMD_TRANSLATION[CMD_PROCESS_SEND_TP_MESSAGE] = "PROCESS SEND MESSAGE TO TOUCH PORTAL"
 CMD_TRANSLATION[CMD_PROCESS_REFRESH_TP_PLUGIN_STATES] = "PROCESS REFRESH TP PLUGIN STATES"
+CMD_TRANSLATION[CMD_STOP_THREAD] = "STOP THREAD"
+
+# Shared selector requests
+SELECTOR_REGISTER = 0
+SELECTOR_UNREGISTER = 1
 
 # QUEUE Priorities
+QUEUE_PRIORITY_STOP   = 0  # Stop sentinel is actioned ahead of everything else
 QUEUE_PRIORITY_HIGH   = 100
 QUEUE_PRIORITY_MEDIUM = 200
 QUEUE_PRIORITY_LOW    = 400
+
+# QUEUE priorities of messages received from Touch Portal Desktop (by message type)
+TP_MESSAGE_PRIORITIES = {}
+TP_MESSAGE_PRIORITIES["action"] = QUEUE_PRIORITY_HIGH  # Button presses never wait behind anything else
+TP_MESSAGE_PRIORITIES["info"] = QUEUE_PRIORITY_MEDIUM
+TP_MESSAGE_PRIORITIES["listChange"] = QUEUE_PRIORITY_LOW  # List refreshes can be bulky and aren't latency critical
+TP_MESSAGE_PRIORITY_DEFAULT = QUEUE_PRIORITY_MEDIUM
+
+# QUEUE message classes
+TP_MESSAGE_CLASS_CONTROL = 0  # Stop sentinel, messages to send and the info (pairing) / closePlugin messages - never dropped
+TP_MESSAGE_CLASS_ACTION = 1  # Button presses
+TP_MESSAGE_CLASS_LIST_CHANGE = 2  # List selection changes
+TP_MESSAGE_CLASS_INFO = 3  # Other messages from Touch Portal Desktop
+TP_MESSAGE_CLASS_REFRESH = 4  # Refresh TP plugin states requests
+
+# Messages from Touch Portal Desktop which the connection depends on (see TP_MESSAGE_CLASS_CONTROL)
+TP_MESSAGE_TYPES_CONTROL = ("info", "closePlugin")
+
+# QUEUE overload policies (applied when the queue is at capacity). Entries with a coalesce key are coalesced whether
+# or not the queue is at capacity - a queued list change or refresh that hasn't started is superseded by a newer one,
+# so actioning both would only add to the handler's work (and the latency of whatever is queued behind them)
+TP_QUEUE_POLICY_BLOCK = 0  # Wait (up to TP_QUEUE_BLOCK_SECONDS) for space, then drop the new entry - dropped at once for the TP Selector thread
+TP_QUEUE_POLICY_DROP_OLDEST = 1  # Drop the oldest queued entry of a lower priority, otherwise of the same class
+TP_QUEUE_POLICY_COALESCE = 2  # Replace the queued entry with the same key (e.g. same list), otherwise drop as above
+
+TP_QUEUE_POLICIES = {}
+TP_QUEUE_POLICIES[TP_MESSAGE_CLASS_CONTROL] = TP_QUEUE_POLICY_BLOCK
+TP_QUEUE_POLICIES[TP_MESSAGE_CLASS_ACTION] = TP_QUEUE_POLICY_DROP_OLDEST
+TP_QUEUE_POLICIES[TP_MESSAGE_CLASS_LIST_CHANGE] = TP_QUEUE_POLICY_COALESCE
+TP_QUEUE_POLICIES[TP_MESSAGE_CLASS_INFO] = TP_QUEUE_POLICY_BLOCK
+TP_QUEUE_POLICIES[TP_MESSAGE_CLASS_REFRESH] = TP_QUEUE_POLICY_COALESCE
@@ -13,7 +13,6 @@ Requires the file be stored in the usual location.
 
 # noinspection PyUnresolvedReferences
 # ============================== Native Imports ===============================
-import copy
 import json
 import sys
 
@@ -48,10 +47,6 @@ def construct(plugin_self, dev_id):
         # except IOError:
         #     pass
 
-        # Re-initialise monitored devices and monitored variables
-        plugin_self.globals[K_TP][K_MONITORED_DEVICES] = {}  # Dictionary will be filled with devices to monitor
-        plugin_self.globals[K_TP][K_MONITORED_VARIABLES] = {}  # Dictionary will be filled with variables to monitor
-
         monitored_devices = {}  # Dictionary will be filled with devices to monitor
         monitored_variables = {}  # Dictionary will be filled with variables to monitor
 
@@ -513,15 +508,11 @@ def construct(plugin_self, dev_id):
             plugin_self.logger.error(u"CONSTRUCT ERROR: IOError is '{0}'".format(io_error))
             return False
 
-        # plugin_self.globals[K_LOCK].acquire()  # Serialise update of monitored devices and variables
-        plugin_self.globals[K_TP][K_MONITORED_DEVICES] = copy.deepcopy(monitored_devices)
-        plugin_self.globals[K_TP][K_MONITORED_VARIABLES] = copy.deepcopy(monitored_variables)
-        # plugin_self.globals[K_LOCK].release()
+        # Replaces this Touch Portal device's monitored devices and variables - other Touch Portal devices' are unaffected
+        plugin_self.globals[K_TP][K_MONITOR_INDEX].subscribe(dev_id, monitored_devices, monitored_variables)
 
-        plugin_self.logger.debug(u"K_MONITORED_DEVICES:\n{0}\n"
-                                 .format(plugin_self.globals[K_TP][K_MONITORED_DEVICES]))
-        plugin_self.logger.debug(u"K_MONITORED_VARIABLES:\n{0}\n"
-                                 .format(plugin_self.globals[K_TP][K_MONITORED_VARIABLES]))
+        plugin_self.logger.debug(u"MONITORED DEVICES:\n{0}\n".format(monitored_devices))
+        plugin_self.logger.debug(u"MONITORED VARIABLES:\n{0}\n".format(monitored_variables))
 
         return True
 
@@ -11,12 +11,24 @@ import json
 import logging
 import os
 import platform
-import Queue
 import shutil
+import socket
 import sys
 import threading
+import time
 from tpHandler import ThreadTpHandler
 from tpReader import ThreadTpReader
+from tpCapture import TpCapture
+from tpMetrics import TpMetrics
+from tpMonitors import TpMonitorIndex
+from tpQueue import TpBoundedPriorityQueue, TpQueueEntry
+from tpReconnect import TpReconnectScheduler
+from tpRegistry import TpRegistry
+from tpSelector import ThreadTpSelector
+from tpSnapshots import TpSnapshotCache
+from tpTrace import TpTracer
+from tpWriter import ThreadTpWriter, TpDesktopStates
+from tpWorkers import TpIndigoWorkerPool
 
 # ============================== Custom Imports ===============================
 try:
@@ -101,18 +113,23 @@ class Plugin(indigo.PluginBase):
         # Initialise dictionary to store sockets
         self.globals[K_SOCKETS] = {}
 
-        # Initialise dictionary for socket recovery
-        self.globals[K_RECOVERY_INVOKED] = []  # A list of device Ids to recover socket connections for - likely to only be one item in list!
+        # Initialise dictionary for the shared selector thread (only started if a device uses the selector I/O engine)
+        self.globals[K_SELECTOR] = {}
 
-        self.globals[K_LOCK] = threading.Lock()  # Used to serialise updating of 'recoveryInvoked'
+        # Initialise scheduler for socket recovery - connection loss wakes runConcurrentThread immediately
+        self.globals[K_RECONNECT_SCHEDULER] = TpReconnectScheduler()
+
+        self.globals[K_LOCK] = threading.Lock()
 
         # Initialise dictionary for constants
         self.globals[K_CONSTANT] = {}
         self.globals[K_CONSTANT][K_DEFAULT_DATE_TIME] = datetime.datetime.strptime("2000-01-01", "%Y-%m-%d")
 
-        # Initialise monitored devices and monitored variables
-        self.globals[K_TP][K_MONITORED_DEVICES] = {}  # Dictionary will be filled with devices to monitor
-        self.globals[K_TP][K_MONITORED_VARIABLES] = {}  # Dictionary will be filled with variables to monitor
+        # Initialise monitored devices and monitored variables of every Touch Portal device
+        self.globals[K_TP][K_MONITOR_INDEX] = TpMonitorIndex()  # Filled by entry_tp_generator as each device starts
+
+        # Initialise snapshots of the Indigo devices, variables and action groups used by the TP Handler threads
+        self.globals[K_TP][K_SNAPSHOT_CACHE] = TpSnapshotCache()  # Kept up to date by the Indigo change callbacks
 
         # Set Plugin Config Values
         self.closedPrefsConfigUi(plugin_prefs, False)
@@ -154,6 +171,46 @@ class Plugin(indigo.PluginBase):
             else:
                 self.process_turn_off(dev, True)  # True = Toggle
 
+    # =============================================================================
+    def actionGroupCreated(self, group):
+        """
+        Indigo method invoked when any Indigo action group is created.
+
+        -----
+        :param group:
+        :return:
+        """
+
+        self.globals[K_TP][K_SNAPSHOT_CACHE].invalidate(TP_SNAPSHOT_ACTION_GROUPS, group.id)
+        indigo.PluginBase.actionGroupCreated(self, group)
+
+    # =============================================================================
+    def actionGroupDeleted(self, group):
+        """
+        Indigo method invoked when any Indigo action group is deleted.
+
+        -----
+        :param group:
+        :return:
+        """
+
+        self.globals[K_TP][K_SNAPSHOT_CACHE].invalidate(TP_SNAPSHOT_ACTION_GROUPS, group.id)
+        indigo.PluginBase.actionGroupDeleted(self, group)
+
+    # =============================================================================
+    def actionGroupUpdated(self, orig_group, new_group):
+        """
+        Indigo method invoked when any Indigo action group is changed.
+
+        -----
+        :param orig_group:
+        :param new_group:
+        :return:
+        """
+
+        self.globals[K_TP][K_SNAPSHOT_CACHE].update(TP_SNAPSHOT_ACTION_GROUPS, new_group)
+        indigo.PluginBase.actionGroupUpdated(self, orig_group, new_group)
+
     # =============================================================================
     def closedDeviceConfigUi(self, values_dict, user_cancelled, type_id, dev_id):
         """
@@ -182,6 +239,12 @@ class Plugin(indigo.PluginBase):
             self.globals[K_TP][dev_id][K_AUTO_CONNECT] = bool(values_dict.get("auto_connect", TP_AUTO_CONNECT_DEFAULT))
             self.globals[K_TP][dev_id][K_SOCKET_RETRY_SECONDS] = int(values_dict.get("socket_retry_seconds", TP_SOCKET_RETRY_DEFAULT))
             self.globals[K_TP][dev_id][K_SOCKET_RETRY_SILENT_AFTER] = int(values_dict.get("socket_retry_silent_after", TP_SOCKET_RETRY_SILENT_AFTER_DEFAULT))
+            self.globals[K_TP][dev_id][K_LIVENESS_TIMEOUT] = int(values_dict.get("liveness_timeout", TP_LIVENESS_TIMEOUT_DEFAULT))
+            self.globals[K_TP][dev_id][K_COALESCE_COMMANDS] = bool(values_dict.get("coalesce_commands", TP_COALESCE_COMMANDS_DEFAULT))
+            self.globals[K_TP][dev_id][K_DUPLICATE_PRESS_MS] = int(values_dict.get("duplicate_press_ms", TP_DUPLICATE_PRESS_MS_DEFAULT))
+
+            # The published items added, updated or deleted in the dialog are saved - Touch Portal actions use them from now on
+            self.compile_tp_registry(dev_id, values_dict.get("tp_devices", None))
 
         except StandardError as standard_error_message:
             self.logger.error(u"closedDeviceConfigUi error detected. "
@@ -228,6 +291,32 @@ class Plugin(indigo.PluginBase):
                                                                    standard_error_message))
             return True
 
+    # =============================================================================
+    def deviceCreated(self, dev):
+        """
+        Indigo method invoked when any Indigo device is created.
+
+        -----
+        :param dev:
+        :return:
+        """
+
+        self.globals[K_TP][K_SNAPSHOT_CACHE].invalidate(TP_SNAPSHOT_DEVICES, dev.id)
+        indigo.PluginBase.deviceCreated(self, dev)
+
+    # =============================================================================
+    def deviceDeleted(self, dev):
+        """
+        Indigo method invoked when any Indigo device is deleted.
+
+        -----
+        :param dev:
+        :return:
+        """
+
+        self.globals[K_TP][K_SNAPSHOT_CACHE].invalidate(TP_SNAPSHOT_DEVICES, dev.id)
+        indigo.PluginBase.deviceDeleted(self, dev)
+
     # =============================================================================
     def deviceStartComm(self, dev):
         """
@@ -253,6 +342,39 @@ class Plugin(indigo.PluginBase):
             self.globals[K_TP][dev_id][K_PORT] = int(dev.pluginProps.get("port", TP_PORT_DEFAULT))
             self.globals[K_TP][dev_id][K_DESKTOP_USER_DATA_FOLDER_PATH] = dev.pluginProps.get("tp_user_data_folder_path", None)
             self.globals[K_TP][dev_id][K_TIMEOUT] = int(dev.pluginProps.get("timeout", TP_SOCKET_TIMEOUT_DEFAULT))
+            self.globals[K_TP][dev_id][K_RECEIVE_BUFFER_SIZE] = int(dev.pluginProps.get("receive_buffer_size", TP_RECEIVE_BUFFER_SIZE_DEFAULT))
+            self.globals[K_TP][dev_id][K_MAX_FRAME_SIZE] = int(dev.pluginProps.get("max_message_size", TP_MAX_FRAME_SIZE_DEFAULT))
+            self.globals[K_TP][dev_id][K_QUEUE_CAPACITY] = int(dev.pluginProps.get("queue_capacity", TP_QUEUE_CAPACITY_DEFAULT))
+            self.globals[K_TP][dev_id][K_INDIGO_WORKER_COUNT] = int(dev.pluginProps.get("indigo_workers", TP_INDIGO_WORKERS_DEFAULT))
+            self.globals[K_TP][dev_id][K_COALESCE_COMMANDS] = bool(dev.pluginProps.get("coalesce_commands", TP_COALESCE_COMMANDS_DEFAULT))
+            self.globals[K_TP][dev_id][K_DUPLICATE_PRESS_MS] = int(dev.pluginProps.get("duplicate_press_ms", TP_DUPLICATE_PRESS_MS_DEFAULT))
+            self.globals[K_TP][dev_id][K_IO_ENGINE] = dev.pluginProps.get("io_engine", TP_IO_ENGINE_DEFAULT)
+            self.globals[K_TP][dev_id][K_TCP_KEEPALIVE] = bool(dev.pluginProps.get("tcp_keepalive", TP_TCP_KEEPALIVE_DEFAULT))
+            self.globals[K_TP][dev_id][K_TCP_NODELAY] = bool(dev.pluginProps.get("tcp_nodelay", TP_TCP_NODELAY_DEFAULT))
+            self.globals[K_TP][dev_id][K_LIVENESS_TIMEOUT] = int(dev.pluginProps.get("liveness_timeout", TP_LIVENESS_TIMEOUT_DEFAULT))
+            self.globals[K_TP][dev_id][K_LAST_RECEIVED] = time.time()
+            self.globals[K_TP][dev_id][K_LIVENESS_PROBE_SENT] = None
+
+            if self.globals[K_TP][dev_id].get(K_CAPTURE) is not None:
+                self.globals[K_TP][dev_id][K_CAPTURE].close()
+            self.globals[K_TP][dev_id][K_CAPTURE] = None
+            if bool(dev.pluginProps.get("capture_traffic", TP_CAPTURE_TRAFFIC_DEFAULT)):
+                capture_path = u"{0}/{1}".format(indigo.server.getLogsFolderPath(pluginId=self.pluginId), TP_CAPTURE_FILENAME.format(dev_id))
+                self.globals[K_TP][dev_id][K_CAPTURE] = TpCapture(capture_path)
+                self.logger.info(u"'{0}' is capturing Touch Portal traffic to '{1}'".format(dev.name, capture_path))
+
+            self.globals[K_TP][dev_id][K_METRICS] = TpMetrics()
+            if self.globals[K_TP][dev_id][K_IO_ENGINE] == TP_IO_ENGINE_SELECTOR:
+                self.globals[K_TP][dev_id][K_METRICS].set("io_engine", "Shared Selector")
+            else:
+                self.globals[K_TP][dev_id][K_METRICS].set("io_engine", "Reader Thread")
+            self.globals[K_TP][dev_id][K_TRACER] = None
+            if bool(dev.pluginProps.get("trace_latency", TP_TRACE_LATENCY_DEFAULT)):
+                self.globals[K_TP][dev_id][K_TRACER] = TpTracer(TP_TRACE_RING_SIZE)
+                self.logger.info(u"'{0}' is tracing the latency of Touch Portal actions".format(dev.name))
+            # Survives reconnections so that the latest value of every state can be sent on reconnection
+            self.globals[K_TP][dev_id][K_DESKTOP_STATES] = TpDesktopStates(self.globals[K_TP][dev_id][K_METRICS])
+            self.compile_tp_registry(dev_id, dev.pluginProps.get("tp_devices", None))
             self.globals[K_TP][dev_id][K_SOCKET_RETRY_SECONDS] = int(dev.pluginProps.get("socket_retry_seconds", TP_SOCKET_RETRY_DEFAULT))
             self.globals[K_TP][dev_id][K_SOCKET_RETRY_SILENT_AFTER] = int(dev.pluginProps.get("socket_retry_silent_after", TP_SOCKET_RETRY_SILENT_AFTER_DEFAULT))
             self.globals[K_TP][dev_id][K_SHOW_VARIABLE_VALUE] = bool(dev.pluginProps.get("show_variable_value", TP_SHOW_VARIABLE_VALUE_DEFAULT))
@@ -317,8 +439,6 @@ class Plugin(indigo.PluginBase):
             indigo.devices[dev].updateStateImageOnServer(indigo.kStateImageSel.SensorOff)
             dev.updateStateOnServer("connection_status", "Disconnected")
 
-            self.globals[K_TP][dev_id][K_MONITORED_DEVICES] = {}  # Dictionary will be filled by entry_tp_generator
-
             # Write out a new entry.tp file to the TP desktop machine.
             entry_tp_created = entry_tp_generator.construct(self, dev_id)
             if not entry_tp_created:
@@ -360,7 +480,7 @@ class Plugin(indigo.PluginBase):
         if dev_id in self.globals[K_THREADS]:
             if K_THREAD_READER in self.globals[K_THREADS][dev_id]:
                 try:
-                    self.globals[K_THREADS][dev_id][K_THREAD_READER][K_EVENT].set()
+                    self.globals[K_THREADS][dev_id][K_THREAD_READER][K_THREAD].stop()  # Wakes the thread so that it stops immediately
                 except StandardError as standard_error_message:
                     self.logger.error(u"Error detected in Touch Portal Plugin [deviceStopComm of device '{0}']. "
                                       u"Line '{1}' has error='{2}'".format(dev.name,
@@ -371,13 +491,44 @@ class Plugin(indigo.PluginBase):
         if dev_id in self.globals[K_THREADS]:
             if K_THREAD_HANDLER in self.globals[K_THREADS][dev_id]:
                 try:
-                    self.globals[K_THREADS][dev_id][K_THREAD_HANDLER][K_EVENT].set()
+                    self.globals[K_THREADS][dev_id][K_THREAD_HANDLER][K_THREAD].stop()  # Wakes the thread so that it stops immediately
+                except StandardError as standard_error_message:
+                    self.logger.error(u"Error detected in Touch Portal Plugin [deviceStopComm of device '{0}']. "
+                                      u"Line '{1}' has error='{2}'".format(dev.name,
+                                                                           sys.exc_traceback.tb_lineno,
+                                                                           standard_error_message))
+
+        # Check if TP Writer thread is running for this Touch Portal device and if so, stop it
+        if dev_id in self.globals[K_THREADS]:
+            if K_THREAD_WRITER in self.globals[K_THREADS][dev_id]:
+                try:
+                    self.globals[K_THREADS][dev_id][K_THREAD_WRITER][K_THREAD].stop()  # Wakes the thread so that it stops immediately
                 except StandardError as standard_error_message:
                     self.logger.error(u"Error detected in Touch Portal Plugin [deviceStopComm of device '{0}']. "
                                       u"Line '{1}' has error='{2}'".format(dev.name,
                                                                            sys.exc_traceback.tb_lineno,
                                                                            standard_error_message))
 
+        # Stop the shared selector managing this Touch Portal device's connection (if it is)
+        self.tp_selector_unregister(dev_id)
+
+        # Forget any outstanding socket recovery for this Touch Portal device
+        self.globals[K_RECONNECT_SCHEDULER].cancel(dev_id)
+
+        # Stop the Indigo command threads once the commands already queued have been run
+        if self.globals[K_TP][dev_id].get(K_INDIGO_WORKERS) is not None:
+            self.globals[K_TP][dev_id][K_INDIGO_WORKERS].stop()
+            self.globals[K_TP][dev_id][K_INDIGO_WORKERS] = None
+
+        # Stop capturing traffic (if capturing)
+        if self.globals[K_TP][dev_id].get(K_CAPTURE) is not None:
+            self.globals[K_TP][dev_id][K_CAPTURE].close()
+            self.globals[K_TP][dev_id][K_CAPTURE] = None
+        self.globals[K_TP][dev_id][K_TRACER] = None
+
+        # Stop sending the changes of this Touch Portal device's monitored devices and variables
+        self.globals[K_TP][K_MONITOR_INDEX].unsubscribe(dev_id)
+
         if not self.globals[K_TP][dev_id][K_DEVICE_STARTED]:
             self.logger.debug(u"Touch Portal: '{0}' device stopping but startup not yet completed".format(dev.name))
 
@@ -397,60 +548,31 @@ class Plugin(indigo.PluginBase):
         """
 
         try:
-            if new_dev.deviceTypeId == 'touchPortal':  # Ignore Touch Portal device updates!
+            # Indigo calls this for every device change - those of devices not known to any Touch Portal desktop
+            # (including the Touch Portal devices themselves) are rejected first. Their snapshot is only replaced if
+            # cached for an action - otherwise that costs a frozenset lookup (see TpSnapshotCache.update)
+            if new_dev.id not in self.globals[K_TP][K_MONITOR_INDEX].device_ids:
+                self.globals[K_TP][K_SNAPSHOT_CACHE].update(TP_SNAPSHOT_DEVICES, new_dev)
                 return
 
-            # Debug logging
-            # self.logger.error(
-            #     u"deviceUpdated '{0}, 'K_MONITORED_DEVICES': {1}"
-            #     .format(new_dev.name, self.globals[K_TP][K_MONITORED_DEVICES]))
+            monitor_index = self.globals[K_TP][K_MONITOR_INDEX]
+            self.globals[K_TP][K_SNAPSHOT_CACHE].update(TP_SNAPSHOT_DEVICES, new_dev)  # Only if cached
 
-            # At this point check if device is known to Touch Portal desktop
-            # and if so update required states if they have changed.
+            # Only the attributes mirrored by a desktop are compared and only changed ones are encoded
+            tp_desktop_device_ids_sent = set()
+            for compared_attributes, tp_value, tp_state_id, tp_desktop_device_ids in monitor_index.device_comparators.get(new_dev.id, ()):
+                if compared_attributes(orig_dev) == compared_attributes(new_dev):
+                    continue
+                new_state_value = tp_value(new_dev)
+                for tp_desktop_device_id in tp_desktop_device_ids:  # Every Touch Portal device mirroring the state
+                    writer = self.tp_writer(tp_desktop_device_id)
+                    if writer is not None and writer.send_state_update(tp_state_id, new_state_value):  # None = not connected since it started
+                        tp_desktop_device_ids_sent.add(tp_desktop_device_id)
 
-            if K_MONITORED_DEVICES in self.globals[K_TP]:
-                if new_dev.id in self.globals[K_TP][K_MONITORED_DEVICES]:
-                    monitor_list = self.globals[K_TP][K_MONITORED_DEVICES][new_dev.id]
-                    tp_desktop_device_id = monitor_list[TP_MONITOR_TP_DESKTOP_DEV_ID]
-                    tp_state_id = monitor_list[TP_MONITOR_TP_STATE_ID]
-                    monitor_on_off = monitor_list[TP_MONITOR_ON_OFF]
-                    monitor_brightness = monitor_list[TP_MONITOR_BRIGHTNESS]
-                    monitor_rgb = monitor_list[TP_MONITOR_RGB]
-
-                    if monitor_on_off:
-                        if orig_dev.onState != new_dev.onState:
-                            self.logger.debug(
-                                u"K_MONITORED_DEVICE [ON_OFF]:\n{0}\n".format(self.globals[K_TP][K_MONITORED_DEVICES]))
-                            new_state_value = "OFF"
-                            if new_dev.onState:
-                                new_state_value = "ON"
-                            tp_state_id = u"indigo_device_{0}_on_off".format(new_dev.id)
-                            tp_message = '{{"type": "stateUpdate", "id": "{0}", "value" : "{1}"}}'.format(
-                                tp_state_id, new_state_value)
-                            self.globals[K_THREADS][tp_desktop_device_id][K_THREAD_HANDLER][K_THREAD].process_send_tp_message(tp_desktop_device_id, tp_message)
-
-                    if monitor_brightness:
-                        if orig_dev.brightness != new_dev.brightness:
-                            self.logger.debug(
-                                u"K_MONITORED_DEVICE [BRIGHTNESS]:\n{0}\n".format(self.globals[K_TP][K_MONITORED_DEVICES]))
-                            new_state_value = new_dev.brightness
-                            tp_state_id = u"indigo_device_{0}_brightness".format(new_dev.id)
-                            tp_message = '{{"type": "stateUpdate", "id": "{0}", "value" : "{1}"}}'.format(
-                                tp_state_id, new_state_value)
-                            self.globals[K_THREADS][tp_desktop_device_id][K_THREAD_HANDLER][K_THREAD].process_send_tp_message(tp_desktop_device_id, tp_message)
-
-                    if monitor_rgb:
-                        if orig_dev.redLevel != new_dev.redLevel or orig_dev.greenLevel != new_dev.greenLevel or orig_dev.blueLevel != new_dev.blueLevel:
-                            self.logger.debug(
-                                u"K_MONITORED_DEVICE [COLOUR RGB]:\n{0}\n".format(self.globals[K_TP][K_MONITORED_DEVICES]))
-                            red_level = int((new_dev.redLevel * 255.0) / 100.0)
-                            green_level = int((new_dev.greenLevel * 255.0) / 100.0)
-                            blue_level = int((new_dev.blueLevel * 255.0) / 100.0)
-                            new_state_value = ('#FF%02x%02x%02x' % (red_level, green_level, blue_level)).upper()
-                            tp_state_id = u"indigo_device_{0}_colour_rgb".format(new_dev.id)
-                            tp_message = '{{"type": "stateUpdate", "id": "{0}", "value" : "{1}"}}'.format(
-                                tp_state_id, new_state_value)
-                            self.globals[K_THREADS][tp_desktop_device_id][K_THREAD_HANDLER][K_THREAD].process_send_tp_message(tp_desktop_device_id, tp_message)
+            for tp_desktop_device_id in tp_desktop_device_ids_sent:
+                tracer = self.globals[K_TP][tp_desktop_device_id].get(K_TRACER)
+                if tracer is not None:
+                    tracer.echo(new_dev.id)  # Completes the trace of the Touch Portal action which changed the device
 
         except StandardError as standard_error_message:
             self.logger.error(u"StandardError detected in Touch Portal Plugin [deviceUpdated] for device '{0}']. "
@@ -490,6 +612,51 @@ class Plugin(indigo.PluginBase):
             if orig_timeout != new_timeout:
                 return True
 
+            orig_io_engine = orig_dev.pluginProps.get("io_engine", TP_IO_ENGINE_DEFAULT)
+            new_io_engine = new_dev.pluginProps.get("io_engine", TP_IO_ENGINE_DEFAULT)
+            if orig_io_engine != new_io_engine:
+                return True
+
+            orig_tcp_keepalive = orig_dev.pluginProps.get("tcp_keepalive", TP_TCP_KEEPALIVE_DEFAULT)
+            new_tcp_keepalive = new_dev.pluginProps.get("tcp_keepalive", TP_TCP_KEEPALIVE_DEFAULT)
+            if orig_tcp_keepalive != new_tcp_keepalive:
+                return True
+
+            orig_tcp_nodelay = orig_dev.pluginProps.get("tcp_nodelay", TP_TCP_NODELAY_DEFAULT)
+            new_tcp_nodelay = new_dev.pluginProps.get("tcp_nodelay", TP_TCP_NODELAY_DEFAULT)
+            if orig_tcp_nodelay != new_tcp_nodelay:
+                return True
+
+            orig_receive_buffer_size = orig_dev.pluginProps.get("receive_buffer_size", TP_RECEIVE_BUFFER_SIZE_DEFAULT)
+            new_receive_buffer_size = new_dev.pluginProps.get("receive_buffer_size", TP_RECEIVE_BUFFER_SIZE_DEFAULT)
+            if orig_receive_buffer_size != new_receive_buffer_size:
+                return True
+
+            orig_max_message_size = orig_dev.pluginProps.get("max_message_size", TP_MAX_FRAME_SIZE_DEFAULT)
+            new_max_message_size = new_dev.pluginProps.get("max_message_size", TP_MAX_FRAME_SIZE_DEFAULT)
+            if orig_max_message_size != new_max_message_size:
+                return True
+
+            orig_capture_traffic = orig_dev.pluginProps.get("capture_traffic", TP_CAPTURE_TRAFFIC_DEFAULT)
+            new_capture_traffic = new_dev.pluginProps.get("capture_traffic", TP_CAPTURE_TRAFFIC_DEFAULT)
+            if orig_capture_traffic != new_capture_traffic:
+                return True
+
+            orig_trace_latency = orig_dev.pluginProps.get("trace_latency", TP_TRACE_LATENCY_DEFAULT)
+            new_trace_latency = new_dev.pluginProps.get("trace_latency", TP_TRACE_LATENCY_DEFAULT)
+            if orig_trace_latency != new_trace_latency:
+                return True
+
+            orig_queue_capacity = orig_dev.pluginProps.get("queue_capacity", TP_QUEUE_CAPACITY_DEFAULT)
+            new_queue_capacity = new_dev.pluginProps.get("queue_capacity", TP_QUEUE_CAPACITY_DEFAULT)
+            if orig_queue_capacity != new_queue_capacity:
+                return True
+
+            orig_indigo_workers = orig_dev.pluginProps.get("indigo_workers", TP_INDIGO_WORKERS_DEFAULT)
+            new_indigo_workers = new_dev.pluginProps.get("indigo_workers", TP_INDIGO_WORKERS_DEFAULT)
+            if orig_indigo_workers != new_indigo_workers:
+                return True
+
             orig_tp_user_data_folder_path = orig_dev.pluginProps.get("tp_user_data_folder_path", TP_DESKTOP_USER_DATA_FOLDER_DEFAULT_PATH)
             new_tp_user_data_folder_path = new_dev.pluginProps.get("tp_user_data_folder_path", TP_DESKTOP_USER_DATA_FOLDER_DEFAULT_PATH)
             if orig_tp_user_data_folder_path != new_tp_user_data_folder_path:
@@ -530,6 +697,27 @@ class Plugin(indigo.PluginBase):
 
             plugin_props["timeout"] = TP_SOCKET_TIMEOUT_DEFAULT  # Force timeout to plugin default number of seconds
 
+            if "receive_buffer_size" not in plugin_props:
+                plugin_props["receive_buffer_size"] = TP_RECEIVE_BUFFER_SIZE_DEFAULT  # Bytes requested per socket read
+
+            if "max_message_size" not in plugin_props:
+                plugin_props["max_message_size"] = TP_MAX_FRAME_SIZE_DEFAULT  # Largest message accepted from Touch Portal Desktop
+
+            if "queue_capacity" not in plugin_props:
+                plugin_props["queue_capacity"] = TP_QUEUE_CAPACITY_DEFAULT  # Entries held in the receive from / send to queue
+
+            if "indigo_workers" not in plugin_props:
+                plugin_props["indigo_workers"] = TP_INDIGO_WORKERS_DEFAULT  # Threads running Indigo commands for TP actions
+
+            if "coalesce_commands" not in plugin_props:
+                plugin_props["coalesce_commands"] = bool(TP_COALESCE_COMMANDS_DEFAULT)  # Merge superseded dimmer commands?
+
+            if "duplicate_press_ms" not in plugin_props:
+                plugin_props["duplicate_press_ms"] = TP_DUPLICATE_PRESS_MS_DEFAULT  # Ignore identical actions within n milliseconds
+
+            if "io_engine" not in plugin_props:
+                plugin_props["io_engine"] = TP_IO_ENGINE_DEFAULT  # Reader thread per desktop or shared selector
+
             if "tp_user_data_folder_path" not in plugin_props:
                 plugin_props["tp_user_data_folder_path"] = u"{0}{1}".format(os.path.expanduser("~"),
                                                                             TP_DESKTOP_USER_DATA_FOLDER_DEFAULT_PATH)
@@ -546,6 +734,21 @@ class Plugin(indigo.PluginBase):
             if "socket_retry_silent_after" not in plugin_props:
                 plugin_props["socket_retry_silent_after"] = TP_SOCKET_RETRY_SILENT_AFTER_DEFAULT  # Socket error retry silent after n attempts?
 
+            if "tcp_keepalive" not in plugin_props:
+                plugin_props["tcp_keepalive"] = bool(TP_TCP_KEEPALIVE_DEFAULT)  # OS detects a vanished Touch Portal Desktop?
+
+            if "tcp_nodelay" not in plugin_props:
+                plugin_props["tcp_nodelay"] = bool(TP_TCP_NODELAY_DEFAULT)  # Send small messages immediately?
+
+            if "capture_traffic" not in plugin_props:
+                plugin_props["capture_traffic"] = bool(TP_CAPTURE_TRAFFIC_DEFAULT)  # Capture traffic for replay (tpReplay.py)?
+
+            if "trace_latency" not in plugin_props:
+                plugin_props["trace_latency"] = bool(TP_TRACE_LATENCY_DEFAULT)  # Trace the latency of Touch Portal actions?
+
+            if "liveness_timeout" not in plugin_props:
+                plugin_props["liveness_timeout"] = TP_LIVENESS_TIMEOUT_DEFAULT  # Recover connection if silent for n seconds?
+
             if "tp_devices" not in plugin_props or plugin_props["tp_devices"] == "":
                 plugin_props["tp_devices"] = json.dumps({})  # Empty dictionary in JSON container
 
@@ -591,23 +794,29 @@ class Plugin(indigo.PluginBase):
     def runConcurrentThread(self):
 
         try:
-            while True:
-                self.sleep(5)  # Sleep for 5 seconds
-
-                if self.globals[K_RECOVERY_INVOKED]:
-                    if len(self.globals[K_RECOVERY_INVOKED]) > 0:
+            metrics_publish_time = time.time() + TP_METRICS_PUBLISH_SECONDS
+            liveness_check_time = time.time() + TP_LIVENESS_CHECK_SECONDS
 
-                        # Initiate socket recovery process - See method handleCommunication in tpReader
-                        self.globals[K_LOCK].acquire()  # Serialise update of 'recoveryInvoked' list
-                        dev_id = self.globals[K_RECOVERY_INVOKED].pop(0)  # retrieve first (likely only) device to recover
-                        self.globals[K_LOCK].release()
-
-                        dev = indigo.devices[dev_id]
-                        connected = self.tp_connect(dev)
-                        if connected:
-                            self.logger.debug(u"\"{0}\" attempting reconnection to the Touch Portal Desktop".format(dev.name))
-                        else:
-                            self.logger.error(u"\"{0}\" reconnecting to the Touch Portal Desktop failed".format(dev.name))
+            while True:
+                # Wait until a socket recovery is requested / due or it is time to check liveness / publish metrics
+                self.globals[K_RECONNECT_SCHEDULER].wait(max(0.0, min(metrics_publish_time, liveness_check_time) - time.time()))
+                if self.stopThread:
+                    raise self.StopThread
+
+                if time.time() >= liveness_check_time:
+                    liveness_check_time = time.time() + TP_LIVENESS_CHECK_SECONDS
+                    self.check_tp_liveness()
+
+                if time.time() >= metrics_publish_time:
+                    metrics_publish_time = time.time() + TP_METRICS_PUBLISH_SECONDS
+                    self.publish_tp_metrics()
+
+                # Initiate socket recovery process for every device that is due - See tpReader / tpSelector
+                # Each device is recovered in its own short-lived thread so that recoveries run in parallel
+                for dev_id in self.globals[K_RECONNECT_SCHEDULER].due():
+                    recovery_thread = threading.Thread(target=self.tp_recover, args=(dev_id,))
+                    recovery_thread.setDaemon(True)  # Forces thread to close if plugin is reloaded
+                    recovery_thread.start()
 
         except self.StopThread:
             pass    # Optionally catch the StopThread exception and do any needed cleanup.
@@ -620,6 +829,9 @@ class Plugin(indigo.PluginBase):
         """
 
         self.logger.debug(u"Shutdown called")
+
+        if K_THREAD in self.globals[K_SELECTOR]:
+            self.globals[K_SELECTOR][K_THREAD].stop()
         self.logger.info(u"'Touch Portal' Plugin shutdown complete")
 
     # =============================================================================
@@ -630,6 +842,7 @@ class Plugin(indigo.PluginBase):
 
         indigo.devices.subscribeToChanges()
         indigo.variables.subscribeToChanges()
+        indigo.actionGroups.subscribeToChanges()  # Keeps the action group snapshots up to date (see tpSnapshots)
         self.logger.debug(u"Touch Portal initialisation complete")
 
     # =============================================================================
@@ -640,6 +853,7 @@ class Plugin(indigo.PluginBase):
 
         self.logger.debug(u"Thread shutdown called")
         self.stopThread = True
+        self.globals[K_RECONNECT_SCHEDULER].wakeup()  # Release runConcurrentThread from its wait
 
     # =============================================================================
     def validateActionConfigUi(self, values_dict, type_id, action_id):
@@ -717,6 +931,41 @@ class Plugin(indigo.PluginBase):
             except ValueError:
                 error_dict["timeout"] = u"The socket timeout value must be a numeric value."
 
+            # =============================== Receive Buffer Size Field ===============================
+            try:
+                if int(values_dict["receive_buffer_size"]) < 1024:
+                    error_dict["receive_buffer_size"] = u"The receive buffer size cannot be less than 1024 bytes."
+            except ValueError:
+                error_dict["receive_buffer_size"] = u"The receive buffer size must be a numeric value."
+
+            # =============================== Max Message Size Field ===============================
+            try:
+                if int(values_dict["max_message_size"]) < 1024:
+                    error_dict["max_message_size"] = u"The maximum message size cannot be less than 1024 bytes."
+            except ValueError:
+                error_dict["max_message_size"] = u"The maximum message size must be a numeric value."
+
+            # =============================== Queue Capacity Field ===============================
+            try:
+                if int(values_dict["queue_capacity"]) < 16:
+                    error_dict["queue_capacity"] = u"The queue capacity cannot be less than 16 entries."
+            except ValueError:
+                error_dict["queue_capacity"] = u"The queue capacity must be a numeric value."
+
+            # =============================== Indigo Command Threads Field ===============================
+            try:
+                if int(values_dict["indigo_workers"]) < 1 or int(values_dict["indigo_workers"]) > TP_INDIGO_WORKERS_MAXIMUM:
+                    error_dict["indigo_workers"] = u"The number of Indigo command threads must be between 1 and {0}.".format(TP_INDIGO_WORKERS_MAXIMUM)
+            except ValueError:
+                error_dict["indigo_workers"] = u"The number of Indigo command threads must be a numeric value."
+
+            # =============================== Duplicate Press Milliseconds Field ===============================
+            try:
+                if int(values_dict["duplicate_press_ms"]) < 0 or int(values_dict["duplicate_press_ms"]) > TP_DUPLICATE_PRESS_MS_MAXIMUM:
+                    error_dict["duplicate_press_ms"] = u"The duplicate press milliseconds must be between 0 and {0}.".format(TP_DUPLICATE_PRESS_MS_MAXIMUM)
+            except ValueError:
+                error_dict["duplicate_press_ms"] = u"The duplicate press milliseconds must be a numeric value."
+
             # =============================== Socket Retry Seconds Field ===============================
             try:
                 int(values_dict["socket_retry_seconds"])   # Throws a ValueError if not numeric
@@ -733,6 +982,14 @@ class Plugin(indigo.PluginBase):
             except ValueError:
                 error_dict["socket_retry_silent_after"] = u"The retry silent after 'n' attempts value must be a numeric value."
 
+            # =============================== Liveness Timeout Field ===============================
+            try:
+                liveness_timeout = int(values_dict["liveness_timeout"])   # Throws a ValueError if not numeric
+                if liveness_timeout != 0 and liveness_timeout < 10:
+                    error_dict["liveness_timeout"] = u"The liveness timeout must be zero (off) or at least 10 seconds."
+            except ValueError:
+                error_dict["liveness_timeout"] = u"The liveness timeout value must be a numeric value."
+
             # =============================== Save button "safety net' ===============================
             error_button = ""
             if values_dict["tp_devices_list"] == "_ADD":
@@ -775,6 +1032,32 @@ class Plugin(indigo.PluginBase):
 
         # =============================================================================
 
+    # =============================================================================
+    def variableCreated(self, var):
+        """
+        Indigo method invoked when any Indigo variable is created.
+
+        -----
+        :param var:
+        :return:
+        """
+
+        self.globals[K_TP][K_SNAPSHOT_CACHE].invalidate(TP_SNAPSHOT_VARIABLES, var.id)
+        indigo.PluginBase.variableCreated(self, var)
+
+    # =============================================================================
+    def variableDeleted(self, var):
+        """
+        Indigo method invoked when any Indigo variable is deleted.
+
+        -----
+        :param var:
+        :return:
+        """
+
+        self.globals[K_TP][K_SNAPSHOT_CACHE].invalidate(TP_SNAPSHOT_VARIABLES, var.id)
+        indigo.PluginBase.variableDeleted(self, var)
+
     # =============================================================================
     def variableUpdated(self, orig_var, new_var):
         """
@@ -787,42 +1070,41 @@ class Plugin(indigo.PluginBase):
         """
 
         try:
+            self.globals[K_TP][K_SNAPSHOT_CACHE].update(TP_SNAPSHOT_VARIABLES, new_var)  # Only if cached
+
             # At this point check if variable is known to Touch Portal desktop
             # and if so update required states if they have changed.
 
-            if K_MONITORED_VARIABLES in self.globals[K_TP]:
-                if new_var.id in self.globals[K_TP][K_MONITORED_VARIABLES]:
-                    monitor_list = self.globals[K_TP][K_MONITORED_VARIABLES][new_var.id]
+            monitors = self.globals[K_TP][K_MONITOR_INDEX].variables.get(new_var.id)
+            if monitors is not None and orig_var.value != new_var.value:
+                for monitor_list in monitors:  # One per Touch Portal device mirroring the variable
                     tp_desktop_device_id = monitor_list[TP_MONITOR_TP_DESKTOP_DEV_ID]
-                    tp_state_id = monitor_list[TP_MONITOR_TP_STATE_ID]
-                    monitor_true_false = monitor_list[TP_MONITOR_TRUE_FALSE]
-                    monitor_text = monitor_list[TP_MONITOR_TEXT]
-
-                    if monitor_true_false:
-                        if orig_var.value != new_var.value:
-                            self.logger.debug(
-                                u"K_MONITORED_VARIABLE [ON_OFF]:\n{0}\n".format(self.globals[K_TP][K_MONITORED_VARIABLES]))
-
-                            new_state_value = new_var.value.lower()
-                            if new_state_value == "false" or new_state_value == "true":
-                                tp_state_id = u"indigo_variable_{0}_true_false".format(new_var.id)
-                                tp_message = '{{"type": "stateUpdate", "id": "{0}", "value" : "{1}"}}'.format(tp_state_id, new_state_value)
-
-                                self.globals[K_THREADS][tp_desktop_device_id][K_THREAD_HANDLER][K_THREAD].process_send_tp_message(tp_desktop_device_id, tp_message)
-                            else:
-                                self.logger.error(u"Touch Portal monitored boolean Variable '{0}' update "
-                                                  u"intercepted to non-bool value: '{1}' - State Update "
-                                                  u"ignored!".format(new_var.name, new_state_value))
-
-                    elif monitor_text:
-                        if orig_var.value != new_var.value:
-                            self.logger.debug(
-                                u"K_MONITORED_VARIABLE [TEXT]:\n{0}\n".format(self.globals[K_TP][K_MONITORED_VARIABLES]))
+                    writer = self.tp_writer(tp_desktop_device_id)
+                    if writer is None:
+                        continue  # Touch Portal device not connected since it started
+                    state_sent = False
+
+                    if monitor_list[TP_MONITOR_TRUE_FALSE]:
+                        self.logger.debug(u"MONITORED VARIABLE [ON_OFF]: {0}".format(monitor_list))
 
+                        new_state_value = new_var.value.lower()
+                        if new_state_value == "false" or new_state_value == "true":
                             tp_state_id = u"indigo_variable_{0}_true_false".format(new_var.id)
-                            tp_message = '{{"type": "stateUpdate", "id": "{0}", "value" : "{1}"}}'.format(tp_state_id, new_var.value)
+                            state_sent = writer.send_state_update(tp_state_id, new_state_value)
+                        else:
+                            self.logger.error(u"Touch Portal monitored boolean Variable '{0}' update "
+                                              u"intercepted to non-bool value: '{1}' - State Update "
+                                              u"ignored!".format(new_var.name, new_state_value))
+
+                    elif monitor_list[TP_MONITOR_TEXT]:
+                        self.logger.debug(u"MONITORED VARIABLE [TEXT]: {0}".format(monitor_list))
 
-                            self.globals[K_THREADS][tp_desktop_device_id][K_THREAD_HANDLER][K_THREAD].process_send_tp_message(tp_desktop_device_id, tp_message)
+                        tp_state_id = u"indigo_variable_{0}_text".format(new_var.id)  # As created by entry_tp_generator
+                        state_sent = writer.send_state_update(tp_state_id, new_var.value)
+
+                    tracer = self.globals[K_TP][tp_desktop_device_id].get(K_TRACER)
+                    if state_sent and tracer is not None:
+                        tracer.echo(new_var.id)  # Completes the trace of the Touch Portal action which changed the variable
 
         except StandardError as standard_error_message:
             self.logger.error(u"StandardError detected in Touch Portal Plugin [variableUpdated] for variable '{0}']. "
@@ -869,7 +1151,7 @@ class Plugin(indigo.PluginBase):
 
         try:
             self.globals[K_QUEUES][dev_id][K_RECEIVE_FROM_SEND_TO_TP]\
-                .put([QUEUE_PRIORITY_HIGH, 0, CMD_PROCESS_REFRESH_TP_PLUGIN_STATES, dev_id, None])
+                .put(TpQueueEntry(QUEUE_PRIORITY_HIGH, CMD_PROCESS_REFRESH_TP_PLUGIN_STATES, dev_id, None))
 
         except StandardError as standard_error_message:
             self.logger.error(u"StandardError detected in Touch Portal Plugin [action_refresh_tp_plugin_states] for "
@@ -947,15 +1229,11 @@ class Plugin(indigo.PluginBase):
             self.logger.debug(u"UPDATESTATEVALUE [{0}] = {1}".format(type(tp_value), tp_value))
 
             if tp_value != "":
-                #  Only send value if not blank -
-                state_update_message = ('{{"type":"{0}","id":"{1}","value":"{2}"}}'
-                                        .format("stateUpdate", tp_id, tp_value))
-
-                self.logger.debug(u"STATE_UPDATE_MESSAGE = {0}".format(state_update_message))
-
-                # self.globals[K_QUEUES][dev_id][K_SEND_TO_TP].put([QUEUE_PRIORITY_HIGH, 0, CMD_PROCESS_SEND_TP_MESSAGE, dev_id, [state_update_message]])
-
-                self.globals[K_THREADS][dev_id][K_THREAD_HANDLER][K_THREAD].process_send_tp_message(dev_id, state_update_message)
+                #  Only send value if not blank (and not already showing in Touch Portal) -
+                if self.globals[K_THREADS][dev_id][K_THREAD_WRITER][K_THREAD].send_state_update(tp_id, tp_value):
+                    self.logger.debug(u"STATE_UPDATE_MESSAGE: '{0}' = {1}".format(tp_id, tp_value))
+                else:
+                    self.logger.debug(u"STATE_UPDATE_MESSAGE: '{0}' unchanged or Touch Portal Desktop disconnected = {1}".format(tp_id, tp_value))
 
             else:
                 self.logger.error(u"STATE_UPDATE_MESSAGE: Value missing for device "
@@ -1133,6 +1411,70 @@ class Plugin(indigo.PluginBase):
         # self.logger.debug(u"add_new_tp_device VALUES DICT = {0}".format(values_dict))
         return values_dict
 
+    # =============================================================================
+    def check_tp_liveness(self):
+        """
+        Plugin method to detect Touch Portal Desktops that have gone away without closing the connection (half-open).
+        A connection that has been silent for half the liveness timeout is probed with a pair message (Touch Portal
+        Desktop replies with an info message). If nothing at all is received within the liveness timeout, the socket
+        is shut down which invokes the normal socket recovery process in tpReader / tpSelector.
+        """
+
+        try:
+            now = time.time()
+            for dev in indigo.devices.iter("self"):
+                dev_id = dev.id
+                if dev_id not in self.globals[K_TP] or not self.globals[K_TP][dev_id].get(K_DEVICE_STARTED, False):
+                    continue
+                liveness_timeout = self.globals[K_TP][dev_id].get(K_LIVENESS_TIMEOUT, 0)
+                if liveness_timeout <= 0 or dev.states.get("connection_status", "") != "Connected":
+                    continue
+
+                last_received = self.globals[K_TP][dev_id].get(K_LAST_RECEIVED, now)
+                silent_seconds = now - last_received
+
+                if silent_seconds >= liveness_timeout:
+                    self.logger.warning(u"'{0}' has heard nothing from Touch Portal Desktop for {1} seconds - reconnecting"
+                                        .format(dev.name, int(silent_seconds)))
+                    self.globals[K_TP][dev_id][K_LAST_RECEIVED] = now  # Don't repeat whilst recovery is under way
+                    try:
+                        self.globals[K_SOCKETS][dev_id][K_TP_SOCKET].shutdown(socket.SHUT_RDWR)
+                    except (KeyError, socket.error):
+                        pass  # Socket already closed - recovery is under way
+
+                elif silent_seconds >= liveness_timeout / 2.0:
+                    probe_sent = self.globals[K_TP][dev_id].get(K_LIVENESS_PROBE_SENT)
+                    if probe_sent is None or probe_sent < last_received:
+                        self.globals[K_TP][dev_id][K_LIVENESS_PROBE_SENT] = now
+                        self.globals[K_QUEUES][dev_id][K_RECEIVE_FROM_SEND_TO_TP].put(
+                            TpQueueEntry(QUEUE_PRIORITY_HIGH, CMD_PROCESS_SEND_TP_MESSAGE, dev_id,
+                                         ['{"type":"pair", "id":"indigo_domotics_001"}']))
+
+        except StandardError as standard_error_message:
+            self.logger.error(u"StandardError detected in Touch Portal Plugin [check_tp_liveness]. "
+                              u"Line '{0}' has error='{1}'".format(sys.exc_traceback.tb_lineno,
+                                                                   standard_error_message))
+
+    # =============================================================================
+    def compile_tp_registry(self, dev_id, tp_devices_json):
+        """
+        Plugin method to compile the published items of a Touch Portal device (its 'tp_devices' property) into the
+        registry used by the TP Handler thread. The new registry replaces the old one in a single assignment so the
+        handler sees either the old or the new items, never a mixture.
+
+        -----
+        :param dev_id: Indigo Touch Portal device id
+        :param tp_devices_json: JSON dict of the published items
+        :return:
+        """
+
+        try:
+            self.globals[K_TP][dev_id][K_TP_REGISTRY] = TpRegistry.from_json(tp_devices_json)
+        except ValueError as value_error_message:
+            self.logger.error(u"Published Touch Portal items of '{0}' are invalid and can't be used: {1}"
+                              .format(indigo.devices[dev_id].name, value_error_message))
+            self.globals[K_TP][dev_id][K_TP_REGISTRY] = TpRegistry({})
+
     # =============================================================================
     def delete_devices(self, values_dict, type_id, dev_id):
         try:
@@ -1171,6 +1513,33 @@ class Plugin(indigo.PluginBase):
                 device_list.append((dev.id, dev.name))
         return device_list
 
+    # =============================================================================
+    def dump_tp_action_latency(self, values_dict=None, type_id=""):
+        """
+        Plugin menu method to log the latency percentiles of the Touch Portal actions traced by each Touch Portal device
+        (see the device's 'Trace Action Latency' option).
+
+        -----
+        :param values_dict:
+        :param type_id:
+        :return:
+        """
+        try:
+            tracing = False
+            for dev in indigo.devices.iter("self"):
+                tracer = self.globals[K_TP].get(dev.id, {}).get(K_TRACER)
+                if tracer is None:
+                    continue
+                tracing = True
+                self.logger.info(u"Touch Portal action latency of '{0}':\n{1}\n".format(dev.name, u"\n".join(tracer.report())))
+            if not tracing:
+                self.logger.info(u"No Touch Portal device is tracing action latency - enable 'Trace Action Latency' in the device's settings")
+
+        except StandardError as standard_error_message:
+            self.logger.error(u"StandardError detected in Touch Portal Plugin [dump_tp_action_latency]. "
+                              u"Line '{0}' has error='{1}'".format(sys.exc_traceback.tb_lineno,
+                                                                   standard_error_message))
+
     # =============================================================================
     def initialise_device_config_dialogue(self, dialogue_dict):
         try:
@@ -1255,6 +1624,49 @@ class Plugin(indigo.PluginBase):
 
             self.logger.info(u"Sent \"{0}\"  {1} - connecting to Touch Portal Desktop".format(dev.name, process_ui))
 
+    # =============================================================================
+    def publish_tp_metrics(self):
+        """
+        Plugin method to publish the performance figures of each started Touch Portal device as device states.
+        Plugin CPU and thread count are plugin-wide and allow the connection I/O engines to be compared, as are the
+        Indigo snapshot cache lookups (see tpSnapshots).
+        """
+
+        try:
+            cpu_times = os.times()
+            cpu_seconds = cpu_times[0] + cpu_times[1]  # user + system
+            wall_seconds = time.time()
+            if K_METRICS in self.globals[K_TP]:
+                previous_cpu_seconds, previous_wall_seconds = self.globals[K_TP][K_METRICS]
+                cpu_percent = round(((cpu_seconds - previous_cpu_seconds) * 100.0) / max(wall_seconds - previous_wall_seconds, 0.001), 1)
+            else:
+                cpu_percent = 0.0
+            self.globals[K_TP][K_METRICS] = (cpu_seconds, wall_seconds)
+            thread_count = threading.active_count()
+            cache_hits, cache_misses = self.globals[K_TP][K_SNAPSHOT_CACHE].statistics()
+            cache_hit_percent = round((cache_hits * 100.0) / max(cache_hits + cache_misses, 1), 1)
+
+            for dev in indigo.devices.iter("self"):
+                if dev.id not in self.globals[K_TP] or not self.globals[K_TP][dev.id].get(K_DEVICE_STARTED, False):
+                    continue
+                metrics = self.globals[K_TP][dev.id][K_METRICS]
+                metrics.set("plugin_cpu_percent", cpu_percent)
+                metrics.set("plugin_thread_count", thread_count)
+                metrics.set("indigo_cache_hits", cache_hits)
+                metrics.set("indigo_cache_misses", cache_misses)
+                metrics.set("indigo_cache_hit_percent", cache_hit_percent)
+                if K_LAST_RECEIVED in self.globals[K_TP][dev.id]:
+                    metrics.set("last_seen", datetime.datetime.fromtimestamp(
+                        self.globals[K_TP][dev.id][K_LAST_RECEIVED]).strftime("%Y-%m-%d %H:%M:%S"))
+                if self.globals[K_TP][dev.id].get(K_TRACER) is not None:
+                    self.globals[K_TP][dev.id][K_TRACER].publish(metrics)
+                metrics.publish(dev)
+
+        except StandardError as standard_error_message:
+            self.logger.error(u"StandardError detected in Touch Portal Plugin [publish_tp_metrics]. "
+                              u"Line '{0}' has error='{1}'".format(sys.exc_traceback.tb_lineno,
+                                                                   standard_error_message))
+
     # =============================================================================
     def published_tp_devices_list(self, filter, values_dict, typeId, dev_id):
 
@@ -1429,7 +1841,7 @@ class Plugin(indigo.PluginBase):
             if dev_id in self.globals[K_THREADS]:
                 if K_THREAD_READER in self.globals[K_THREADS][dev_id]:
                     try:
-                        self.globals[K_THREADS][dev_id][K_THREAD_READER][K_EVENT].set()
+                        self.globals[K_THREADS][dev_id][K_THREAD_READER][K_THREAD].stop()  # Wakes the thread so that it stops immediately
                         self.globals[K_THREADS][dev_id][K_THREAD_READER][K_THREAD].join(timeout=10)  # Wait at least 'timeout' seconds for thread to end
                     except StandardError as standard_error_message:
                         self.logger.error(u"StandardError [1] detected in Touch Portal Plugin [tp_connect of device "
@@ -1438,11 +1850,14 @@ class Plugin(indigo.PluginBase):
                                                                                        standard_error_message))
                         connecting_status = u"TP Reader Thread purge error: '{0}'".format(standard_error_message)  # Error clearing out previous TP Reader thread
 
+            # Check if the shared selector is managing this Touch Portal device and if so, stop it
+            self.tp_selector_unregister(dev_id)
+
             # Check if TP Handler thread is running for this Touch Portal device and if so, stop it
             if dev_id in self.globals[K_THREADS]:
                 if K_THREAD_HANDLER in self.globals[K_THREADS][dev_id]:
                     try:
-                        self.globals[K_THREADS][dev_id][K_THREAD_HANDLER][K_EVENT].set()
+                        self.globals[K_THREADS][dev_id][K_THREAD_HANDLER][K_THREAD].stop()  # Wakes the thread so that it stops immediately
                         self.globals[K_THREADS][dev_id][K_THREAD_HANDLER][K_THREAD].join(timeout=10)  # Wait at least 'timeout' seconds for thread to end
                     except StandardError as standard_error_message:
                         self.logger.error(u"StandardError [1] detected in Touch Portal Plugin [tp_connect of device "
@@ -1451,16 +1866,66 @@ class Plugin(indigo.PluginBase):
                                                                                        standard_error_message))
                         connecting_status = u"TP Handler Thread purge error: '{0}'".format(standard_error_message)  # Error clearing out previous TP Handler thread
 
+            # Check if TP Writer thread is running for this Touch Portal device and if so, stop it
+            if dev_id in self.globals[K_THREADS]:
+                if K_THREAD_WRITER in self.globals[K_THREADS][dev_id]:
+                    try:
+                        self.globals[K_THREADS][dev_id][K_THREAD_WRITER][K_THREAD].stop()  # Wakes the thread so that it stops immediately
+                        self.globals[K_THREADS][dev_id][K_THREAD_WRITER][K_THREAD].join(timeout=10)  # Wait at least 'timeout' seconds for thread to end
+                    except StandardError as standard_error_message:
+                        self.logger.error(u"StandardError [1] detected in Touch Portal Plugin [tp_connect of device "
+                                          u"'{0}']. Line '{1}' has error='{2}'".format(dev.name,
+                                                                                       sys.exc_traceback.tb_lineno,
+                                                                                       standard_error_message))
+                        connecting_status = u"TP Writer Thread purge error: '{0}'".format(standard_error_message)  # Error clearing out previous TP Writer thread
+
             if connecting_status == "":
                 # Create (or replace) TP handler 'receive from / send to Touch Portal' queue
                 if dev_id not in self.globals[K_QUEUES]:
                     self.globals[K_QUEUES][dev_id] = {}
                 # Used to queue tpReader / tpHandler commands to be received from / sent to the Touch Portal Desktop
-                self.globals[K_QUEUES][dev_id][K_RECEIVE_FROM_SEND_TO_TP] = Queue.PriorityQueue()
+                self.globals[K_QUEUES][dev_id][K_RECEIVE_FROM_SEND_TO_TP] = TpBoundedPriorityQueue(
+                    self.globals[K_TP][dev_id].get(K_QUEUE_CAPACITY, int(TP_QUEUE_CAPACITY_DEFAULT)), self.globals[K_TP][dev_id][K_METRICS])
                 self.globals[K_QUEUES][dev_id][K_INITIALISED] = True
 
+                # Create (or replace) the pool of threads running Indigo commands for TP actions - commands already
+                # queued on the previous pool are allowed to finish first so that they stay in order
+                if self.globals[K_TP][dev_id].get(K_INDIGO_WORKERS) is not None:
+                    self.globals[K_TP][dev_id][K_INDIGO_WORKERS].stop(TP_INDIGO_WORKERS_STOP_SECONDS)
+                self.globals[K_TP][dev_id][K_INDIGO_WORKERS] = TpIndigoWorkerPool(
+                    self.globals[K_TP][dev_id].get(K_INDIGO_WORKER_COUNT, int(TP_INDIGO_WORKERS_DEFAULT)), self.globals[K_TP][dev_id][K_METRICS], dev_id)
+
             if connecting_status == "":
-                # Now start the TP Handler thread for this Touch Portal
+                # Now start the TP Writer thread for this Touch Portal (sends every message to Touch Portal Desktop)
+                if dev_id not in self.globals[K_THREADS]:
+                    self.globals[K_THREADS][dev_id] = {}
+                if K_THREAD_WRITER not in self.globals[K_THREADS][dev_id]:
+                    self.globals[K_THREADS][dev_id][K_THREAD_WRITER] = {}
+                try:
+                    self.globals[K_THREADS][dev_id][K_THREAD_WRITER][K_EVENT] = threading.Event()
+                    self.globals[K_THREADS][dev_id][K_THREAD_WRITER][K_THREAD] = ThreadTpWriter(self.globals, self.globals[K_THREADS][dev_id][K_THREAD_WRITER][K_EVENT], dev_id)
+                    self.globals[K_THREADS][dev_id][K_THREAD_WRITER][K_THREAD].setDaemon(True)  # Forces thread to close if plugin is reloaded
+                    self.globals[K_THREADS][dev_id][K_THREAD_WRITER][K_THREAD].start()
+                except StandardError as standard_error_message:
+                    self.logger.error(u"StandardError [3] detected in Touch Portal Plugin [tp_connect of device "
+                                      u"'{0}']. Line '{1}' has error='{2}'".format(dev.name,
+                                                                                   sys.exc_traceback.tb_lineno,
+                                                                                   standard_error_message))
+                    connecting_status = u"TP Writer create Thread error: '{0}'".format(standard_error_message)  # Error creating TP Writer thread
+
+            if connecting_status == "" and self.globals[K_TP][dev_id].get(K_IO_ENGINE, TP_IO_ENGINE_DEFAULT) == TP_IO_ENGINE_SELECTOR:
+                # Hand the connection to the shared selector thread instead of starting a TP Reader thread
+                try:
+                    self.tp_selector_register(dev_id)
+                except StandardError as standard_error_message:
+                    self.logger.error(u"StandardError [2] detected in Touch Portal Plugin [tp_connect of device "
+                                      u"'{0}']. Line '{1}' has error='{2}'".format(dev.name,
+                                                                                   sys.exc_traceback.tb_lineno,
+                                                                                   standard_error_message))
+                    connecting_status = u"TP Selector register error: '{0}'".format(standard_error_message)  # Error registering with TP Selector thread
+
+            elif connecting_status == "":
+                # Now start the TP Reader thread for this Touch Portal
                 if dev_id not in self.globals[K_THREADS]:
                     self.globals[K_THREADS][dev_id] = {}
                 if K_THREAD_READER not in self.globals[K_THREADS][dev_id]:
@@ -1478,6 +1943,7 @@ class Plugin(indigo.PluginBase):
                                                                                    standard_error_message))
                     connecting_status = u"TP Reader  create Thread error: '{0}'".format(standard_error_message)  # Error creating TP Reader thread
 
+            if connecting_status == "":
                 # Now start the TP Handler thread for this Touch Portal
                 if dev_id not in self.globals[K_THREADS]:
                     self.globals[K_THREADS][dev_id] = {}
@@ -1607,7 +2073,7 @@ class Plugin(indigo.PluginBase):
             if dev_id in self.globals[K_THREADS]:
                 if K_THREAD_READER in self.globals[K_THREADS][dev_id]:
                     try:
-                        self.globals[K_THREADS][dev_id][K_THREAD_READER][K_EVENT].set()
+                        self.globals[K_THREADS][dev_id][K_THREAD_READER][K_THREAD].stop()  # Wakes the thread so that it stops immediately
                         self.globals[K_THREADS][dev_id][K_THREAD_READER][K_THREAD].join(timeout=3)  # Wait at least 'timeout' seconds for thread to end
                     except StandardError as standard_error_message:
                         self.logger.error(u"Error detected in Touch Portal Plugin [tp_disconnect of device "
@@ -1616,11 +2082,17 @@ class Plugin(indigo.PluginBase):
                                                                                        standard_error_message))
                         disconnecting_status = u"Disconnecting thread error"  # Error clearing out previous TP Reader thread
 
+            # Check if the shared selector is managing this Touch Portal device and if so, stop it
+            self.tp_selector_unregister(dev_id)
+
+            # Forget any outstanding socket recovery for this Touch Portal device
+            self.globals[K_RECONNECT_SCHEDULER].cancel(dev_id)
+
             # Check if TP Handler thread is running for this Touch Portal device and if so, stop it
             if dev_id in self.globals[K_THREADS]:
                 if K_THREAD_HANDLER in self.globals[K_THREADS][dev_id]:
                     try:
-                        self.globals[K_THREADS][dev_id][K_THREAD_HANDLER][K_EVENT].set()
+                        self.globals[K_THREADS][dev_id][K_THREAD_HANDLER][K_THREAD].stop()  # Wakes the thread so that it stops immediately
                         self.globals[K_THREADS][dev_id][K_THREAD_HANDLER][K_THREAD].join(timeout=3)  # Wait at least 'timeout' seconds for thread to end
                     except StandardError as standard_error_message:
                         self.logger.error(u"Error detected in Touch Portal Plugin [tp_disconnect of device "
@@ -1629,6 +2101,24 @@ class Plugin(indigo.PluginBase):
                                                                                        standard_error_message))
                         disconnecting_status = u"Disconnecting thread error"  # Error clearing out previous TP Handler thread
 
+            # Check if TP Writer thread is running for this Touch Portal device and if so, stop it
+            if dev_id in self.globals[K_THREADS]:
+                if K_THREAD_WRITER in self.globals[K_THREADS][dev_id]:
+                    try:
+                        self.globals[K_THREADS][dev_id][K_THREAD_WRITER][K_THREAD].stop()  # Wakes the thread so that it stops immediately
+                        self.globals[K_THREADS][dev_id][K_THREAD_WRITER][K_THREAD].join(timeout=3)  # Wait at least 'timeout' seconds for thread to end
+                    except StandardError as standard_error_message:
+                        self.logger.error(u"Error detected in Touch Portal Plugin [tp_disconnect of device "
+                                          u"'{0}']. Line '{1}' has error='{2}'".format(dev.name,
+                                                                                       sys.exc_traceback.tb_lineno,
+                                                                                       standard_error_message))
+                        disconnecting_status = u"Disconnecting thread error"  # Error clearing out previous TP Writer thread
+
+            # Stop the Indigo command threads once the commands already queued have been run
+            if self.globals[K_TP][dev_id].get(K_INDIGO_WORKERS) is not None:
+                self.globals[K_TP][dev_id][K_INDIGO_WORKERS].stop()
+                self.globals[K_TP][dev_id][K_INDIGO_WORKERS] = None
+
             if disconnecting_status != "":
                 dev.updateStateOnServer("connection_status", disconnecting_status)
                 dev.setErrorStateOnServer("Connection Error")
@@ -1647,6 +2137,77 @@ class Plugin(indigo.PluginBase):
                                                                    standard_error_message))
             return False
 
+    # =============================================================================
+    def tp_recover(self, dev_id):
+        """
+        Plugin method to recover the connection of a Touch Portal device whose connection has been lost.
+        Invoked in its own thread by runConcurrentThread.
+
+        -----
+        :param dev_id:
+        :return:
+        """
+
+        try:
+            dev = indigo.devices[dev_id]
+            if not dev.enabled:
+                return  # Device has been disabled since the recovery was requested
+
+            connected = self.tp_connect(dev)
+            if connected:
+                self.logger.debug(u"\"{0}\" attempting reconnection to the Touch Portal Desktop".format(dev.name))
+            else:
+                self.logger.error(u"\"{0}\" reconnecting to the Touch Portal Desktop failed".format(dev.name))
+
+        except StandardError as standard_error_message:
+            self.logger.error(u"StandardError detected in Touch Portal Plugin [tp_recover]. "
+                              u"Line '{0}' has error='{1}'".format(sys.exc_traceback.tb_lineno,
+                                                                   standard_error_message))
+
+    # =============================================================================
+    def tp_selector_register(self, dev_id):
+        """
+        Plugin method to hand a Touch Portal device's connection to the shared selector thread.
+        The selector thread is started on first use.
+
+        -----
+        :param dev_id:
+        :return:
+        """
+
+        if K_THREAD not in self.globals[K_SELECTOR] or not self.globals[K_SELECTOR][K_THREAD].is_alive():
+            self.globals[K_SELECTOR][K_EVENT] = threading.Event()
+            self.globals[K_SELECTOR][K_THREAD] = ThreadTpSelector(self.globals, self.globals[K_SELECTOR][K_EVENT])
+            self.globals[K_SELECTOR][K_THREAD].setDaemon(True)  # Forces thread to close if plugin is reloaded
+            self.globals[K_SELECTOR][K_THREAD].start()
+
+        self.globals[K_SELECTOR][K_THREAD].register(dev_id)
+
+    # =============================================================================
+    def tp_selector_unregister(self, dev_id):
+        """
+        Plugin method to stop the shared selector thread managing a Touch Portal device's connection.
+
+        -----
+        :param dev_id:
+        :return:
+        """
+
+        if K_THREAD in self.globals[K_SELECTOR] and self.globals[K_SELECTOR][K_THREAD].is_alive():
+            self.globals[K_SELECTOR][K_THREAD].unregister(dev_id)
+
+    # =============================================================================
+    def tp_writer(self, dev_id):
+        """
+        Plugin method to return the TP Writer thread of a Touch Portal device.
+
+        -----
+        :param dev_id: Indigo Touch Portal device id
+        :return: ThreadTpWriter or None if the Touch Portal device hasn't connected since it started
+        """
+
+        return self.globals[K_THREADS].get(dev_id, {}).get(K_THREAD_WRITER, {}).get(K_THREAD)
+
     # =============================================================================
     def update_tp_device(self, values_dict, type_id, dev_id):
 
@@ -0,0 +1,139 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Touch Portal [tpBenchmark] © Autolog & DaveL17 2020
+#
+# Standalone tool (not loaded by Indigo) that replays synthetic Indigo device updates through plugin.deviceUpdated -
+# which Indigo calls for every device change in the house - against a fake 'indigo' module (see tpReplay.py) and
+# reports the cost per call.
+#
+# Usage: python tpBenchmark.py [--updates n] [--devices n] [--monitored n] [--desktops n] [--seed n] [--debug]
+#   --updates is the number of device updates replayed (default 100000).
+#   --devices is the number of Indigo devices updated - the first --monitored of them are mirrored by every desktop.
+#   --desktops is the number of Touch Portal devices (desktops).
+#   --debug enables the plugin's debug logging (discarded) so that its cost is included.
+#
+
+# noinspection PyUnresolvedReferences
+# ============================== Native Imports ===============================
+import argparse
+import copy
+import logging
+import random
+import sys
+import threading
+import time
+
+from tpReplay import build_fake_indigo
+
+BENCHMARK_FIRST_DESKTOP_ID = 1  # Indigo device ids of the fake Touch Portal devices
+BENCHMARK_FIRST_DEVICE_ID = 1001  # Indigo device ids of the devices updated
+
+
+# =============================================================================
+def benchmark(arguments):
+    """
+    Replay the synthetic device updates and report the cost per call.
+
+    -----
+    :param arguments: parsed command line arguments
+    :return: exit code
+    """
+    indigo = build_fake_indigo(0.0)
+    sys.modules["indigo"] = indigo  # Must be installed before the plugin modules are imported
+
+    from constants import K_DESKTOP_STATES, K_METRICS, K_MONITOR_INDEX, K_SNAPSHOT_CACHE, K_THREAD, K_THREAD_WRITER, K_THREADS, K_TP
+    import plugin
+    from tpMetrics import TpMetrics
+    from tpMonitors import TpMonitorIndex
+    from tpSnapshots import TpSnapshotCache
+    from tpWriter import ThreadTpWriter, TpDesktopStates
+
+    random.seed(arguments.seed)
+
+    monitor_index = TpMonitorIndex()
+    plugin_globals = {K_TP: {K_MONITOR_INDEX: monitor_index, K_SNAPSHOT_CACHE: TpSnapshotCache()}, K_THREADS: {}}
+    writers = []
+    for desktop_number in range(arguments.desktops):
+        desktop_id = BENCHMARK_FIRST_DESKTOP_ID + desktop_number
+        metrics = TpMetrics()
+        plugin_globals[K_TP][desktop_id] = {K_METRICS: metrics, K_DESKTOP_STATES: TpDesktopStates(metrics)}
+        writer = ThreadTpWriter(plugin_globals, threading.Event(), desktop_id)  # Not started - messages are counted, not written
+        writer.paired()
+        plugin_globals[K_THREADS][desktop_id] = {K_THREAD_WRITER: {K_THREAD: writer}}
+        writers.append(writer)
+
+        # Every desktop mirrors the on / off state of the monitored devices, half their brightness and a third their colour
+        monitored_devices = {}
+        for device_number in range(arguments.monitored):
+            monitored_devices[BENCHMARK_FIRST_DEVICE_ID + device_number] = [desktop_id, u"", True, device_number % 2 == 0, device_number % 3 == 0]
+        monitor_index.subscribe(desktop_id, monitored_devices, {})
+
+    # Plugin.__init__ needs an Indigo server - only the attributes used by deviceUpdated are set
+    tp_plugin = plugin.Plugin.__new__(plugin.Plugin)
+    tp_plugin.logger = logging.getLogger("Plugin")
+    tp_plugin.globals = plugin_globals
+
+    # A third of the updates change the on / off state, a third the brightness and a third something not mirrored
+    updates = []
+    for update_number in range(arguments.updates):
+        orig_dev = indigo.FakeIndigoObject(BENCHMARK_FIRST_DEVICE_ID + random.randrange(arguments.devices), u"Device")
+        orig_dev.deviceTypeId = "dimmer"
+        orig_dev.onState = random.random() < 0.5
+        orig_dev.brightness = random.randrange(101)
+        new_dev = copy.copy(orig_dev)
+        change = update_number % 3
+        if change == 0:
+            new_dev.onState = not orig_dev.onState
+        elif change == 1:
+            new_dev.brightness = (orig_dev.brightness + 1) % 101
+        else:
+            new_dev.states = {"lastChanged": update_number}
+        updates.append((orig_dev, new_dev))
+
+    monitored_ids = monitor_index.devices
+    monitored_updates = [update for update in updates if update[1].id in monitored_ids]
+    unmonitored_updates = [update for update in updates if update[1].id not in monitored_ids]
+
+    seconds = {}
+    for name, name_updates in (("unmonitored", unmonitored_updates), ("monitored", monitored_updates)):
+        start_time = time.time()
+        for orig_dev, new_dev in name_updates:
+            tp_plugin.deviceUpdated(orig_dev, new_dev)
+        seconds[name] = time.time() - start_time
+
+    total_seconds = seconds["unmonitored"] + seconds["monitored"]
+    print(u"Replayed {0} device updates ({1} devices, {2} monitored by {3} desktops)".format(
+        len(updates), arguments.devices, min(arguments.monitored, arguments.devices), arguments.desktops))
+    print(u"  Total time:           {0:.3f} seconds".format(total_seconds))
+    print(u"  Cost per call:        {0:.2f} us".format(total_seconds * 1000000.0 / max(len(updates), 1)))
+    print(u"  Unmonitored devices:  {0:.2f} us per call ({1} calls)".format(
+        seconds["unmonitored"] * 1000000.0 / max(len(unmonitored_updates), 1), len(unmonitored_updates)))
+    print(u"  Monitored devices:    {0:.2f} us per call ({1} calls)".format(
+        seconds["monitored"] * 1000000.0 / max(len(monitored_updates), 1), len(monitored_updates)))
+    print(u"  State updates queued: {0}".format(sum(len(writer.outbound) for writer in writers)))
+    return 0
+
+
+# =============================================================================
+def main():
+    parser = argparse.ArgumentParser(description="Time plugin.deviceUpdated with synthetic Indigo device updates.")
+    parser.add_argument("--updates", type=int, default=100000, help="device updates replayed (default 100000)")
+    parser.add_argument("--devices", type=int, default=2000, help="Indigo devices updated (default 2000)")
+    parser.add_argument("--monitored", type=int, default=50, help="devices mirrored by every desktop (default 50)")
+    parser.add_argument("--desktops", type=int, default=2, help="Touch Portal devices (default 2)")
+    parser.add_argument("--seed", type=int, default=1, help="random seed of the updates")
+    parser.add_argument("--debug", action="store_true", help="include the cost of the plugin's debug logging (discarded)")
+    arguments = parser.parse_args()
+
+    if arguments.debug:
+        logging.getLogger("Plugin").addHandler(logging.NullHandler())
+        logging.getLogger("Plugin").setLevel(logging.DEBUG)
+    else:
+        logging.basicConfig(level=logging.WARNING, format="%(name)s %(levelname)s %(message)s")
+
+    return benchmark(arguments)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
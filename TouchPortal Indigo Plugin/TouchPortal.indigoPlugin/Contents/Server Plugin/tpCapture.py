@@ -0,0 +1,54 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Touch Portal [tpCapture] © Autolog & DaveL17 2020
+#
+
+# noinspection PyUnresolvedReferences
+# ============================== Native Imports ===============================
+import logging
+import logging.handlers
+import threading
+import time
+
+# ============================== Plugin Imports ===============================
+from constants import *
+
+
+# noinspection PyUnresolvedReferences,PyPep8Naming,PyPep8
+class TpCapture(object):
+
+    # This class appends every message received from / sent to a Touch Portal Desktop to a rotating capture file.
+    # Each line is '<seconds since capture started> <I|O> <message>' - see tpReplay.py to replay a capture.
+
+    def __init__(self, path, max_bytes=TP_CAPTURE_MAX_BYTES, backup_count=TP_CAPTURE_BACKUP_COUNT):
+
+        self.lock = threading.Lock()  # Inbound messages are captured by the reader / selector and outbound by the handler
+        self.path = path
+        self.file_handler = logging.handlers.RotatingFileHandler(path, maxBytes=max_bytes, backupCount=backup_count)
+        self.file_handler.setFormatter(logging.Formatter("%(message)s"))
+        self.start_time = time.time()
+        self.last_offset = 0.0
+
+    # =============================================================================
+    def record(self, direction, message):
+        """
+        Append a message to the capture file.
+
+        -----
+        :param direction: TP_CAPTURE_INBOUND or TP_CAPTURE_OUTBOUND
+        :param message: message without its line terminator
+        :return:
+        """
+        if isinstance(message, unicode):
+            message = message.encode("utf-8")
+        with self.lock:
+            # Offsets never go backwards even if the system clock is adjusted whilst capturing
+            offset = max(self.last_offset, time.time() - self.start_time)
+            self.last_offset = offset
+            self.file_handler.emit(logging.makeLogRecord({"msg": "{0:.6f} {1} {2}".format(offset, direction, message)}))
+
+    # =============================================================================
+    def close(self):
+        with self.lock:
+            self.file_handler.close()
@@ -0,0 +1,131 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Touch Portal [tpDispatchBenchmark] © Autolog & DaveL17 2020
+#
+# Standalone tool (not loaded by Indigo) that times the Touch Portal Handler dispatching the action messages of a
+# traffic capture (see tpCapture.py) to their Indigo commands - against a fake 'indigo' module (see tpReplay.py), with
+# the commands run on the handler thread - and reports messages per second and the Indigo commands issued.
+#
+# Usage: python tpDispatchBenchmark.py <capture file> [--baseline folder] [--repeat n] [--plugin-folder folder]
+#   --baseline is the 'Server Plugin' folder of another checkout whose handler is timed too (in its own process) - e.g.
+#     a worktree of the commit before the dispatch tables were added, for the handler which chained if / elif.
+#     The Indigo commands issued by both should be the same.
+#   --repeat is the number of times the action messages are dispatched in each of the three timed rounds (default 5).
+#   --plugin-folder is the 'Server Plugin' folder timed (default the folder of this tool).
+#
+
+# noinspection PyUnresolvedReferences
+# ============================== Native Imports ===============================
+import argparse
+import json
+import logging
+import os
+import subprocess
+import sys
+import threading
+import time
+
+from tpReplay import build_fake_indigo, create_tp_devices, load_capture
+
+DISPATCH_TP_DEVICE_ID = 1  # Indigo device id of the fake Touch Portal Desktop device
+DISPATCH_ROUNDS = 3  # Timed rounds - the fastest is reported
+
+
+# =============================================================================
+def benchmark(arguments):
+    """
+    Time the handler of the plugin folder dispatching the captured action messages.
+
+    -----
+    :param arguments: parsed command line arguments
+    :return: exit code
+    """
+    indigo = build_fake_indigo(0.0)
+    sys.modules["indigo"] = indigo  # Must be installed before the plugin modules are imported
+    sys.path.insert(0, arguments.plugin_folder)  # Ahead of this tool's folder so that the checkout's modules are timed
+
+    import constants
+    from tpHandler import ThreadTpHandler
+    from tpMetrics import TpMetrics
+
+    inbound = [message for offset, direction, message in load_capture(arguments.capture_file) if direction == constants.TP_CAPTURE_INBOUND]
+    actions = [(message, json.loads(message)) for message in inbound if json.loads(message).get("type") == "action"]
+    if not actions:
+        print(u"No action messages found in '{0}'".format(arguments.capture_file))
+        return 1
+
+    tp_devices_json = json.dumps(create_tp_devices(indigo, inbound))
+    tp_device = indigo.FakeIndigoObject(DISPATCH_TP_DEVICE_ID, u"Touch Portal Dispatch")
+    tp_device.pluginProps["tp_devices"] = tp_devices_json
+    indigo.devices[DISPATCH_TP_DEVICE_ID] = tp_device
+
+    tp_globals = {constants.K_SHOW_VARIABLE_VALUE: False, constants.K_METRICS: TpMetrics()}
+    plugin_globals = {
+        constants.K_TP: {DISPATCH_TP_DEVICE_ID: tp_globals},
+        constants.K_DEBUG: {constants.K_SHOW_MESSAGES: False},
+        constants.K_TP_PLUGIN_INFO: {constants.K_TP_PLUGIN_VERSION: 0},
+        constants.K_SOCKETS: {DISPATCH_TP_DEVICE_ID: {}},
+        constants.K_QUEUES: {DISPATCH_TP_DEVICE_ID: {}}
+    }
+
+    # A handler from an earlier checkout looks up fewer globals - only those known to its constants are set
+    if hasattr(constants, "K_DUPLICATE_PRESS_MS"):
+        tp_globals[constants.K_DUPLICATE_PRESS_MS] = 0  # Every round repeats the same presses
+    if hasattr(constants, "K_TP_REGISTRY"):
+        from tpRegistry import TpRegistry
+        tp_globals[constants.K_TP_REGISTRY] = TpRegistry.from_json(tp_devices_json)
+    if hasattr(constants, "K_MONITORED_DEVICES"):
+        plugin_globals[constants.K_TP][constants.K_MONITORED_DEVICES] = {}
+        plugin_globals[constants.K_TP][constants.K_MONITORED_VARIABLES] = {}
+    if hasattr(constants, "K_MONITOR_INDEX"):
+        from tpMonitors import TpMonitorIndex
+        plugin_globals[constants.K_TP][constants.K_MONITOR_INDEX] = TpMonitorIndex()
+    if hasattr(constants, "K_SNAPSHOT_CACHE"):
+        from tpSnapshots import TpSnapshotCache
+        plugin_globals[constants.K_TP][constants.K_SNAPSHOT_CACHE] = TpSnapshotCache()
+
+    handler = ThreadTpHandler(plugin_globals, threading.Event(), DISPATCH_TP_DEVICE_ID)  # Not started - called directly
+
+    dispatched = actions * arguments.repeat
+    fastest_seconds = None
+    for _ in range(DISPATCH_ROUNDS):
+        start_time = time.time()
+        for message, converted_data in dispatched:
+            handler.process_receive_tp_message(tp_device, message, converted_data)
+        seconds = time.time() - start_time
+        fastest_seconds = seconds if fastest_seconds is None else min(fastest_seconds, seconds)
+
+    commands = indigo.FakeIndigoCommands.calls
+    print(u"Dispatched {0} action messages with the handler in '{1}'".format(len(dispatched), arguments.plugin_folder))
+    print(u"  Throughput:           {0:.0f} messages/second (fastest of {1} rounds)".format(
+        len(dispatched) / max(fastest_seconds, 0.000001), DISPATCH_ROUNDS))
+    print(u"  Indigo commands:      {0} per round".format(sum(commands.values()) // DISPATCH_ROUNDS))
+    for command_name, count in sorted(commands.items()):
+        print(u"    {0:<30} {1}".format(command_name, count // DISPATCH_ROUNDS))
+    return 0
+
+
+# =============================================================================
+def main():
+    parser = argparse.ArgumentParser(description="Time the Touch Portal Handler dispatching the action messages of a capture.")
+    parser.add_argument("capture_file", help="capture file written when 'Capture Touch Portal Traffic' is enabled")
+    parser.add_argument("--baseline", default=None, help="'Server Plugin' folder of another checkout to time as well")
+    parser.add_argument("--repeat", type=int, default=5, help="times the action messages are dispatched per round (default 5)")
+    parser.add_argument("--plugin-folder", default=os.path.dirname(os.path.abspath(__file__)), help="'Server Plugin' folder timed")
+    arguments = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING, format="%(name)s %(levelname)s %(message)s")
+
+    if arguments.baseline is not None:
+        # The modules of both checkouts have the same names - so the baseline is timed in a process of its own
+        exit_code = subprocess.call([sys.executable, os.path.abspath(__file__), arguments.capture_file, "--repeat", str(arguments.repeat),
+                                     "--plugin-folder", os.path.abspath(arguments.baseline)])
+        if exit_code != 0:
+            return exit_code
+
+    return benchmark(arguments)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,280 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Touch Portal [tpEngineBenchmark] © Autolog & DaveL17 2020
+#
+# Standalone tool (not loaded by Indigo) that compares the plugin's I/O engines - a TP Reader thread per desktop (T,
+# the original design) and the shared TP Selector thread (S) - by the latency and CPU cost of Touch Portal traffic.
+# Each fake Touch Portal Desktop connection sends list refreshes (listChange messages) one at a time and times each
+# until the plugin's reply (choiceUpdate message) is received. The fake desktops run in a process of their own so that
+# the CPU time reported is only that of the plugin (reader / selector, handler and writer threads). The plugin runs
+# against a fake 'indigo' module (see tpReplay.py).
+#
+# Usage: python tpEngineBenchmark.py [--io-engine T|S|both] [--desktops n] [--messages n] [--verbose]
+#   --io-engine is the plugin's 'I/O Engine' timed - both (default) times T and then S, each in a process of its own.
+#   --desktops is the number of Touch Portal devices (desktops) connected (default 4).
+#   --messages is the number of round trips timed per desktop (default 1000).
+#
+
+# noinspection PyUnresolvedReferences
+# ============================== Native Imports ===============================
+import argparse
+import json
+import logging
+import multiprocessing
+import os
+import socket
+import subprocess
+import sys
+import threading
+import time
+
+from tpReplay import build_fake_indigo
+
+ENGINE_FIRST_TP_DEVICE_ID = 1  # Indigo device ids of the fake Touch Portal devices
+ENGINE_PAIR_TIMEOUT_SECONDS = 30  # Give up waiting for every desktop to be paired after this long
+ENGINE_INFO_MESSAGE = b'{"type":"info","sdkVersion":2,"tpVersionString":"2.3.010","tpVersionCode":203010,"pluginVersion":1}\n'
+ENGINE_LIST_ID = "indigo_device_name_on_off"  # A list refresh the handler answers with a choiceUpdate message
+
+
+# =============================================================================
+def read_messages(connection):
+    """
+    Yield the messages received on a connection (without line terminators) until it is closed.
+
+    -----
+    :param connection: socket
+    :return: generator of messages
+    """
+    received = b""
+    while True:
+        data = connection.recv(4096)
+        if not data:
+            return
+        received += data
+        while b"\n" in received:
+            message, received = received.split(b"\n", 1)
+            yield message
+
+
+# =============================================================================
+def serve_desktop(connection, desktop_number, messages, paired, go, results):
+    """
+    Stand in for one Touch Portal Desktop: answer the pair message, then time the list refresh round trips.
+
+    -----
+    :param connection: accepted socket
+    :param desktop_number: used to make the list instance ids unique
+    :param messages: round trips to time
+    :param paired: threading.Semaphore released once the pair message has been answered
+    :param go: threading.Event set when the round trips are to start
+    :param results: list the round trip latencies (ms) are added to
+    :return:
+    """
+    latencies = []
+    try:
+        incoming = read_messages(connection)
+        for message in incoming:
+            if b'"pair"' in message:
+                connection.sendall(ENGINE_INFO_MESSAGE)
+                break
+        paired.release()
+        go.wait()
+
+        for message_number in range(messages):
+            instance_id = u"{0}-{1}".format(desktop_number, message_number)
+            sent_time = time.time()
+            connection.sendall(json.dumps({"type": "listChange", "listId": ENGINE_LIST_ID, "instanceId": instance_id,
+                                           "actionId": "indigo_device_toggle", "value": "- Refresh Devices -"}) + "\n")
+            for message in incoming:  # State updates sent once paired are skipped
+                if b'"choiceUpdate"' in message and instance_id.encode("utf-8") in message:
+                    latencies.append((time.time() - sent_time) * 1000.0)
+                    break
+    except socket.error:
+        pass
+    results.extend(latencies)
+
+
+# =============================================================================
+def run_desktops(pipe, desktops, messages):
+    """
+    Run the fake Touch Portal Desktops (in a process of their own): send the listening port, report when every desktop
+    has been paired, then time the round trips once told to start and send back the latencies and wall time. The
+    connections are closed once told that the plugin has disconnected.
+
+    -----
+    :param pipe: multiprocessing connection to the benchmark process
+    :param desktops: connections to accept
+    :param messages: round trips per connection
+    :return:
+    """
+    listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    listener.bind(("127.0.0.1", 0))
+    listener.listen(desktops)
+    pipe.send(listener.getsockname()[1])
+
+    paired = threading.Semaphore(0)
+    go = threading.Event()
+    results = []
+    connections = []  # Referenced here so that a connection isn't closed when its thread ends
+    desktop_threads = []
+    for desktop_number in range(desktops):
+        connection, _ = listener.accept()
+        connections.append(connection)
+        connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        desktop_thread = threading.Thread(target=serve_desktop, args=(connection, desktop_number, messages, paired, go, results))
+        desktop_thread.setDaemon(True)
+        desktop_thread.start()
+        desktop_threads.append(desktop_thread)
+    for _ in range(desktops):
+        paired.acquire()
+    pipe.send("paired")
+
+    pipe.recv()  # Start
+    start_time = time.time()
+    go.set()
+    for desktop_thread in desktop_threads:
+        desktop_thread.join()
+    pipe.send((results, time.time() - start_time))
+    pipe.recv()  # The connections are kept open until the plugin has disconnected
+    for connection in connections:
+        connection.close()
+
+
+# =============================================================================
+def percentile(samples, fraction):
+    return samples[min(len(samples) - 1, int(len(samples) * fraction))]
+
+
+# =============================================================================
+def benchmark(arguments):
+    """
+    Time the round trips with the I/O engine and report their latency and the plugin's CPU time.
+
+    -----
+    :param arguments: parsed command line arguments
+    :return: exit code
+    """
+    indigo = build_fake_indigo(0.0)
+    sys.modules["indigo"] = indigo  # Must be installed before the plugin modules are imported
+
+    # The fake desktops are started before any plugin thread so that their process doesn't inherit them
+    pipe, desktops_pipe = multiprocessing.Pipe()
+    desktops_process = multiprocessing.Process(target=run_desktops, args=(desktops_pipe, arguments.desktops, arguments.messages))
+    desktops_process.daemon = True
+    desktops_process.start()
+    port = pipe.recv()
+
+    from constants import (K_COALESCE_COMMANDS, K_DEBUG, K_DESKTOP_STATES, K_DUPLICATE_PRESS_MS, K_HOST,
+                           K_INDIGO_WORKER_COUNT, K_IO_ENGINE, K_LAST_RECEIVED, K_LIVENESS_PROBE_SENT, K_LIVENESS_TIMEOUT,
+                           K_MAX_FRAME_SIZE, K_METRICS, K_MONITOR_INDEX, K_PORT, K_QUEUES, K_QUEUE_CAPACITY,
+                           K_RECEIVE_BUFFER_SIZE, K_RECONNECT_SCHEDULER, K_SELECTOR, K_SHOW_MESSAGES,
+                           K_SHOW_VARIABLE_VALUE, K_SNAPSHOT_CACHE, K_SOCKETS, K_SOCKET_RETRY_SECONDS,
+                           K_SOCKET_RETRY_SILENT_AFTER, K_TCP_KEEPALIVE, K_TCP_NODELAY, K_THREADS, K_TIMEOUT, K_TP,
+                           K_TP_PLUGIN_INFO, K_TP_PLUGIN_VERSION, K_TRACER, TP_DUPLICATE_PRESS_MS_DEFAULT,
+                           TP_INDIGO_WORKERS_DEFAULT, TP_LIVENESS_TIMEOUT_DEFAULT, TP_MAX_FRAME_SIZE_DEFAULT,
+                           TP_QUEUE_CAPACITY_DEFAULT, TP_RECEIVE_BUFFER_SIZE_DEFAULT, TP_SOCKET_RETRY_DEFAULT,
+                           TP_SOCKET_RETRY_SILENT_AFTER_DEFAULT, TP_SOCKET_TIMEOUT_DEFAULT)
+    import plugin
+    from tpMetrics import TpMetrics
+    from tpMonitors import TpMonitorIndex
+    from tpReconnect import TpReconnectScheduler
+    from tpSnapshots import TpSnapshotCache
+    from tpWriter import TpDesktopStates
+
+    # Plugin.__init__ needs an Indigo server - the globals are set up as by Plugin.__init__ and deviceStartComm
+    tp_plugin = plugin.Plugin.__new__(plugin.Plugin)
+    tp_plugin.logger = logging.getLogger("Plugin")
+    tp_plugin.globals = {
+        K_TP: {K_MONITOR_INDEX: TpMonitorIndex(), K_SNAPSHOT_CACHE: TpSnapshotCache()},
+        K_DEBUG: {K_SHOW_MESSAGES: False},
+        K_TP_PLUGIN_INFO: {K_TP_PLUGIN_VERSION: 1},
+        K_RECONNECT_SCHEDULER: TpReconnectScheduler(),
+        K_SELECTOR: {},
+        K_THREADS: {},
+        K_QUEUES: {},
+        K_SOCKETS: {}
+    }
+    tp_devices = []
+    for desktop_number in range(arguments.desktops):
+        dev_id = ENGINE_FIRST_TP_DEVICE_ID + desktop_number
+        tp_device = indigo.FakeIndigoObject(dev_id, u"Touch Portal Engine {0}".format(desktop_number + 1))
+        indigo.devices[dev_id] = tp_device
+        tp_devices.append(tp_device)
+        metrics = TpMetrics()
+        tp_plugin.globals[K_TP][dev_id] = {
+            K_HOST: "127.0.0.1", K_PORT: port, K_TIMEOUT: TP_SOCKET_TIMEOUT_DEFAULT,
+            K_RECEIVE_BUFFER_SIZE: int(TP_RECEIVE_BUFFER_SIZE_DEFAULT), K_MAX_FRAME_SIZE: int(TP_MAX_FRAME_SIZE_DEFAULT),
+            K_QUEUE_CAPACITY: int(TP_QUEUE_CAPACITY_DEFAULT), K_INDIGO_WORKER_COUNT: int(TP_INDIGO_WORKERS_DEFAULT),
+            K_COALESCE_COMMANDS: False, K_DUPLICATE_PRESS_MS: int(TP_DUPLICATE_PRESS_MS_DEFAULT), K_IO_ENGINE: arguments.io_engine,
+            K_TCP_KEEPALIVE: False, K_TCP_NODELAY: True, K_LIVENESS_TIMEOUT: int(TP_LIVENESS_TIMEOUT_DEFAULT),
+            K_LAST_RECEIVED: time.time(), K_LIVENESS_PROBE_SENT: None, K_METRICS: metrics, K_TRACER: None,
+            K_DESKTOP_STATES: TpDesktopStates(metrics), K_SHOW_VARIABLE_VALUE: False,
+            K_SOCKET_RETRY_SECONDS: int(TP_SOCKET_RETRY_DEFAULT), K_SOCKET_RETRY_SILENT_AFTER: int(TP_SOCKET_RETRY_SILENT_AFTER_DEFAULT)}
+        tp_plugin.compile_tp_registry(dev_id, None)
+
+    for tp_device in tp_devices:
+        if not tp_plugin.tp_connect(tp_device):
+            print(u"Connection of '{0}' to the fake Touch Portal Desktop failed".format(tp_device.name))
+            return 1
+    if not pipe.poll(ENGINE_PAIR_TIMEOUT_SECONDS):
+        print(u"Not every desktop was paired within {0} seconds".format(ENGINE_PAIR_TIMEOUT_SECONDS))
+        return 1
+    pipe.recv()
+    time.sleep(0.5)  # Let the state refreshes sent on pairing finish so that only the round trips are measured
+
+    plugin_threads = threading.active_count() - 1  # Less the main thread
+    start_cpu = sum(os.times()[:2])
+    pipe.send("start")
+    latencies, wall_seconds = pipe.recv()
+    cpu_seconds = sum(os.times()[:2]) - start_cpu
+
+    for tp_device in tp_devices:
+        tp_plugin.tp_disconnect(tp_device)
+    pipe.send("disconnected")
+    desktops_process.join(5)
+
+    expected = arguments.desktops * arguments.messages
+    if len(latencies) != expected:
+        print(u"Only {0} of {1} round trips completed".format(len(latencies), expected))
+        return 1
+
+    latencies.sort()
+    print(u"I/O engine '{0}': {1} desktop(s) x {2} round trips, {3} plugin threads".format(
+        arguments.io_engine, arguments.desktops, arguments.messages, plugin_threads))
+    print(u"  Throughput:           {0:.0f} round trips/second".format(len(latencies) / max(wall_seconds, 0.000001)))
+    print(u"  Latency:              {0:.3f} ms average, {1:.3f} ms median, {2:.3f} ms 99th percentile, {3:.3f} ms maximum".format(
+        sum(latencies) / len(latencies), percentile(latencies, 0.5), percentile(latencies, 0.99), latencies[-1]))
+    print(u"  Plugin CPU:           {0:.1f} ms ({1:.1f} us per round trip, {2:.0f}% of one core)".format(
+        cpu_seconds * 1000.0, cpu_seconds * 1000000.0 / len(latencies), cpu_seconds * 100.0 / max(wall_seconds, 0.000001)))
+    return 0
+
+
+# =============================================================================
+def main():
+    parser = argparse.ArgumentParser(description="Compare the latency and CPU cost of the Touch Portal I/O engines.")
+    parser.add_argument("--io-engine", choices=["T", "S", "both"], default="both",
+                        help="T = reader thread per desktop, S = shared selector, both (default) = T and then S")
+    parser.add_argument("--desktops", type=int, default=4, help="Touch Portal devices (desktops) connected (default 4)")
+    parser.add_argument("--messages", type=int, default=1000, help="round trips timed per desktop (default 1000)")
+    parser.add_argument("--verbose", action="store_true", help="show plugin debug logging")
+    arguments = parser.parse_args()
+
+    if arguments.io_engine == "both":
+        # Each engine is timed in a process of its own so that neither inherits the other's threads
+        for io_engine in ("T", "S"):
+            command = [sys.executable, os.path.abspath(__file__), "--io-engine", io_engine,
+                       "--desktops", str(arguments.desktops), "--messages", str(arguments.messages)]
+            exit_code = subprocess.call(command + (["--verbose"] if arguments.verbose else []))
+            if exit_code != 0:
+                return exit_code
+        return 0
+
+    logging.basicConfig(level=logging.DEBUG if arguments.verbose else logging.WARNING, format="%(name)s %(levelname)s %(message)s")
+
+    return benchmark(arguments)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
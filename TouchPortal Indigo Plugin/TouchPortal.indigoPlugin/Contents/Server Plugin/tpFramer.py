@@ -0,0 +1,109 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Touch Portal [tpFramer] © Autolog & DaveL17 2020
+#
+
+# noinspection PyUnresolvedReferences
+# ============================== Native Imports ===============================
+import logging
+
+# ============================== Plugin Imports ===============================
+from constants import *
+
+
+# noinspection PyUnresolvedReferences,PyPep8Naming,PyPep8
+class TpLineFramer(object):
+
+    # This class turns the Touch Portal Desktop byte stream into complete newline terminated messages
+
+    def __init__(self, receive_size=TP_RECEIVE_BUFFER_SIZE_DEFAULT, max_frame_size=TP_MAX_FRAME_SIZE_DEFAULT):
+
+        self.tpf_logger = logging.getLogger("Plugin.TP_FRAMER")
+
+        self.receive_size = int(receive_size)
+        self.max_frame_size = int(max_frame_size)
+
+        self.receive_area = bytearray(self.receive_size)  # Reused for every recv_into - avoids a new string per read
+        self.receive_view = memoryview(self.receive_area)
+        self.buffer = bytearray()  # Holds any partial message carried over to the next read
+        self.scan_start = 0  # Position in buffer from which to resume searching for a newline
+        self.discarding = False  # True whilst skipping the remainder of an oversized message
+
+        self.frames_count = 0
+        self.oversized_count = 0
+
+    # =============================================================================
+    def receive(self, tp_socket):
+        """
+        Read available data from the socket and return the complete messages received.
+
+        -----
+        :param tp_socket: connected Touch Portal socket
+        :return: (bytes read, list of complete messages) - zero bytes read means the connection has closed
+        """
+        bytes_read = tp_socket.recv_into(self.receive_view, self.receive_size)
+        if bytes_read == 0:
+            return 0, []
+        return bytes_read, self.feed(self.receive_view[:bytes_read])
+
+    # =============================================================================
+    def discard_oversized(self):
+        self.oversized_count += 1
+        self.tpf_logger.error(u"Message from Touch Portal Desktop exceeds the maximum size of {0} bytes - message discarded"
+                              .format(self.max_frame_size))
+
+    # =============================================================================
+    def feed(self, data):
+        """
+        Add data to the receive buffer and return the complete messages now available.
+        Any trailing partial message is retained until the rest of it arrives.
+
+        -----
+        :param data: bytes / bytearray / memoryview received from Touch Portal Desktop
+        :return: list of complete messages (str) without their line terminators
+        """
+        frames = []
+        buffer = self.buffer
+        buffer.extend(data)
+
+        start = 0
+        newline = buffer.find(b"\n", self.scan_start)
+        while newline != -1:
+            if self.discarding:
+                self.discarding = False  # End of the oversized message has been reached - resume normal framing
+            else:
+                end = newline
+                if end > start and buffer[end - 1] == 13:  # Strip the carriage return of a '\r\n' terminator
+                    end -= 1
+                if end - start > self.max_frame_size:
+                    self.discard_oversized()  # Arrived complete - rejected just as if it had been split across reads
+                elif end > start:  # Ignore blank lines
+                    frames.append(str(buffer[start:end]))
+            start = newline + 1
+            newline = buffer.find(b"\n", start)
+
+        if self.discarding:
+            del buffer[:]  # Still within the oversized message - nothing to keep
+        elif start > 0:
+            del buffer[:start]  # Drop the consumed messages, keeping only the partial remainder
+
+        if len(buffer) > self.max_frame_size:
+            # Guard against a message that never terminates consuming ever more memory
+            self.discard_oversized()
+            del buffer[:]
+            self.discarding = True
+
+        self.scan_start = len(buffer)  # Only newly received data needs to be searched next time
+        self.frames_count += len(frames)
+
+        return frames
+
+    # =============================================================================
+    def reset(self):
+        """
+        Discard any buffered partial message e.g. on reconnection.
+        """
+        del self.buffer[:]
+        self.scan_start = 0
+        self.discarding = False
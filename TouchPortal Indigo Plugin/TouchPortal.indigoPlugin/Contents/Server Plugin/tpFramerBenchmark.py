@@ -0,0 +1,135 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Touch Portal [tpFramerBenchmark] © Autolog & DaveL17 2020
+#
+# Standalone tool (not loaded by Indigo) that checks the Touch Portal line framer (see tpFramer.py) against fragmented
+# and coalesced byte streams and reports its throughput in frames per second.
+#
+# Usage: python tpFramerBenchmark.py [--messages n] [--max-frame-size n] [--seed n]
+#   --messages is the number of messages framed for each chunk size timed (default 100000).
+#   --max-frame-size is the framer's maximum message size (default 1048576).
+#
+
+# noinspection PyUnresolvedReferences
+# ============================== Native Imports ===============================
+import argparse
+import logging
+import random
+import sys
+import time
+
+from constants import TP_MAX_FRAME_SIZE_DEFAULT, TP_RECEIVE_BUFFER_SIZE_DEFAULT
+from tpFramer import TpLineFramer
+
+FRAMER_MESSAGE = '{{"type":"action","pluginId":"indigo_domotics_001","actionId":"indigo_device_toggle",' \
+                 '"data":[{{"id":"indigo_device_toggle_data","value":"Device {0}"}}]}}'
+FRAMER_CHUNK_SIZES = (0, 4096, 64, 1)  # Bytes per read timed (0 = the whole stream in one read)
+
+
+# =============================================================================
+def feed_chunks(framer, stream, chunk_sizes):
+    """
+    Feed a byte stream to a framer in successive chunks.
+
+    -----
+    :param framer: TpLineFramer
+    :param stream: bytes
+    :param chunk_sizes: callable returning the size of the next chunk
+    :return: list of frames
+    """
+    frames = []
+    position = 0
+    while position < len(stream):
+        chunk_size = max(chunk_sizes(), 1)
+        frames.extend(framer.feed(stream[position:position + chunk_size]))
+        position += chunk_size
+    return frames
+
+
+# =============================================================================
+def check():
+    """
+    Check the frames produced from fragmented and coalesced streams.
+
+    -----
+    :return: number of checks failed
+    """
+    max_frame_size = 100
+    messages = [FRAMER_MESSAGE.format(number)[:90] for number in range(20)]
+    stream = b"".join(message + b"\n" for message in messages)
+    oversized = b"x" * 500
+    checks = [
+        ("coalesced - every message in one read", lambda: feed_chunks(TpLineFramer(max_frame_size=max_frame_size), stream, lambda: len(stream)), messages),
+        ("fragmented - one byte per read", lambda: feed_chunks(TpLineFramer(max_frame_size=max_frame_size), stream, lambda: 1), messages),
+        ("fragmented - random reads", lambda: feed_chunks(TpLineFramer(max_frame_size=max_frame_size), stream, lambda: random.randint(1, 150)), messages),
+        ("'\\r\\n' terminators and blank lines", lambda: TpLineFramer(max_frame_size=max_frame_size).feed(b"a\r\n\nb\r\n\r\nc\n"), [b"a", b"b", b"c"]),
+        ("oversized message in one read", lambda: TpLineFramer(max_frame_size=max_frame_size).feed(b"a\n" + oversized + b"\nb\n"), [b"a", b"b"]),
+        ("oversized message across reads", lambda: feed_chunks(TpLineFramer(max_frame_size=max_frame_size), b"a\n" + oversized + b"\nb\n", lambda: 7), [b"a", b"b"]),
+        ("message of exactly the maximum size", lambda: TpLineFramer(max_frame_size=max_frame_size).feed(b"y" * max_frame_size + b"\n"), [b"y" * max_frame_size])]
+
+    failed = 0
+    for name, frames_function, expected_frames in checks:
+        frames = frames_function()
+        if frames != expected_frames:
+            failed += 1
+            print(u"  FAILED: {0} - {1} frames, expected {2}".format(name, len(frames), len(expected_frames)))
+
+    # Every split point of a pair of messages must give the same frames
+    pair = messages[0] + b"\n" + messages[1] + b"\n"
+    split_failed = 0
+    for split in range(1, len(pair)):
+        framer = TpLineFramer()
+        if framer.feed(pair[:split]) + framer.feed(pair[split:]) != messages[:2]:
+            split_failed += 1
+    if split_failed:
+        failed += 1
+        print(u"  FAILED: {0} of {1} split points".format(split_failed, len(pair) - 1))
+
+    print(u"Checked {0} streams and {1} split points: {2}".format(
+        len(checks), len(pair) - 1, u"all passed" if failed == 0 else u"{0} FAILED".format(failed)))
+    return failed
+
+
+# =============================================================================
+def benchmark(arguments):
+    """
+    Time the framing of a stream of typical Touch Portal messages in reads of each chunk size.
+
+    -----
+    :param arguments: parsed command line arguments
+    :return:
+    """
+    print(u"Framing typical Touch Portal messages of {0} bytes".format(len(FRAMER_MESSAGE.format(0)) + 1))
+    for chunk_size in FRAMER_CHUNK_SIZES:
+        messages = min(arguments.messages, 10000) if chunk_size == 1 else arguments.messages  # A read per byte is slow
+        chunk_stream = b"".join(FRAMER_MESSAGE.format(number % 1000) + b"\n" for number in range(messages))
+        framer = TpLineFramer(TP_RECEIVE_BUFFER_SIZE_DEFAULT, arguments.max_frame_size)
+        read_size = chunk_size if chunk_size > 0 else len(chunk_stream)
+        start_time = time.time()
+        frames_count = len(feed_chunks(framer, chunk_stream, lambda: read_size))
+        seconds = max(time.time() - start_time, 0.000001)
+        print(u"  {0:<16} {1:>12.0f} frames/second ({2} frames)".format(
+            u"whole stream" if chunk_size == 0 else u"{0} byte reads".format(chunk_size), frames_count / seconds, frames_count))
+        if frames_count != messages:
+            print(u"  FAILED: expected {0} frames".format(messages))
+
+
+# =============================================================================
+def main():
+    parser = argparse.ArgumentParser(description="Check and time the Touch Portal line framer.")
+    parser.add_argument("--messages", type=int, default=100000, help="messages framed for each chunk size (default 100000)")
+    parser.add_argument("--max-frame-size", type=int, default=int(TP_MAX_FRAME_SIZE_DEFAULT), help="maximum message size")
+    parser.add_argument("--seed", type=int, default=1, help="random seed of the fragmented reads")
+    arguments = parser.parse_args()
+
+    logging.basicConfig(level=logging.CRITICAL)  # The oversized checks log errors by design
+    random.seed(arguments.seed)
+
+    failed = check()
+    benchmark(arguments)
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
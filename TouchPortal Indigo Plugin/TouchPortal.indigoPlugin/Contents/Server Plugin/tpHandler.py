@@ -6,13 +6,14 @@
 
 # noinspection PyUnresolvedReferences
 # ============================== Native Imports ===============================
+import collections
 import json
 import logging
 import Queue
 import re
-import socket
 import sys
 import threading
+import time
 
 # ============================== Custom Imports ===============================
 try:
@@ -22,6 +23,68 @@ except ImportError:
 
 # ============================== Plugin Imports ===============================
 from constants import *
+from tpMonitors import TP_MONITOR_DEVICE_STATES
+from tpQueue import TpQueueEntry
+
+TP_COLOUR_VALUE_RE = re.compile(r'#[a-fA-F0-9]{8}$')
+
+
+# noinspection PyUnresolvedReferences,PyPep8Naming,PyPep8
+class TpActionParameters(object):
+
+    # This class holds the data values of an action received from Touch Portal Desktop (see TP_ACTION_DATA_PARAMETERS)
+
+    __slots__ = ("device_name", "brightness_value", "brighten_value", "dim_value", "colour_value",
+                 "action_group_name", "variable_name", "variable_value")
+
+    def __init__(self):
+
+        self.device_name = None
+        self.brightness_value = None
+        self.brighten_value = None
+        self.dim_value = None
+        self.colour_value = None
+        self.action_group_name = None
+        self.variable_name = None
+        self.variable_value = None
+
+
+# noinspection PyUnresolvedReferences,PyPep8Naming,PyPep8
+class TpDuplicatePresses(object):
+
+    # This class remembers the toggle actions received within the last few milliseconds (see the device's 'Ignore
+    # Duplicate Presses Within' option) so that an identical toggle - a double tap or a message resent over a poor Wi-Fi
+    # connection - can be dropped before its Indigo command is run. Entries expire in the order they were received, so
+    # only the actions received within the window are held.
+
+    def __init__(self):
+
+        self.received = collections.deque()  # (received time, key) - oldest first
+        self.last_received = {}  # key: time the action was last actioned
+
+    # =============================================================================
+    def is_duplicate(self, key, received_time, window_seconds):
+        """
+        Check whether an action is identical to one actioned within the window - if not, remember it.
+
+        -----
+        :param key: (actionId, data values) of the action
+        :param received_time: time the action was received from the socket
+        :param window_seconds: identical actions received within this many seconds are duplicates
+        :return: True if the action is a duplicate
+        """
+        while self.received and received_time - self.received[0][0] > window_seconds:
+            expired_time, expired_key = self.received.popleft()
+            if self.last_received.get(expired_key) == expired_time:
+                del self.last_received[expired_key]
+
+        last_received_time = self.last_received.get(key)
+        if last_received_time is not None and received_time - last_received_time <= window_seconds:
+            return True  # Not remembered - the window runs from the action that was actioned
+
+        self.last_received[key] = received_time
+        self.received.append((received_time, key))
+        return False
 
 
 # noinspection PyUnresolvedReferences,PyPep8Naming,PyPep8
@@ -38,6 +101,61 @@ class ThreadTpHandler(threading.Thread):
         self.tph_logger = logging.getLogger("Plugin.TP_HANDLER")
         self.tph_logger.debug(u"Debugging Touch Portal Handler Thread")
         self.thread_stop = event
+        self.trace = None  # TpTrace of the action message being processed (whilst tracing)
+        self.tp_registry = None  # TP devices registry (TpRegistry) for the batch being processed - see tp_registry_snapshot
+        self.received_time = None  # Time the message being processed was received from the socket
+        self.duplicate_presses = TpDuplicatePresses()
+
+        # Dispatch tables - message type: handler and actionId: (Indigo command type, target resolver, action handler)
+        self.tp_type_handlers = {
+            "action": self.process_receive_tp_message_action,
+            "info": self.process_receive_tp_message_info,
+            "listChange": self.process_receive_tp_message_list_change,
+            "closePlugin": self.process_receive_tp_message_close_plugin
+        }
+        self.tp_action_handlers = {
+            TP_ENTRY_COMMAND_DEVICE_TURN_ON: (TP_INDIGO_COMMAND_TYPE_DEVICE, self.resolve_tp_action_device, self.tp_action_device_turn_on),
+            TP_ENTRY_COMMAND_DEVICE_TURN_OFF: (TP_INDIGO_COMMAND_TYPE_DEVICE, self.resolve_tp_action_device, self.tp_action_device_turn_off),
+            TP_ENTRY_COMMAND_DEVICE_TOGGLE: (TP_INDIGO_COMMAND_TYPE_DEVICE, self.resolve_tp_action_device, self.tp_action_device_toggle),
+            TP_ENTRY_COMMAND_DEVICE_BRIGHTNESS_SET: (TP_INDIGO_COMMAND_TYPE_DEVICE, self.resolve_tp_action_device, self.tp_action_device_brightness_set),
+            TP_ENTRY_COMMAND_DEVICE_BRIGHTEN: (TP_INDIGO_COMMAND_TYPE_DEVICE, self.resolve_tp_action_device, self.tp_action_device_brighten),
+            TP_ENTRY_COMMAND_DEVICE_DIM: (TP_INDIGO_COMMAND_TYPE_DEVICE, self.resolve_tp_action_device, self.tp_action_device_dim),
+            TP_ENTRY_COMMAND_DEVICE_SET_COLOUR: (TP_INDIGO_COMMAND_TYPE_DEVICE, self.resolve_tp_action_device, self.tp_action_device_colour_set),
+            TP_ENTRY_COMMAND_ACTION_GROUP_RUN: (TP_INDIGO_COMMAND_TYPE_ACTION_GROUP, self.resolve_tp_action_action_group, self.tp_action_action_group_run),
+            TP_ENTRY_COMMAND_VARIABLE_SET_TEXT: (TP_INDIGO_COMMAND_TYPE_VARIABLE, self.resolve_tp_action_variable, self.tp_action_variable_set_text),
+            TP_ENTRY_COMMAND_VARIABLE_SET_TRUE: (TP_INDIGO_COMMAND_TYPE_VARIABLE, self.resolve_tp_action_variable, self.tp_action_variable_set_true),
+            TP_ENTRY_COMMAND_VARIABLE_SET_FALSE: (TP_INDIGO_COMMAND_TYPE_VARIABLE, self.resolve_tp_action_variable, self.tp_action_variable_set_false),
+            TP_ENTRY_COMMAND_VARIABLE_TOGGLE: (TP_INDIGO_COMMAND_TYPE_VARIABLE, self.resolve_tp_action_variable, self.tp_action_variable_toggle)
+        }
+        # actionId: (coalesce key, coalescer) for the actions whose waiting Indigo commands can be merged
+        self.tp_action_coalescers = {
+            TP_ENTRY_COMMAND_DEVICE_BRIGHTNESS_SET: (TP_COALESCE_BRIGHTNESS, self.coalesce_tp_action_latest),
+            TP_ENTRY_COMMAND_DEVICE_BRIGHTEN: (TP_COALESCE_STEP, self.coalesce_tp_action_step),
+            TP_ENTRY_COMMAND_DEVICE_DIM: (TP_COALESCE_STEP, self.coalesce_tp_action_step),
+            TP_ENTRY_COMMAND_DEVICE_SET_COLOUR: (TP_COALESCE_COLOUR, self.coalesce_tp_action_latest)
+        }
+        # listId: (refresh choice, registry capability listed, actionIds the list belongs to)
+        self.tp_list_refreshes = {
+            "indigo_device_name_on_off": ("- Refresh Devices -", TP_REGISTRY_CAPABILITY_DEVICE_ON_OFF, frozenset(
+                (TP_ENTRY_COMMAND_DEVICE_TURN_ON, TP_ENTRY_COMMAND_DEVICE_TURN_OFF, TP_ENTRY_COMMAND_DEVICE_TOGGLE))),
+            "indigo_device_name_brightness": ("- Refresh Devices -", TP_REGISTRY_CAPABILITY_DEVICE_BRIGHTNESS, frozenset(
+                (TP_ENTRY_COMMAND_DEVICE_BRIGHTNESS_SET, TP_ENTRY_COMMAND_DEVICE_BRIGHTEN, TP_ENTRY_COMMAND_DEVICE_DIM))),
+            "indigo_device_name_rgb": ("- Refresh Devices -", TP_REGISTRY_CAPABILITY_DEVICE_RGB, frozenset(
+                (TP_ENTRY_COMMAND_DEVICE_SET_COLOUR,))),
+            "indigo_action_group_name": ("- Refresh Action Groups -", TP_REGISTRY_CAPABILITY_ACTION_GROUP, frozenset(
+                (TP_ENTRY_COMMAND_ACTION_GROUP_RUN,))),
+            "indigo_variable_name_text": ("- Refresh Variables -", TP_REGISTRY_CAPABILITY_VARIABLE_TEXT, frozenset(
+                (TP_ENTRY_COMMAND_VARIABLE_SET_TEXT,))),
+            "indigo_variable_name_true_false": ("- Refresh Variables -", TP_REGISTRY_CAPABILITY_VARIABLE_TRUE_FALSE, frozenset(
+                (TP_ENTRY_COMMAND_VARIABLE_SET_TRUE, TP_ENTRY_COMMAND_VARIABLE_SET_FALSE, TP_ENTRY_COMMAND_VARIABLE_TOGGLE)))
+        }
+
+    # =============================================================================
+    def stop(self):
+        self.thread_stop.set()
+        # Sentinel wakes the blocking queue get immediately - see handle_communication
+        self.globals[K_QUEUES][self.dev_id][K_RECEIVE_FROM_SEND_TO_TP].put(
+            TpQueueEntry(QUEUE_PRIORITY_STOP, CMD_STOP_THREAD, None, []))
 
     # =============================================================================
     def handle_communication(self, dev):
@@ -51,44 +169,71 @@ class ThreadTpHandler(threading.Thread):
         try:
             dev_id = dev.id
             socket_error_message = ""
+            metrics = self.globals[K_TP][dev_id][K_METRICS]
 
             while not self.thread_stop.is_set() and socket_error_message == "":
                 # noinspection PyPep8,PyBroadException
                 try:
-                    tp_queued_entry = self.globals[K_QUEUES][self.dev_id][K_RECEIVE_FROM_SEND_TO_TP].get(True, 3)  # blockings
-
-                    # tpQueuedEntry format:
-                    #   - Priority
-                    #   - Command
-                    #   - Device
-                    #   - Data
-
-                    self.tph_logger.debug(u"DEQUEUED MESSAGE = {0}".format(tp_queued_entry))
-                    tp_queue_priority, tp_queue_sequence, tp_command, tp_command_dev_id, tp_command_package = tp_queued_entry
-
-                    if tp_command_dev_id is not None:
-                        self.tph_logger.debug(u"\nTPHANDLER: '{0}' DEQUEUED COMMAND '{1}'".format(indigo.devices[tp_command_dev_id].name, CMD_TRANSLATION[tp_command]))
-                    else:
-                        self.tph_logger.debug(u"\nTPHANDLER: DEQUEUED COMMAND '{0}'".format(CMD_TRANSLATION[tp_command]))
-
-                    if tp_command == CMD_PROCESS_SEND_TP_MESSAGE:
-                        message_to_send = tp_command_package[0]
-                        self.process_send_tp_message(tp_command_dev_id, message_to_send)  # Process message to send to Touch Portal Desktop App
-                        continue
-                    elif tp_command == CMD_PROCESS_RECEIVED_TP_MESSAGE:
-                        message_received = tp_command_package[0]
-                        self.process_receive_tp_message(dev, message_received)  # Process message received from Touch Portal Desktop App
-                        continue
-                    elif tp_command == CMD_PROCESS_REFRESH_TP_PLUGIN_STATES:
-                        self.process_refresh_tp_states(dev_id)  # Process Refresh TP Plugin States
-                        continue
-                    else:
-                        try:
-                            # Processing for known command not yet added to tpHandler - info message only
-                            self.tph_logger.info(u"TPHandler: '{0}' command cannot be processed - ignored".format(CMD_TRANSLATION[tp_command]))
-                        except StandardError:
-                            # Handle situation where command is completely unknown and no translation exists = error!
-                            self.tph_logger.error(u"TPHandler: '{0}' unknown command cannot be processed".format(tp_command))
+                    # Process every entry that is ready (up to TP_HANDLER_BATCH_MAXIMUM) per wakeup - blocking until
+                    # there is at least one (stop() queues a sentinel)
+                    tp_queued_entries = self.globals[K_QUEUES][self.dev_id][K_RECEIVE_FROM_SEND_TO_TP].get_batch(TP_HANDLER_BATCH_MAXIMUM)
+                    metrics.high_water("handler_batch_high_water", len(tp_queued_entries))
+                    self.tph_logger.debug(u"\nTPHANDLER: '{0}' DEQUEUED {1} ENTRIES".format(dev.name, len(tp_queued_entries)))
+
+                    # Messages sent whilst processing the batch are written together when it has been processed
+                    writer = self.globals[K_THREADS][dev_id][K_THREAD_WRITER][K_THREAD]
+                    writer.cork()
+                    try:
+                        refreshed = False
+                        for tp_queued_entry in tp_queued_entries:
+
+                            # tpQueuedEntry format (TpQueueEntry):
+                            #   - Priority
+                            #   - Sequence
+                            #   - Command
+                            #   - Device
+                            #   - Data
+
+                            self.tph_logger.debug(u"DEQUEUED MESSAGE = {0}".format(tp_queued_entry))
+                            tp_command = tp_queued_entry.command
+                            tp_command_dev_id = tp_queued_entry.dev_id
+                            tp_command_package = tp_queued_entry.package
+                            self.trace = tp_queued_entry.trace
+                            if self.trace is not None:
+                                self.trace.stamp(TP_TRACE_DEQUEUED)
+
+                            if tp_command == CMD_STOP_THREAD:
+                                break  # While loop ends as self.thread_stop is set
+                            elif tp_command == CMD_PROCESS_SEND_TP_MESSAGE:
+                                message_to_send = tp_command_package[0]
+                                self.process_send_tp_message(tp_command_dev_id, message_to_send)  # Process message to send to Touch Portal Desktop App
+                            elif tp_command == CMD_PROCESS_RECEIVED_TP_MESSAGE:
+                                message_received = tp_command_package[0]
+                                if len(tp_command_package) > 1:  # Time message was received from the socket
+                                    self.received_time = tp_command_package[1]
+                                    metrics.observe("receive_latency", (time.time() - self.received_time) * 1000.0)
+                                converted_data = tp_command_package[2] if len(tp_command_package) > 2 else None  # Decoded by tpReader / tpSelector
+                                self.process_receive_tp_message(dev, message_received, converted_data)  # Process message received from Touch Portal Desktop App
+                            elif tp_command == CMD_PROCESS_REFRESH_TP_PLUGIN_STATES:
+                                if refreshed:
+                                    metrics.increment("handler_refreshes_collapsed")  # Already refreshed in this batch
+                                    continue
+                                refreshed = True
+                                # A requested refresh resends every state, even those Touch Portal Desktop should already show
+                                writer.clear_state_cache()
+                                self.process_refresh_tp_states(dev_id)  # Process Refresh TP Plugin States
+                            else:
+                                try:
+                                    # Processing for known command not yet added to tpHandler - info message only
+                                    self.tph_logger.info(u"TPHandler: '{0}' command cannot be processed - ignored".format(CMD_TRANSLATION[tp_command]))
+                                except StandardError:
+                                    # Handle situation where command is completely unknown and no translation exists = error!
+                                    self.tph_logger.error(u"TPHandler: '{0}' unknown command cannot be processed".format(tp_command))
+                    finally:
+                        writer.uncork()
+                        self.trace = None
+                        self.received_time = None
+                        self.tp_registry = None  # Next batch uses the registry current then
 
                 except Queue.Empty:
                     pass
@@ -107,7 +252,53 @@ class ThreadTpHandler(threading.Thread):
         # End of While loop and TP Handler thread will close down
 
     # =============================================================================
-    def process_receive_tp_message(self, dev, dataReceived):
+    def coalesce_tp_action_latest(self, queued_handler, queued_args, tp_action_handler, args):
+        """
+        Merge an absolute brightness / colour set with the same set still waiting for the device - the latest wins.
+
+        -----
+        :return: (action handler, args)
+        """
+        return tp_action_handler, args
+
+    # =============================================================================
+    def coalesce_tp_action_step(self, queued_handler, queued_args, tp_action_handler, args):
+        """
+        Merge a brighten / dim step with the brighten / dim step still waiting for the device.
+        Only valid steps (1 - 100) are merged: they are summed (dim steps are negative) and clamped to 100%.
+
+        -----
+        :return: (action handler, args) or None if the steps can't be merged
+        """
+        step = 0
+        for dev, tp_action, parameters, target in (queued_args, args):
+            if tp_action == TP_ENTRY_COMMAND_DEVICE_BRIGHTEN:
+                tp_step_value = parameters.brighten_value
+            else:
+                tp_step_value = parameters.dim_value
+            try:
+                tp_step_value = int(tp_step_value)
+            except (TypeError, ValueError):
+                return None  # Invalid step - left to be reported when actioned
+            if tp_step_value < 1 or tp_step_value > 100:
+                return None  # Out of range step - left to be rejected when actioned
+            if tp_action == TP_ENTRY_COMMAND_DEVICE_BRIGHTEN:
+                step += tp_step_value
+            else:
+                step -= tp_step_value
+        step = max(-100, min(100, step))
+        if step == 0:
+            return None  # Steps cancel out but the waiting step can't be withdrawn
+
+        parameters = TpActionParameters()
+        if step > 0:
+            parameters.brighten_value = step
+            return self.tp_action_device_brighten, (dev, TP_ENTRY_COMMAND_DEVICE_BRIGHTEN, parameters, target)
+        parameters.dim_value = -step
+        return self.tp_action_device_dim, (dev, TP_ENTRY_COMMAND_DEVICE_DIM, parameters, target)
+
+    # =============================================================================
+    def process_receive_tp_message(self, dev, dataReceived, converted_data=None):
         """
         Process message received from Touch Portal Desktop.
         Process as appropriate: Indigo device/action group/variable command
@@ -115,31 +306,28 @@ class ThreadTpHandler(threading.Thread):
         -----
         :param dev:
         :param dataReceived:
+        :param converted_data: dataReceived already decoded (None = decode here)
         :return:
         """
         try:
 
             self.tph_logger.debug(u"processReceiveTpMessage: {0}".format(dataReceived))
 
-            try:
-                converted_data = json.loads(dataReceived)
-                self.tph_logger.debug(u"Received [Converted Data]: '{0}'".format(converted_data))
-            except ValueError:
-                self.tph_logger.debug(u"Received [JSON Data] could not be decoded: '{0}'".format(dataReceived))
-                return  # Invalid
+            if converted_data is None:
+                try:
+                    converted_data = json.loads(dataReceived)
+                except ValueError:
+                    self.tph_logger.debug(u"Received [JSON Data] could not be decoded: '{0}'".format(dataReceived))
+                    return  # Invalid
+            self.tph_logger.debug(u"Received [Converted Data]: '{0}'".format(converted_data))
 
             tp_type = converted_data["type"]
 
             self.tph_logger.debug("Type '{0}' received from Touch Portal Desktop".format(tp_type))
 
-            if tp_type == "action":
-                self.process_receive_tp_message_action(dev, converted_data)
-            elif tp_type == "info":
-                self.process_receive_tp_message_info(dev, converted_data)
-            elif tp_type == "listChange":
-                self.process_receive_tp_message_list_change(dev, converted_data)
-            elif tp_type == "closePlugin":
-                self.tph_logger.warning("Type '{0}' received from Touch Portal Desktop".format(tp_type))
+            tp_type_handler = self.tp_type_handlers.get(tp_type)
+            if tp_type_handler is not None:
+                tp_type_handler(dev, converted_data)
 
             # Unknown tp_type, so ignore.
 
@@ -162,405 +350,68 @@ class ThreadTpHandler(threading.Thread):
 
             # tp_pluginId = converted_data['pluginId']  # Reserved for future use
 
-            tp_device_name = None
-            tp_brightness_value = None
-            tp_brighten_value = None
-            tp_dim_value = None
-            tp_colour_value = None
-            tp_action_group_name = None
-            tp_variable_name = None
-            tp_variable_value = None
-
-            for data_entry in converted_data["data"]:
-                if data_entry["id"] == "indigo_device_name_on_off":
-                    if "value" in data_entry:
-                        tp_device_name = data_entry["value"]
-                elif data_entry["id"] == "indigo_device_name_brightness":
-                    if "value" in data_entry:
-                        tp_device_name = data_entry["value"]
-                elif data_entry["id"] == "indigo_device_name_rgb":
-                    if "value" in data_entry:
-                        tp_device_name = data_entry["value"]
-                elif data_entry["id"] == "indigo_device_brightness_value":
-                    if "value" in data_entry:
-                        tp_brightness_value = data_entry["value"]
-                elif data_entry["id"] == "indigo_device_brighten_value":
-                    if "value" in data_entry:
-                        tp_brighten_value = data_entry["value"]
-                elif data_entry["id"] == "indigo_device_dim_value":
-                    if "value" in data_entry:
-                        tp_dim_value = data_entry["value"]
-                elif data_entry["id"] == "indigo_device_colour_value":
-                    if "value" in data_entry:
-                        tp_colour_value = data_entry["value"]
-                elif data_entry["id"] == "indigo_action_group_name":
-                    if "value" in data_entry:
-                        tp_action_group_name = data_entry["value"]
-                elif data_entry["id"] == "indigo_variable_name_text":
-                    if "value" in data_entry:
-                        tp_variable_name = data_entry["value"]
-                elif data_entry["id"] == "indigo_variable_name_true_false":
-                    if "value" in data_entry:
-                        tp_variable_name = data_entry["value"]
-                elif data_entry["id"] == "indigo_variable_value":
-                    if "value" in data_entry:
-                        tp_variable_value = data_entry["value"]
-
-            debug_show_messages_from_tp_desktop = self.globals[K_DEBUG][K_SHOW_MESSAGES]
-
-            # Retrieve known TP Devices from Indigo Touch Portal Device
-            tp_devices_pre_json = indigo.devices[dev_id].pluginProps.get("tp_devices", None)
-            self.tph_logger.debug(u"TP DEVICES:\n{0}\n".format(tp_devices_pre_json))
-
-            if tp_devices_pre_json is None:
-                self.tph_logger.warning(u"TP DEVICES MISSING")  # TODO: Needs Enhancing
-                return
-            tp_devices = json.loads(tp_devices_pre_json)
-
             tp_action = converted_data["actionId"]
 
-            if "device_" in tp_action and tp_action in TP_ENTRY_COMMANDS_DEVICE:
-                if tp_device_name is None or tp_device_name == "":
-                    self.tph_logger.error(
-                        "Action '{0}' received from Touch Portal Desktop App with missing Touch Portal Device name".format(TP_ENTRY_TRANSLATION[tp_action]))
-                    return  # Invalid
-
-                # validate request and determine related Indigo Device
-                valid = True  # Assume valid request
-                indigo_device_id = 0  # Only needed to suppress PyCharm 'referenced before assignment' warning
-                tp_device_name_key = tp_device_name.lower()  # Key is lowercase
-                if tp_device_name_key not in tp_devices:
-                    valid = False  # TP Device name missing in stored TP Devices
-                else:
-                    tp_data = tp_devices[tp_device_name_key]
-                    if "dev_id" not in tp_data:
-                        valid = False  # Indigo Device id missing in TP device
-                    else:
-                        try:
-                            indigo_device_id = int(tp_data["dev_id"])
-                            if indigo_device_id not in indigo.devices:
-                                valid = False  # Indigo Device id not known to Indigo
-                        except ValueError:
-                            valid = False  # Indigo Device id stored in TP device is invalid
-                if not valid:
-                    self.tph_logger.error(
-                        "Action '{0}' received from Touch Portal Desktop App for invalid TP Device '{1}'.".format(
-                            TP_ENTRY_TRANSLATION[tp_action], tp_device_name))
-                    return  # Invalid
-
-                indigo_dev = indigo.devices[indigo_device_id]  # This is the Indigo Device upon which the TP action will be performed
-
-                if indigo_dev.name == tp_device_name:
-                    log_message_name = "'{0}'".format(indigo_dev.name)
-                else:
-                    log_message_name = "'{0}' [TP Name '{1}']".format(indigo_dev.name, tp_device_name)
-
-                if tp_action == TP_ENTRY_COMMAND_DEVICE_TURN_ON:
-                    if debug_show_messages_from_tp_desktop:
-                        self.tph_logger.info("Action '{0}' received from Touch Portal Desktop App for Device {1}".format(
-                                             TP_ENTRY_TRANSLATION[tp_action], log_message_name))
-                    indigo.device.turnOn(indigo_device_id)
-
-                elif tp_action == TP_ENTRY_COMMAND_DEVICE_TURN_OFF:
-                    if debug_show_messages_from_tp_desktop:
-                        self.tph_logger.info("Action '{0}' received from Touch Portal Desktop App for Device {1}".format(
-                                             TP_ENTRY_TRANSLATION[tp_action], log_message_name))
-                    indigo.device.turnOff(indigo_device_id)
-
-                elif tp_action == TP_ENTRY_COMMAND_DEVICE_TOGGLE:
-                    if debug_show_messages_from_tp_desktop:
-                        self.tph_logger.info("Action '{0}' received from Touch Portal Desktop App for Device {1}".format(
-                                             TP_ENTRY_TRANSLATION[tp_action], log_message_name))
-                    indigo.device.toggle(indigo_device_id)
-
-                elif tp_action == TP_ENTRY_COMMAND_DEVICE_BRIGHTNESS_SET:
-                    valid = True  # Assume valid request
-                    try:
-                        if tp_brightness_value is None or tp_brightness_value == "":
-                            tp_brightness_value = "?"
-                            valid = False
-                        else:
-                            tp_brightness_value = int(tp_brightness_value)
-                    except ValueError:
-                        valid = False
-                    if valid and tp_brightness_value < 0 or tp_brightness_value > 100:
-                        valid = False
-                    if not valid:
-                        if tp_brightness_value == "?":
-                            self.tph_logger.error(
-                                "Action '{0}' received from Touch Portal Desktop App for Device {1} with no brightness value specified".format(
-                                    TP_ENTRY_TRANSLATION[tp_action], log_message_name))
-                            return  # Invalid
-                        else:
-                            self.tph_logger.error(u"Action '{0}' to {1}% received from Touch Portal Desktop App for Device {2} is invalid - it must be an integer and between 0 and "
-                                                  u"100 (inclusive)".format(TP_ENTRY_TRANSLATION[tp_action], tp_brightness_value, log_message_name))
-                        return  # Invalid
-                    if debug_show_messages_from_tp_desktop:
-                        self.tph_logger.info(
-                            "Action '{0}' to {1}% received from Touch Portal Desktop App for Device {2}".format(
-                                TP_ENTRY_TRANSLATION[tp_action], tp_brightness_value, log_message_name))
-                    indigo.dimmer.setBrightness(indigo_device_id, value=tp_brightness_value)
-
-                elif tp_action == TP_ENTRY_COMMAND_DEVICE_BRIGHTEN:
-                    valid = True  # Assume valid request
-                    try:
-                        if tp_brighten_value is None or tp_brighten_value == "":
-                            tp_brighten_value = "?"
-                            valid = False
-                        else:
-                            tp_brighten_value = int(tp_brighten_value)
-                    except ValueError:
-                        valid = False
-                    if valid and tp_brighten_value < 1 or tp_brighten_value > 100:
-                        valid = False
-                    if not valid:
-                        if tp_brighten_value == "?":
-                            self.tph_logger.error(
-                                "Action '{0}' received from Touch Portal Desktop App for Device {1} with no brighten value specified".format(
-                                    TP_ENTRY_TRANSLATION[tp_action], log_message_name))
-                            return  # Invalid
-                        else:
-                            self.tph_logger.error(u"Action '{0}' by {1}% received from Touch Portal Desktop App for Device '{2}' is invalid - it must be an integer and between 1 and "
-                                                  u"100 (inclusive)".format(TP_ENTRY_TRANSLATION[tp_action], tp_brighten_value, log_message_name))
-                        return  # Invalid
-                    if debug_show_messages_from_tp_desktop:
-                        self.tph_logger.info(
-                            "Action '{0}' by {1}% received from Touch Portal Desktop App for Device {1}".format(
-                                TP_ENTRY_TRANSLATION[tp_action], log_message_name))
-                    indigo.dimmer.brighten(indigo_device_id, by=tp_brighten_value)
-
-                elif tp_action == TP_ENTRY_COMMAND_DEVICE_DIM:
-                    valid = True  # Assume valid request
-                    try:
-                        if tp_dim_value is None or tp_dim_value == "":
-                            tp_dim_value = "?"
-                            valid = False
-                        else:
-                            tp_dim_value = int(tp_dim_value)
-                    except ValueError:
-                        valid = False
-                    if valid and tp_dim_value < 1 or tp_dim_value > 100:
-                        valid = False
-                    if not valid:
-                        if tp_dim_value == "?":
-                            self.tph_logger.error(
-                                "Action '{0}' received from Touch Portal Desktop App for Device {1} with no dim value specified".format(
-                                    TP_ENTRY_TRANSLATION[tp_action], log_message_name))
-                            return  # Invalid
-                        else:
-                            self.tph_logger.error(u"Action '{0}' by {1}% received from Touch Portal Desktop App for Device {2} is invalid - it must be an integer and between 1 and "
-                                                  u"100 (inclusive)".format(TP_ENTRY_TRANSLATION[tp_action], tp_dim_value, log_message_name))
-                        return  # Invalid
-                    if debug_show_messages_from_tp_desktop:
-                        self.tph_logger.info("Action '{0}' by {1}% received from Touch Portal Desktop App for Device {2}".format(
-                            TP_ENTRY_TRANSLATION[tp_action], tp_dim_value, log_message_name))
-                    indigo.dimmer.dim(indigo_device_id, by=tp_dim_value)
-
-                elif tp_action == TP_ENTRY_COMMAND_DEVICE_SET_COLOUR:
-                    if not hasattr(indigo_dev, 'supportsRGB')\
-                            or not hasattr(indigo_dev, 'supportsColor')\
-                            or not indigo_dev.supportsRGB\
-                            or not indigo_dev.supportsColor:  # Check device supports color
-                        self.tph_logger.error("Action '{0}' received from Touch Portal Desktop App for Device {1} which does not support colour - action ignored".format(
-                                TP_ENTRY_TRANSLATION[tp_action], log_message_name))
-                        return  # Invalid
-
-                    valid = True  # Assume valid request
-                    if tp_colour_value is None or tp_colour_value == "":
-                        tp_colour_value = "?"
-                        valid = False
-                    else:
-                        # validate colour string which should be in hex format: '#rrggbbaa' ('aa' is transparency and will be ignored)
-                        rgb_string = re.compile(r'#[a-fA-F0-9]{8}$')
-                        if not bool(rgb_string.match(tp_colour_value)):
-                            valid = False
-                    if not valid:
-                        if tp_colour_value == "?":
-                            self.tph_logger.error(
-                                "Action '{0}' received from Touch Portal Desktop App for Device {1} with no colour value specified".format(
-                                    TP_ENTRY_TRANSLATION[tp_action], log_message_name))
-                            return  # Invalid
-                        else:
-                            self.tph_logger.error(u"Action '{0}' received from Touch Portal Desktop App"
-                                                  u" for Device {1}. '{2}' is invalid"
-                                                  u" - it must be a color hex string format #rrggbbaa"
-                                                  .format(TP_ENTRY_TRANSLATION[tp_action],
-                                                          indigo_dev, indigo_color_value))
-                        return  # Invalid
-                    red_level = int(int(tp_colour_value[1:3], 16) * 100)
-                    green_level = int(int(tp_colour_value[3:5], 16) * 100)
-                    blue_level = int(int(tp_colour_value[5:7], 16) * 100)
-                    if debug_show_messages_from_tp_desktop:
-                        self.tph_logger.info("Action '{0}' received from Touch Portal Desktop App for Device {1}."
-                                             "Set Colour to: Red = {2}, Green = {3}, Blue = {4}"
-                                             .format(TP_ENTRY_TRANSLATION[tp_action], log_message_name,
-                                                     red_level, green_level, blue_level))
-                    indigo.dimmer.setColorLevels(indigo_device_id, red_level, green_level, blue_level)
-
-            elif "action_group_" in tp_action and tp_action in TP_ENTRY_COMMANDS_ACTION_GROUP:
-                if tp_action_group_name is None or tp_action_group_name == "":
-                    self.tph_logger.error("Action '{0}' received from Touch Portal Desktop App"
-                                          " with missing Touch Portal Device name"
-                                          .format(TP_ENTRY_TRANSLATION[tp_action]))
-                    return  # Invalid
-
-                # validate request and determine related Indigo Action Group
-                valid = True  # Assume valid request
-                indigo_action_group_id = 0  # Only needed to suppress PyCharm 'referenced before assignment' warning
-
-                tp_device_name_key = tp_action_group_name.lower()  # Key is lowercase
-                if tp_device_name_key not in tp_devices:
-                    valid = False  # TP Device name missing in stored TP Devices
-                else:
-                    tp_data = tp_devices[tp_device_name_key]
-                    if "action_group_id" not in tp_data:
-                        valid = False  # Indigo Action Group id missing in TP device
-                    else:
-                        try:
-                            indigo_action_group_id = int(tp_data["action_group_id"])
-                            if indigo_action_group_id not in indigo.actionGroups:
-                                valid = False  # Indigo Action Group id not known to Indigo
-                        except ValueError:
-                            valid = False  # Indigo Action Group id stored in TP device is invalid
-                if not valid:
-                    self.tph_logger.error(
-                        "Action '{0}' received from Touch Portal Desktop App for Invalid TP Device '{1}'".format(
-                            TP_ENTRY_TRANSLATION[tp_action], tp_device_name))
-                    return  # Invalid
-
-                action_group_dev = indigo.actionGroups[indigo_action_group_id]  # This is the Indigo Action Group upon which the TP action will be performed
-
-                if action_group_dev.name == tp_variable_name:
-                    log_message_name = "'{0}'".format(action_group_dev.name)
-                else:
-                    log_message_name = "'{0}' [TP Name '{1}']".format(action_group_dev.name, tp_action_group_name)
-
-                if tp_action == TP_ENTRY_COMMAND_ACTION_GROUP_RUN:
-                    if debug_show_messages_from_tp_desktop:
-                        self.tph_logger.info("Action '{0}' received from Touch Portal Desktop App to run Action Group {0}".format(
-                            TP_ENTRY_TRANSLATION[tp_action], log_message_name))
-                    indigo.actionGroup.execute(indigo_action_group_id)
-
-            elif "variable_" in tp_action and tp_action in TP_ENTRY_COMMANDS_VARIABLE:
-                if tp_variable_name is None or tp_variable_name == "":
-                    self.tph_logger.error(
-                        "Action '{0}' received from Touch Portal Desktop App with missing Touch Portal Device name".format(TP_ENTRY_TRANSLATION[tp_action]))
-                    return  # Invalid
-
-                # validate request and determine related Indigo Variable
-                valid_code = 0  # Assume valid request
-                indigo_variable_id = 0  # Only needed to suppress PyCharm 'referenced before assignment' warning
-
-                tp_device_name_key = tp_variable_name.lower()  # Key is lowercase
-                if tp_device_name_key not in tp_devices:
-                    valid_code = 4  # TP Device name missing in stored TP Devices
-
-                else:
-                    tp_data = tp_devices[tp_device_name_key]
-                    if "variable_id" not in tp_data:
-                        valid_code = 8  # Indigo Variable id missing in TP device
-                    else:
-                        try:
-                            indigo_variable_id = int(tp_data["variable_id"])
-                            if indigo_variable_id not in indigo.variables:
-                                valid_code = 12  # Indigo Variable id not known to Indigo
-                        except ValueError:
-                            valid_code = 16  # Indigo Variable id stored in TP device is invalid
-                if valid_code != 0:
-                    error_message = ""
-                    if valid_code == 4:
-                        error_message = (u"No Variable named '{0}'".format(tp_device_name_key))
-                    elif valid_code == 8:
-                        error_message = (u"No Variable id specified for variable '{0}'"
-                                         .format(tp_device_name_key))
-                    elif valid_code == 12 or valid_code == 16:
-                        error_message = (u"Variable '{0}' has invalid id = '{1}'"
-                                         .format(tp_device_name_key, indigo_variable_id))
-                    else:
-                        error_message = u"Unknown error reason!"
-
-                    self.tph_logger.error(
-                        "Action '{0}' received from Touch Portal Desktop App is in error: {1}"
-                        .format(TP_ENTRY_TRANSLATION[tp_action], error_message))
-                    return  # Invalid
-
-                variable_dev = indigo.variables[indigo_variable_id]  # This is the Indigo Variable upon which the TP action will be performed
-
-                if variable_dev.name == tp_variable_name:
-                    log_message_name = "'{0}'".format(variable_dev.name)
-                else:
-                    log_message_name = "'{0}' [TP Name '{1}']".format(variable_dev.name, tp_variable_name)
+            if tp_action not in self.tp_action_handlers:
+                self.tph_logger.error(
+                    "Action '{0}' received from Touch Portal Desktop App not recognised'".format(
+                        tp_action))
+                return  # Invalid
 
-                if variable_dev.readOnly:
-                    self.tph_logger.warning(
-                        "Action '{0}' received from Touch Portal Desktop App to update Read ONLY Variable '{1}'"
-                        " - Update ignored."
-                        .format(TP_ENTRY_TRANSLATION[tp_action], variable_dev.name))
-                    return  # Invalid
+            # An identical toggle received again within the window (a double tap or a resend) is dropped before any
+            # Indigo command - otherwise it would be toggled back. Repeated brighten / dim steps and action groups are
+            # actioned (waiting brighten / dim steps are merged by the Indigo worker pool - see coalesce_tp_action_step)
+            duplicate_press_ms = self.globals[K_TP][dev_id].get(K_DUPLICATE_PRESS_MS, int(TP_DUPLICATE_PRESS_MS_DEFAULT))
+            if duplicate_press_ms > 0 and tp_action in TP_ENTRY_COMMANDS_DUPLICATE_PRESS:
+                duplicate_key = (tp_action, tuple((data_entry.get("id"), data_entry.get("value")) for data_entry in converted_data["data"]))
+                received_time = self.received_time if self.received_time is not None else time.time()
+                if self.duplicate_presses.is_duplicate(duplicate_key, received_time, duplicate_press_ms / 1000.0):
+                    self.globals[K_TP][dev_id][K_METRICS].increment("actions_duplicates_suppressed")
+                    self.tph_logger.debug(u"Duplicate action '{0}' received from Touch Portal Desktop ignored".format(tp_action))
+                    return
+
+            parameters = TpActionParameters()
+            for data_entry in converted_data["data"]:
+                parameter_name = TP_ACTION_DATA_PARAMETERS.get(data_entry["id"])
+                if parameter_name is not None and "value" in data_entry:
+                    setattr(parameters, parameter_name, data_entry["value"])
 
-                if tp_action == TP_ENTRY_COMMAND_VARIABLE_SET_TEXT:
-                    if debug_show_messages_from_tp_desktop:
-                        self.tph_logger.info("Action '{0}' received from Touch Portal Desktop App to set Variable value for {1} to '{2}'"
-                                             .format(TP_ENTRY_TRANSLATION[tp_action],
-                                                     log_message_name, indigo_variable_value))
-                    if self.globals[K_TP][dev_id][K_SHOW_VARIABLE_VALUE]:
-                        self.tph_logger.info("Setting Variable {0} to value '{1}'".format(log_message_name, tp_variable_value))
-                    indigo.variable.updateValue(indigo_variable_id, value=tp_variable_value)
-
-                elif tp_action == TP_ENTRY_COMMAND_VARIABLE_SET_TRUE:
-                    if debug_show_messages_from_tp_desktop:
-                        self.tph_logger.info("Action '{0}' received from Touch Portal Desktop App to set Variable {1} to 'true'".format(
-                                             TP_ENTRY_TRANSLATION[tp_action], log_message_name, indigo_variable_value))
-                    if self.globals[K_TP][dev_id][K_SHOW_VARIABLE_VALUE]:
-                        self.tph_logger.info("Setting Variable {0} to value 'true'".format(log_message_name, tp_variable_value))
-                    indigo.variable.updateValue(indigo_variable_id, value="true")
-
-                elif tp_action == TP_ENTRY_COMMAND_VARIABLE_SET_FALSE:
-                    if debug_show_messages_from_tp_desktop:
-                        self.tph_logger.info("Action '{0}' received from Touch Portal Desktop App to set Variable {1} to FALSE".format(
-                                             TP_ENTRY_TRANSLATION[tp_action], log_message_name, indigo_variable_value))
-                    if self.globals[K_TP][dev_id][K_SHOW_VARIABLE_VALUE]:
-                        self.tph_logger.info("Setting Variable {0} to value 'false'".format(log_message_name, tp_variable_value))
-                    indigo.variable.updateValue(indigo_variable_id, value="false")
-
-                elif tp_action == TP_ENTRY_COMMAND_VARIABLE_TOGGLE:
-                    if debug_show_messages_from_tp_desktop:
-                        if variable_dev.name == tp_variable_name:
-                            self.tph_logger.info("Action '{0}' received from Touch Portal Desktop App"
-                                                 " to Toggle Variable {1}"
-                                                 .format(TP_ENTRY_TRANSLATION[tp_action], log_message_name))
-                        else:
-                            self.tph_logger.info("Action '{0}' received from Touch Portal Desktop App"
-                                                 " to Toggle Variable {1}"
-                                                 .format(TP_ENTRY_TRANSLATION[tp_action], log_message_name))
-
-
-                    variable_value = indigo.variables[indigo_variable_id].value
-                    if variable_value.lower() == "false":
-                        variable_value = "true"
-                    elif variable_value.lower() == "true":
-                        variable_value = "false"
-                    else:
-                        self.tph_logger.error(
-                            "Action '{0}' received from Touch Portal Desktop App to Toggle Indigo Variable {1}"
-                            " which currently has a non-bool value: '{2}'"
-                            .format(TP_ENTRY_TRANSLATION[tp_action], log_message_name, variable_value))
-
-                    if self.globals[K_TP][dev_id][K_SHOW_VARIABLE_VALUE]:
-                        self.tph_logger.info("Setting Variable {0} to value '{1}'"
-                                             .format(log_message_name, variable_value))
-                    indigo.variable.updateValue(indigo_variable_id, value=variable_value)
+            # Retrieve known TP Devices of the Indigo Touch Portal Device
+            tp_registry = self.tp_registry_snapshot(dev_id)
+            if tp_registry is None:
+                self.tph_logger.warning(u"TP DEVICES MISSING")  # TODO: Needs Enhancing
+                return
 
+            indigo_command_type, resolve_target, tp_action_handler = self.tp_action_handlers[tp_action]
+            target = resolve_target(tp_action, parameters, tp_registry)
+            if target is None:
+                return  # Invalid - already reported
+
+            # The Indigo command is run by the worker for the target so that a slow command (e.g. an action group
+            # with delays) doesn't hold up the following button presses
+            indigo_workers = self.globals[K_TP][dev_id].get(K_INDIGO_WORKERS)
+            if indigo_workers is not None:
+                coalesce_key, coalescer = None, None
+                if self.globals[K_TP][dev_id].get(K_COALESCE_COMMANDS, TP_COALESCE_COMMANDS_DEFAULT):
+                    coalesce_key, coalescer = self.tp_action_coalescers.get(tp_action, (None, None))
+                indigo_workers.submit(target[0], indigo_command_type, tp_action_handler, (dev, tp_action, parameters, target),
+                                      coalesce_key, coalescer, self.trace)
             else:
-                self.tph_logger.error(
-                    "Action '{0}' received from Touch Portal Desktop App not recognised'".format(
-                        tp_action))
+                if self.trace is not None:
+                    self.trace.stamp(TP_TRACE_INDIGO_START)
+                tp_action_handler(dev, tp_action, parameters, target)
+                if self.trace is not None:
+                    self.trace.finished(target[0])
 
         except StandardError as standard_error_message:
             self.tph_logger.error(u"StandardError detected in 'processReceiveTpMessageAction'."
                                   " Line '{0}' has error='{1}'"
                                   .format(sys.exc_traceback.tb_lineno, standard_error_message))
 
+    # =============================================================================
+    def process_receive_tp_message_close_plugin(self, dev, converted_data):
+        self.tph_logger.warning("Type '{0}' received from Touch Portal Desktop".format(converted_data["type"]))
+
     # =============================================================================
     def process_receive_tp_message_info(self, dev, converted_data):
         """
@@ -576,6 +427,13 @@ class ThreadTpHandler(threading.Thread):
         try:
             dev_id = dev.id
 
+            # Reply to a liveness probe (see check_tp_liveness in plugin) - record the round trip time only
+            probe_sent = self.globals[K_TP][dev_id].get(K_LIVENESS_PROBE_SENT)
+            if probe_sent is not None:
+                self.globals[K_TP][dev_id][K_LIVENESS_PROBE_SENT] = None
+                self.globals[K_TP][dev_id][K_METRICS].set("round_trip_ms", int(round((time.time() - probe_sent) * 1000.0)))
+                return
+
             #  Message in format: {"tpVersionString": "2.2.000", "tpVersionCode": 202000, "sdkVersion": 2, "type": "info", "pluginVersion": 43}
 
             try:
@@ -625,6 +483,10 @@ class ThreadTpHandler(threading.Thread):
                 pluginProps["version"] = firmware
                 dev.replacePluginPropsOnServer(pluginProps)
 
+            # Now paired - Touch Portal Desktop may have been restarted whilst disconnected, so send the latest value of
+            # every state sent so far and refresh the monitored devices (which adds any of their states not sent yet)
+            self.globals[K_THREADS][dev_id][K_THREAD_WRITER][K_THREAD].paired()
+            self.globals[K_TP][dev_id][K_METRICS].increment("state_snapshots")
             self.process_refresh_tp_states(dev_id)
 
         except StandardError as standard_error_message:
@@ -666,116 +528,23 @@ class ThreadTpHandler(threading.Thread):
             if tp_list_instance_id is None:
                 return
 
-            tp_devices_pre_json = dev.pluginProps.get("tp_devices", None)
-            if tp_devices_pre_json is None:
+            tp_registry = self.tp_registry_snapshot(dev.id)
+            if tp_registry is None:
                 self.tph_logger.warning(u"TP DEVICES MISSING")  # TODO: Needs Enhancing
                 return
-            tp_devices = json.loads(tp_devices_pre_json)
-
-            tp_devices_list = ""
-            if tp_list_id == "indigo_device_name_on_off" and tp_list_change_value == "- Refresh Devices -":
-                if (tp_action_id == TP_ENTRY_COMMAND_DEVICE_TURN_ON or
-                        tp_action_id == TP_ENTRY_COMMAND_DEVICE_TURN_OFF or
-                        tp_action_id == TP_ENTRY_COMMAND_DEVICE_TOGGLE):
-                    tp_devices_supporting_on_off = list()
-                    for tp_name_key, tp_data in tp_devices.iteritems():
-                        if tp_data["mode"] == 'D':
-                            if "supports_on_off_state" in tp_data and bool(tp_data["supports_on_off_state"]):
-                                tp_devices_supporting_on_off.append(tp_data["tp_name"])
-                    if len(tp_devices_supporting_on_off) == 0:
-                        tp_devices_list = '"- No Devices Defined -"'
-                    else:
-                        tp_devices_list = '"- Select Device -"'
-                        for tp_device_supporting_on_off in tp_devices_supporting_on_off:
-                            tp_devices_list += u', "{0}"'.format(tp_device_supporting_on_off)
-                    tp_devices_list += u', "- Refresh Devices -"'
-
-            elif tp_list_id == "indigo_device_name_brightness" and tp_list_change_value == "- Refresh Devices -":
-                if (tp_action_id == TP_ENTRY_COMMAND_DEVICE_BRIGHTNESS_SET or
-                        tp_action_id == TP_ENTRY_COMMAND_DEVICE_BRIGHTEN or
-                        tp_action_id == TP_ENTRY_COMMAND_DEVICE_DIM):
-                    tp_devices_supporting_brightness = list()
-                    for tp_name_key, tp_data in tp_devices.iteritems():
-                        if tp_data["mode"] == 'D':
-                            if "supports_brightness_state" in tp_data and bool(tp_data["supports_brightness_state"]):
-                                tp_devices_supporting_brightness.append(tp_data["tp_name"])
-                    if len(tp_devices_supporting_brightness) == 0:
-                        tp_devices_list = '"- No Devices Defined -"'
-                    else:
-                        tp_devices_list = '"- Select Device -"'
-                        for tp_device_supporting_brightness in tp_devices_supporting_brightness:
-                            tp_devices_list += u', "{0}"'.format(tp_device_supporting_brightness)
-                    tp_devices_list += u', "- Refresh Devices -"'
-
-            elif tp_list_id == "indigo_device_name_rgb" and tp_list_change_value == "- Refresh Devices -":
-                if tp_action_id == TP_ENTRY_COMMAND_DEVICE_SET_COLOUR:
-                    tp_devices_supporting_rgb = list()
-                    for tp_name_key, tp_data in tp_devices.iteritems():
-                        if tp_data["mode"] == 'D':
-                            if "supports_brightness_state" in tp_data and bool(
-                                    tp_data["supports_colourRGB_state"]):
-                                tp_devices_supporting_rgb.append(tp_data["tp_name"])
-                    if len(tp_devices_supporting_rgb) == 0:
-                        tp_devices_list = '"- No Devices Defined -"'
-                    else:
-                        tp_devices_list = '"- Select Device -"'
-                        for tp_device_supporting_rgb in tp_devices_supporting_rgb:
-                            tp_devices_list += u', "{0}"'.format(tp_device_supporting_rgb)
-                    tp_devices_list += u', "- Refresh Devices -"'
-
-            elif tp_list_id == "indigo_action_group_name" and tp_list_change_value == "- Refresh Action Groups -":
-                if tp_action_id == TP_ENTRY_COMMAND_ACTION_GROUP_RUN:
-                    tp_devices_action_group = list()
-                    for tp_name_key, tp_data in tp_devices.iteritems():
-                        if tp_data["mode"] == 'A':
-                            tp_devices_action_group.append(tp_data["tp_name"])
-                    if len(tp_devices_action_group) == 0:
-                        tp_devices_list = '"- No Action Groups Defined -"'
-                    else:
-                        tp_devices_list = '"- Select Action Group -"'
-                        for tp_device_action_group in tp_devices_action_group:
-                            tp_devices_list += u', "{0}"'.format(tp_device_action_group)
-                    tp_devices_list += u', "- Refresh Action Groups -"'
-
-            elif tp_list_id == "indigo_variable_name_text" and tp_list_change_value == "- Refresh Variables -":
-                if tp_action_id == TP_ENTRY_COMMAND_VARIABLE_SET_TEXT:
-                    tp_devices_variable = list()
-                    for tp_name_key, tp_data in tp_devices.iteritems():
-                        if tp_data["mode"] == 'V':
-                            if tp_data["supports_variable_tp_text_state"]:
-                                tp_devices_variable.append(tp_data["tp_name"])
-                    if len(tp_devices_variable) == 0:
-                        tp_devices_list = '"- No Variables Defined -"'
-                    else:
-                        tp_devices_list = '"- Select Variable -"'
-                        for tp_device_variable in tp_devices_variable:
-                            tp_devices_list += u', "{0}"'.format(tp_device_variable)
-                    tp_devices_list += u', "- Refresh Variables -"'
-
-            elif tp_list_id == "indigo_variable_name_true_false" and tp_list_change_value == "- Refresh Variables -":
-                if (tp_action_id == TP_ENTRY_COMMAND_VARIABLE_SET_TRUE
-                        or tp_action_id == TP_ENTRY_COMMAND_VARIABLE_SET_FALSE
-                        or tp_action_id == TP_ENTRY_COMMAND_VARIABLE_TOGGLE):
-                    tp_devices_variable = list()
-                    for tp_name_key, tp_data in tp_devices.iteritems():
-                        if tp_data["mode"] == 'V':
-                            if tp_data["supports_variable_tp_true_false_state"]:
-                                tp_devices_variable.append(tp_data["tp_name"])
-                    if len(tp_devices_variable) == 0:
-                        tp_devices_list = '"- No Variables Defined -"'
-                    else:
-                        tp_devices_list = '"- Select Variable -"'
-                        for tp_device_variable in tp_devices_variable:
-                            tp_devices_list += u', "{0}"'.format(tp_device_variable)
-                    tp_devices_list += u', "- Refresh Variables -"'
 
-            else:
+            # Only the refresh choice at the end of each list is processed
+            list_refresh = self.tp_list_refreshes.get(tp_list_id)
+            if list_refresh is None or tp_list_change_value != list_refresh[0]:
                 return  # Ignore as not a Refresh
+            _, capability, tp_action_ids = list_refresh
+            tp_devices_list = tp_registry.choices[capability] if tp_action_id in tp_action_ids else "[]"  # No choices for other actions
 
             self.tph_logger.debug(
                 u"TP NEW CHOICES: Converted Data [{0}] = '{1}'".format(type(tp_devices_list), tp_devices_list))
 
-            tp_message = '{{"type": "choiceUpdate", "id": "{0}", "instanceId": "{1}", "value" : [{2}]}}'.format(tp_list_id, tp_list_instance_id, tp_devices_list)
+            tp_message = u'{{"type": "choiceUpdate", "id": {0}, "instanceId": {1}, "value": {2}}}'.format(
+                json.dumps(tp_list_id), json.dumps(tp_list_instance_id), tp_devices_list)
 
             # self.globals[K_QUEUES][dev_id][K_SEND_TO_TP].put([QUEUE_PRIORITY_HIGH, 0, CMD_PROCESS_SEND_TP_MESSAGE, dev_id, [tp_message]])
 
@@ -791,59 +560,37 @@ class ThreadTpHandler(threading.Thread):
     # =============================================================================
     def process_refresh_tp_states(self, dev_id):
         """
-        TODO: Complete this documentation!
+        Send the states of every monitored device to Touch Portal Desktop.
+        The updates are sent in the bulk lane so that they don't hold up interactive messages (see ThreadTpWriter).
 
         -----
-        :param:
+        :param dev_id: Indigo Touch Portal device id (None = all Touch Portal devices)
         :return:
         """
 
         try:
-            for monitor_dev_id, monitor_list in self.globals[K_TP][K_MONITORED_DEVICES].iteritems():
-                monitored_dev = indigo.devices[monitor_dev_id]
+            monitor_index = self.globals[K_TP][K_MONITOR_INDEX]
+            if dev_id is None:
+                monitored_devices = [(monitor_dev_id, monitor_list) for monitor_dev_id, monitors in monitor_index.devices.iteritems()
+                                     for monitor_list in monitors]
+            else:
+                monitored_devices = monitor_index.desktop_devices.get(dev_id, {}).items()  # Only this Touch Portal device's
+
+            snapshot_cache = self.globals[K_TP][K_SNAPSHOT_CACHE]
+            for monitor_dev_id, monitor_list in monitored_devices:
+                monitored_dev = snapshot_cache.get(TP_SNAPSHOT_DEVICES, monitor_dev_id)
+                if monitored_dev is None:
+                    continue  # Deleted from Indigo
                 tp_desktop_device_id = monitor_list[TP_MONITOR_TP_DESKTOP_DEV_ID]
-                if dev_id is None or dev_id == tp_desktop_device_id:
-                    # tp_state_id = monitor_list[TP_MONITOR_TP_STATE_ID]  # TODO: Remove this line once confirmed as OK
-                    monitor_on_off = monitor_list[TP_MONITOR_ON_OFF]
-                    monitor_brightness = monitor_list[TP_MONITOR_BRIGHTNESS]
-                    monitor_rgb = monitor_list[TP_MONITOR_RGB]
-
-                    if monitor_on_off:
-                        self.tph_logger.debug(
-                            u"K_MONITORED_DEVICE [ON_OFF]:\n{0}\n".format(self.globals[K_TP][K_MONITORED_DEVICES]))
-                        new_state_value = "OFF"
-                        if monitored_dev.onState:
-                            new_state_value = "ON"
-                        tp_state_id = u"indigo_device_{0}_on_off".format(monitor_dev_id)
-                        tp_message = '{{"type": "stateUpdate", "id": "{0}", "value" : "{1}"}}'.format(
-                            tp_state_id, new_state_value)
-
-                        self.process_send_tp_message(tp_desktop_device_id, tp_message)
-
-                    if monitor_brightness:
-                        self.tph_logger.debug(
-                            u"K_MONITORED_DEVICE [BRIGHTNESS]:\n{0}\n".format(self.globals[K_TP][K_MONITORED_DEVICES]))
-                        new_state_value = monitored_dev.brightness
-                        tp_state_id = u"indigo_device_{0}_brightness".format(monitor_dev_id)
-                        tp_message = '{{"type": "stateUpdate", "id": "{0}", "value" : "{1}"}}'.format(
-                            tp_state_id, new_state_value)
-
-                        self.process_send_tp_message(tp_desktop_device_id, tp_message)
-
-                    if monitor_rgb:
-                        self.tph_logger.debug(
-                            u"K_MONITORED_DEVICE [COLOUR RGB]:\n{0}\n".format(self.globals[K_TP][K_MONITORED_DEVICES]))
-                        red_level = int((monitored_dev.redLevel * 255.0) / 100.0)
-                        green_level = int((monitored_dev.greenLevel * 255.0) / 100.0)
-                        blue_level = int((monitored_dev.blueLevel * 255.0) / 100.0)
-                        new_state_value = ('#FF%02x%02x%02x' % (red_level, green_level, blue_level)).upper()
-                        tp_state_id = u"indigo_device_{0}_colour_rgb".format(monitor_dev_id)
-                        tp_message = '{{"type": "stateUpdate", "id": "{0}", "value" : "{1}"}}'.format(
-                            tp_state_id, new_state_value)
-
-                        self.process_send_tp_message(tp_desktop_device_id, tp_message)
-
-                    # TODO: Add in Refresh of variable state (Text  and True / False)
+                self.tph_logger.debug(u"MONITORED DEVICE: {0}".format(monitor_list))
+
+                # The same states (and values) as sent by deviceUpdated when the device changes
+                for monitor_flag, tp_state_id, _, tp_value in TP_MONITOR_DEVICE_STATES:
+                    if monitor_list[monitor_flag]:
+                        self.process_send_tp_state_update(tp_desktop_device_id, tp_state_id.format(monitor_dev_id),
+                                                          tp_value(monitored_dev), TP_OUTBOUND_LANE_BULK)
+
+                # TODO: Add in Refresh of variable state (Text  and True / False)
 
         except StandardError as standard_error_message:
             self.tph_logger.error(u"StandardError detected in Touch Portal Plugin [deviceUpdated] for device '???']. Line '{0}' has error='{1}'".format(
@@ -853,6 +600,7 @@ class ThreadTpHandler(threading.Thread):
     def process_send_tp_message(self, dev_id, message_to_send):
         """
         Process message to send to Touch Portal Desktop.
+        The message is queued for the TP Writer thread which owns the write side of the socket.
 
         -----
         :param dev_id:
@@ -860,26 +608,190 @@ class ThreadTpHandler(threading.Thread):
         :return:
         """
         try:
-            reformatted_message = b"{0}\n".format(message_to_send)
+            self.globals[K_THREADS][dev_id][K_THREAD_WRITER][K_THREAD].send(message_to_send)
 
-            try:
-                self.globals[K_SOCKETS][dev_id][K_TP_SOCKET].sendall(reformatted_message)
-            except socket.error as socket_error_info:
-                if socket_error_info.errno == 32:  # Broken Pipe
-                    self.tph_logger.debug(
-                        u"Socket error detected when sending message to Touch Portal Desktop: Is it running?")
-                    self.tph_logger.debug(
-                        u"Unable to send message '{0}' to Touch Portal Desktop.".format(message_to_send))
-                else:
-                    self.tph_logger.error(
-                        u"Socket Error detected in 'process_send_tp_message'. Line '{0}' has error='{1}'.".format(
-                            sys.exc_traceback.tb_lineno, socket_error_info))
-
-            self.tph_logger.debug(u"process_send_tp_message: {0}".format(reformatted_message))
+            self.tph_logger.debug(u"process_send_tp_message: {0}".format(message_to_send))
 
         except StandardError as standard_error_message:
             self.tph_logger.error(u"StandardError detected in 'process_send_tp_message'. Line '{0}' has error='{1}'".format(sys.exc_traceback.tb_lineno, standard_error_message))
 
+    # =============================================================================
+    def process_send_tp_state_update(self, dev_id, tp_state_id, tp_state_value, lane=TP_OUTBOUND_LANE_INTERACTIVE):
+        """
+        Process a state update to send to Touch Portal Desktop.
+        The update is not sent if Touch Portal Desktop was last sent the same value (see ThreadTpWriter.send_state_update).
+
+        -----
+        :param dev_id:
+        :param tp_state_id:
+        :param tp_state_value:
+        :param lane: TP_OUTBOUND_LANE_INTERACTIVE or TP_OUTBOUND_LANE_BULK (refresh of every state)
+        :return:
+        """
+        try:
+            if self.globals[K_THREADS][dev_id][K_THREAD_WRITER][K_THREAD].send_state_update(tp_state_id, tp_state_value, lane):
+                self.tph_logger.debug(u"process_send_tp_state_update: '{0}' = {1}".format(tp_state_id, tp_state_value))
+
+        except StandardError as standard_error_message:
+            self.tph_logger.error(u"StandardError detected in 'process_send_tp_state_update'. Line '{0}' has error='{1}'".format(sys.exc_traceback.tb_lineno, standard_error_message))
+
+    # =============================================================================
+    def resolve_tp_action_action_group(self, tp_action, parameters, tp_registry):
+        """
+        Validate an Action Group action received from Touch Portal Desktop and determine the related Indigo Action Group.
+
+        -----
+        :param tp_action:
+        :param parameters: TpActionParameters
+        :param tp_registry: known TP Devices (TpRegistry)
+        :return: (Indigo Action Group id, Indigo Action Group snapshot (TpSnapshot), log message name) or None if invalid
+        """
+        tp_action_group_name = parameters.action_group_name
+        if tp_action_group_name is None or tp_action_group_name == "":
+            self.tph_logger.error("Action '{0}' received from Touch Portal Desktop App"
+                                  " with missing Touch Portal Device name"
+                                  .format(TP_ENTRY_TRANSLATION[tp_action]))
+            return None  # Invalid
+
+        # validate request and determine related Indigo Action Group
+        valid = True  # Assume valid request
+        indigo_action_group_id = 0  # Only needed to suppress PyCharm 'referenced before assignment' warning
+        action_group_dev = None  # This will be the Indigo Action Group upon which the TP action will be performed
+
+        tp_item = tp_registry.get(tp_action_group_name)
+        if tp_item is None:
+            valid = False  # TP Device name missing in stored TP Devices
+        elif tp_item.mode != TP_REGISTRY_MODE_ACTION_GROUP or tp_item.indigo_id is None:
+            valid = False  # Indigo Action Group id missing in TP device
+        else:
+            indigo_action_group_id = tp_item.indigo_id
+            action_group_dev = self.globals[K_TP][K_SNAPSHOT_CACHE].get(TP_SNAPSHOT_ACTION_GROUPS, indigo_action_group_id)
+            if action_group_dev is None:
+                valid = False  # Indigo Action Group id not known to Indigo (or stored id invalid)
+        if not valid:
+            self.tph_logger.error(
+                "Action '{0}' received from Touch Portal Desktop App for Invalid TP Device '{1}'".format(
+                    TP_ENTRY_TRANSLATION[tp_action], tp_action_group_name))
+            return None  # Invalid
+
+        if action_group_dev.name == tp_action_group_name:
+            log_message_name = "'{0}'".format(action_group_dev.name)
+        else:
+            log_message_name = "'{0}' [TP Name '{1}']".format(action_group_dev.name, tp_action_group_name)
+
+        return indigo_action_group_id, action_group_dev, log_message_name
+
+    # =============================================================================
+    def resolve_tp_action_device(self, tp_action, parameters, tp_registry):
+        """
+        Validate a Device action received from Touch Portal Desktop and determine the related Indigo Device.
+
+        -----
+        :param tp_action:
+        :param parameters: TpActionParameters
+        :param tp_registry: known TP Devices (TpRegistry)
+        :return: (Indigo Device id, Indigo Device snapshot (TpSnapshot), log message name) or None if invalid
+        """
+        tp_device_name = parameters.device_name
+        if tp_device_name is None or tp_device_name == "":
+            self.tph_logger.error(
+                "Action '{0}' received from Touch Portal Desktop App with missing Touch Portal Device name".format(TP_ENTRY_TRANSLATION[tp_action]))
+            return None  # Invalid
+
+        # validate request and determine related Indigo Device
+        valid = True  # Assume valid request
+        indigo_device_id = 0  # Only needed to suppress PyCharm 'referenced before assignment' warning
+        indigo_dev = None  # This will be the Indigo Device upon which the TP action will be performed
+        tp_item = tp_registry.get(tp_device_name)
+        if tp_item is None:
+            valid = False  # TP Device name missing in stored TP Devices
+        elif tp_item.mode != TP_REGISTRY_MODE_DEVICE or tp_item.indigo_id is None:
+            valid = False  # Indigo Device id missing in TP device
+        else:
+            indigo_device_id = tp_item.indigo_id
+            indigo_dev = self.globals[K_TP][K_SNAPSHOT_CACHE].get(TP_SNAPSHOT_DEVICES, indigo_device_id)
+            if indigo_dev is None:
+                valid = False  # Indigo Device id not known to Indigo (or stored id invalid)
+        if not valid:
+            self.tph_logger.error(
+                "Action '{0}' received from Touch Portal Desktop App for invalid TP Device '{1}'.".format(
+                    TP_ENTRY_TRANSLATION[tp_action], tp_device_name))
+            return None  # Invalid
+
+        if indigo_dev.name == tp_device_name:
+            log_message_name = "'{0}'".format(indigo_dev.name)
+        else:
+            log_message_name = "'{0}' [TP Name '{1}']".format(indigo_dev.name, tp_device_name)
+
+        return indigo_device_id, indigo_dev, log_message_name
+
+    # =============================================================================
+    def resolve_tp_action_variable(self, tp_action, parameters, tp_registry):
+        """
+        Validate a Variable action received from Touch Portal Desktop and determine the related Indigo Variable.
+
+        -----
+        :param tp_action:
+        :param parameters: TpActionParameters
+        :param tp_registry: known TP Devices (TpRegistry)
+        :return: (Indigo Variable id, Indigo Variable snapshot (TpSnapshot), log message name) or None if invalid
+        """
+        tp_variable_name = parameters.variable_name
+        if tp_variable_name is None or tp_variable_name == "":
+            self.tph_logger.error(
+                "Action '{0}' received from Touch Portal Desktop App with missing Touch Portal Device name".format(TP_ENTRY_TRANSLATION[tp_action]))
+            return None  # Invalid
+
+        # validate request and determine related Indigo Variable
+        valid_code = 0  # Assume valid request
+        indigo_variable_id = 0  # Only needed to suppress PyCharm 'referenced before assignment' warning
+        variable_dev = None  # This will be the Indigo Variable upon which the TP action will be performed
+
+        tp_device_name_key = tp_variable_name.lower()  # Key is lowercase
+        tp_item = tp_registry.get(tp_variable_name)
+        if tp_item is None:
+            valid_code = 4  # TP Device name missing in stored TP Devices
+
+        elif tp_item.mode != TP_REGISTRY_MODE_VARIABLE or tp_item.indigo_id is None:
+            valid_code = 8  # Indigo Variable id missing in TP device
+        elif tp_item.indigo_id == 0:
+            valid_code = 16  # Indigo Variable id stored in TP device is invalid
+        else:
+            indigo_variable_id = tp_item.indigo_id
+            variable_dev = self.globals[K_TP][K_SNAPSHOT_CACHE].get(TP_SNAPSHOT_VARIABLES, indigo_variable_id)
+            if variable_dev is None:
+                valid_code = 12  # Indigo Variable id not known to Indigo
+        if valid_code != 0:
+            if valid_code == 4:
+                error_message = (u"No Variable named '{0}'".format(tp_device_name_key))
+            elif valid_code == 8:
+                error_message = (u"No Variable id specified for variable '{0}'"
+                                 .format(tp_device_name_key))
+            elif valid_code == 12 or valid_code == 16:
+                error_message = (u"Variable '{0}' has invalid id = '{1}'"
+                                 .format(tp_device_name_key, indigo_variable_id))
+            else:
+                error_message = u"Unknown error reason!"
+
+            self.tph_logger.error(
+                "Action '{0}' received from Touch Portal Desktop App is in error: {1}"
+                .format(TP_ENTRY_TRANSLATION[tp_action], error_message))
+            return None  # Invalid
+
+        if variable_dev.name == tp_variable_name:
+            log_message_name = "'{0}'".format(variable_dev.name)
+        else:
+            log_message_name = "'{0}' [TP Name '{1}']".format(variable_dev.name, tp_variable_name)
+
+        if variable_dev.readOnly:
+            self.tph_logger.warning(
+                "Action '{0}' received from Touch Portal Desktop App to update Read ONLY Variable '{1}'"
+                " - Update ignored."
+                .format(TP_ENTRY_TRANSLATION[tp_action], variable_dev.name))
+            return None  # Invalid
+
+        return indigo_variable_id, variable_dev, log_message_name
+
     # =============================================================================
     def run(self):
         """
@@ -891,7 +803,7 @@ class ThreadTpHandler(threading.Thread):
             dev_id = self.dev_id
             dev = indigo.devices[dev_id]
 
-            self.globals[K_QUEUES][dev_id][K_RECEIVE_FROM_SEND_TO_TP].put([QUEUE_PRIORITY_HIGH, 0, CMD_PROCESS_SEND_TP_MESSAGE, dev_id, ['{"type":"pair", "id":"indigo_domotics_001"}']])
+            # The pair message is queued by the TP Reader / Selector thread once it has connected
 
             self.tph_logger.debug(u"Touch Portal Handler Thread initialised")
 
@@ -901,3 +813,234 @@ class ThreadTpHandler(threading.Thread):
             self.tph_logger.error(u"StandardError detected in TP Handler Thread. Line '{0}' has error='{1}'".format(sys.exc_traceback.tb_lineno, standard_error_message))
 
         self.tph_logger.debug(u"Touch Portal Handler Thread Ended")
+
+    # =============================================================================
+    def tp_action_action_group_run(self, dev, tp_action, parameters, target):
+        indigo_action_group_id, action_group_dev, log_message_name = target
+        if self.globals[K_DEBUG][K_SHOW_MESSAGES]:
+            self.tph_logger.info("Action '{0}' received from Touch Portal Desktop App to run Action Group {1}".format(
+                TP_ENTRY_TRANSLATION[tp_action], log_message_name))
+        indigo.actionGroup.execute(indigo_action_group_id)
+
+    # =============================================================================
+    def tp_action_device_brighten(self, dev, tp_action, parameters, target):
+        indigo_device_id, indigo_dev, log_message_name = target
+        tp_brighten_value = parameters.brighten_value
+        valid = True  # Assume valid request
+        try:
+            if tp_brighten_value is None or tp_brighten_value == "":
+                tp_brighten_value = "?"
+                valid = False
+            else:
+                tp_brighten_value = int(tp_brighten_value)
+        except ValueError:
+            valid = False
+        if valid and tp_brighten_value < 1 or tp_brighten_value > 100:
+            valid = False
+        if not valid:
+            if tp_brighten_value == "?":
+                self.tph_logger.error(
+                    "Action '{0}' received from Touch Portal Desktop App for Device {1} with no brighten value specified".format(
+                        TP_ENTRY_TRANSLATION[tp_action], log_message_name))
+            else:
+                self.tph_logger.error(u"Action '{0}' by {1}% received from Touch Portal Desktop App for Device {2} is invalid - it must be an integer and between 1 and "
+                                      u"100 (inclusive)".format(TP_ENTRY_TRANSLATION[tp_action], tp_brighten_value, log_message_name))
+            return  # Invalid
+        if self.globals[K_DEBUG][K_SHOW_MESSAGES]:
+            self.tph_logger.info(
+                "Action '{0}' by {1}% received from Touch Portal Desktop App for Device {2}".format(
+                    TP_ENTRY_TRANSLATION[tp_action], tp_brighten_value, log_message_name))
+        indigo.dimmer.brighten(indigo_device_id, by=tp_brighten_value)
+
+    # =============================================================================
+    def tp_action_device_brightness_set(self, dev, tp_action, parameters, target):
+        indigo_device_id, indigo_dev, log_message_name = target
+        tp_brightness_value = parameters.brightness_value
+        valid = True  # Assume valid request
+        try:
+            if tp_brightness_value is None or tp_brightness_value == "":
+                tp_brightness_value = "?"
+                valid = False
+            else:
+                tp_brightness_value = int(tp_brightness_value)
+        except ValueError:
+            valid = False
+        if valid and tp_brightness_value < 0 or tp_brightness_value > 100:
+            valid = False
+        if not valid:
+            if tp_brightness_value == "?":
+                self.tph_logger.error(
+                    "Action '{0}' received from Touch Portal Desktop App for Device {1} with no brightness value specified".format(
+                        TP_ENTRY_TRANSLATION[tp_action], log_message_name))
+            else:
+                self.tph_logger.error(u"Action '{0}' to {1}% received from Touch Portal Desktop App for Device {2} is invalid - it must be an integer and between 0 and "
+                                      u"100 (inclusive)".format(TP_ENTRY_TRANSLATION[tp_action], tp_brightness_value, log_message_name))
+            return  # Invalid
+        if self.globals[K_DEBUG][K_SHOW_MESSAGES]:
+            self.tph_logger.info(
+                "Action '{0}' to {1}% received from Touch Portal Desktop App for Device {2}".format(
+                    TP_ENTRY_TRANSLATION[tp_action], tp_brightness_value, log_message_name))
+        indigo.dimmer.setBrightness(indigo_device_id, value=tp_brightness_value)
+
+    # =============================================================================
+    def tp_action_device_colour_set(self, dev, tp_action, parameters, target):
+        indigo_device_id, indigo_dev, log_message_name = target
+        if not indigo_dev.supportsRGB or not indigo_dev.supportsColor:  # Check device supports color (None = not a colour device)
+            self.tph_logger.error("Action '{0}' received from Touch Portal Desktop App for Device {1} which does not support colour - action ignored".format(
+                    TP_ENTRY_TRANSLATION[tp_action], log_message_name))
+            return  # Invalid
+
+        tp_colour_value = parameters.colour_value
+        valid = True  # Assume valid request
+        if tp_colour_value is None or tp_colour_value == "":
+            tp_colour_value = "?"
+            valid = False
+        else:
+            # validate colour string which should be in hex format: '#rrggbbaa' ('aa' is transparency and will be ignored)
+            if not bool(TP_COLOUR_VALUE_RE.match(tp_colour_value)):
+                valid = False
+        if not valid:
+            if tp_colour_value == "?":
+                self.tph_logger.error(
+                    "Action '{0}' received from Touch Portal Desktop App for Device {1} with no colour value specified".format(
+                        TP_ENTRY_TRANSLATION[tp_action], log_message_name))
+            else:
+                self.tph_logger.error(u"Action '{0}' received from Touch Portal Desktop App"
+                                      u" for Device {1}. '{2}' is invalid"
+                                      u" - it must be a color hex string format #rrggbbaa"
+                                      .format(TP_ENTRY_TRANSLATION[tp_action],
+                                              log_message_name, tp_colour_value))
+            return  # Invalid
+        red_level = int(int(tp_colour_value[1:3], 16) * 100)
+        green_level = int(int(tp_colour_value[3:5], 16) * 100)
+        blue_level = int(int(tp_colour_value[5:7], 16) * 100)
+        if self.globals[K_DEBUG][K_SHOW_MESSAGES]:
+            self.tph_logger.info("Action '{0}' received from Touch Portal Desktop App for Device {1}."
+                                 "Set Colour to: Red = {2}, Green = {3}, Blue = {4}"
+                                 .format(TP_ENTRY_TRANSLATION[tp_action], log_message_name,
+                                         red_level, green_level, blue_level))
+        indigo.dimmer.setColorLevels(indigo_device_id, red_level, green_level, blue_level)
+
+    # =============================================================================
+    def tp_action_device_dim(self, dev, tp_action, parameters, target):
+        indigo_device_id, indigo_dev, log_message_name = target
+        tp_dim_value = parameters.dim_value
+        valid = True  # Assume valid request
+        try:
+            if tp_dim_value is None or tp_dim_value == "":
+                tp_dim_value = "?"
+                valid = False
+            else:
+                tp_dim_value = int(tp_dim_value)
+        except ValueError:
+            valid = False
+        if valid and tp_dim_value < 1 or tp_dim_value > 100:
+            valid = False
+        if not valid:
+            if tp_dim_value == "?":
+                self.tph_logger.error(
+                    "Action '{0}' received from Touch Portal Desktop App for Device {1} with no dim value specified".format(
+                        TP_ENTRY_TRANSLATION[tp_action], log_message_name))
+            else:
+                self.tph_logger.error(u"Action '{0}' by {1}% received from Touch Portal Desktop App for Device {2} is invalid - it must be an integer and between 1 and "
+                                      u"100 (inclusive)".format(TP_ENTRY_TRANSLATION[tp_action], tp_dim_value, log_message_name))
+            return  # Invalid
+        if self.globals[K_DEBUG][K_SHOW_MESSAGES]:
+            self.tph_logger.info("Action '{0}' by {1}% received from Touch Portal Desktop App for Device {2}".format(
+                TP_ENTRY_TRANSLATION[tp_action], tp_dim_value, log_message_name))
+        indigo.dimmer.dim(indigo_device_id, by=tp_dim_value)
+
+    # =============================================================================
+    def tp_action_device_toggle(self, dev, tp_action, parameters, target):
+        indigo_device_id, indigo_dev, log_message_name = target
+        if self.globals[K_DEBUG][K_SHOW_MESSAGES]:
+            self.tph_logger.info("Action '{0}' received from Touch Portal Desktop App for Device {1}".format(
+                                 TP_ENTRY_TRANSLATION[tp_action], log_message_name))
+        indigo.device.toggle(indigo_device_id)
+
+    # =============================================================================
+    def tp_action_device_turn_off(self, dev, tp_action, parameters, target):
+        indigo_device_id, indigo_dev, log_message_name = target
+        if self.globals[K_DEBUG][K_SHOW_MESSAGES]:
+            self.tph_logger.info("Action '{0}' received from Touch Portal Desktop App for Device {1}".format(
+                                 TP_ENTRY_TRANSLATION[tp_action], log_message_name))
+        indigo.device.turnOff(indigo_device_id)
+
+    # =============================================================================
+    def tp_action_device_turn_on(self, dev, tp_action, parameters, target):
+        indigo_device_id, indigo_dev, log_message_name = target
+        if self.globals[K_DEBUG][K_SHOW_MESSAGES]:
+            self.tph_logger.info("Action '{0}' received from Touch Portal Desktop App for Device {1}".format(
+                                 TP_ENTRY_TRANSLATION[tp_action], log_message_name))
+        indigo.device.turnOn(indigo_device_id)
+
+    # =============================================================================
+    def tp_action_variable_set_false(self, dev, tp_action, parameters, target):
+        indigo_variable_id, variable_dev, log_message_name = target
+        if self.globals[K_DEBUG][K_SHOW_MESSAGES]:
+            self.tph_logger.info("Action '{0}' received from Touch Portal Desktop App to set Variable {1} to FALSE".format(
+                                 TP_ENTRY_TRANSLATION[tp_action], log_message_name))
+        if self.globals[K_TP][dev.id][K_SHOW_VARIABLE_VALUE]:
+            self.tph_logger.info("Setting Variable {0} to value 'false'".format(log_message_name))
+        indigo.variable.updateValue(indigo_variable_id, value="false")
+
+    # =============================================================================
+    def tp_action_variable_set_text(self, dev, tp_action, parameters, target):
+        indigo_variable_id, variable_dev, log_message_name = target
+        tp_variable_value = parameters.variable_value
+        if self.globals[K_DEBUG][K_SHOW_MESSAGES]:
+            self.tph_logger.info("Action '{0}' received from Touch Portal Desktop App to set Variable value for {1} to '{2}'"
+                                 .format(TP_ENTRY_TRANSLATION[tp_action],
+                                         log_message_name, tp_variable_value))
+        if self.globals[K_TP][dev.id][K_SHOW_VARIABLE_VALUE]:
+            self.tph_logger.info("Setting Variable {0} to value '{1}'".format(log_message_name, tp_variable_value))
+        indigo.variable.updateValue(indigo_variable_id, value=tp_variable_value)
+
+    # =============================================================================
+    def tp_action_variable_set_true(self, dev, tp_action, parameters, target):
+        indigo_variable_id, variable_dev, log_message_name = target
+        if self.globals[K_DEBUG][K_SHOW_MESSAGES]:
+            self.tph_logger.info("Action '{0}' received from Touch Portal Desktop App to set Variable {1} to 'true'".format(
+                                 TP_ENTRY_TRANSLATION[tp_action], log_message_name))
+        if self.globals[K_TP][dev.id][K_SHOW_VARIABLE_VALUE]:
+            self.tph_logger.info("Setting Variable {0} to value 'true'".format(log_message_name))
+        indigo.variable.updateValue(indigo_variable_id, value="true")
+
+    # =============================================================================
+    def tp_action_variable_toggle(self, dev, tp_action, parameters, target):
+        indigo_variable_id, variable_dev, log_message_name = target
+        if self.globals[K_DEBUG][K_SHOW_MESSAGES]:
+            self.tph_logger.info("Action '{0}' received from Touch Portal Desktop App"
+                                 " to Toggle Variable {1}"
+                                 .format(TP_ENTRY_TRANSLATION[tp_action], log_message_name))
+
+        variable_value = indigo.variables[indigo_variable_id].value  # Not the snapshot - a toggle just sent may not have been notified yet
+        if variable_value.lower() == "false":
+            variable_value = "true"
+        elif variable_value.lower() == "true":
+            variable_value = "false"
+        else:
+            self.tph_logger.error(
+                "Action '{0}' received from Touch Portal Desktop App to Toggle Indigo Variable {1}"
+                " which currently has a non-bool value: '{2}'"
+                .format(TP_ENTRY_TRANSLATION[tp_action], log_message_name, variable_value))
+
+        if self.globals[K_TP][dev.id][K_SHOW_VARIABLE_VALUE]:
+            self.tph_logger.info("Setting Variable {0} to value '{1}'"
+                                 .format(log_message_name, variable_value))
+        indigo.variable.updateValue(indigo_variable_id, value=variable_value)
+
+    # =============================================================================
+    def tp_registry_snapshot(self, dev_id):
+        """
+        Return the TP devices registry (compiled from the Touch Portal device's 'tp_devices' property when the device
+        started or its config dialog was saved) for the batch of queue entries being processed. The batch keeps using
+        the registry it started with even if a new one is compiled part way through.
+
+        -----
+        :param dev_id: Indigo Touch Portal device id
+        :return: TpRegistry or None if missing
+        """
+        if self.tp_registry is None:
+            self.tp_registry = self.globals[K_TP][dev_id].get(K_TP_REGISTRY)
+        return self.tp_registry
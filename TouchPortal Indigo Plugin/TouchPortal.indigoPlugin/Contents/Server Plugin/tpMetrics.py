@@ -0,0 +1,86 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Touch Portal [tpMetrics] © Autolog & DaveL17 2020
+#
+
+# noinspection PyUnresolvedReferences
+# ============================== Native Imports ===============================
+import threading
+
+
+# noinspection PyUnresolvedReferences,PyPep8Naming,PyPep8
+class TpMetrics(object):
+
+    # This class accumulates the performance figures of a Touch Portal device for publishing as device states.
+    # Keys are the Indigo state ids (see Devices.xml) apart from observations which publish '<key>_avg_ms' and '<key>_max_ms'.
+
+    def __init__(self):
+
+        self.lock = threading.Lock()  # Metrics are updated from the reader, selector, handler and Indigo callback threads
+        self.values = {}  # Counters and gauges
+        self.observations = {}  # key = [count, total, maximum] - reset each time they are published
+        self.published = {}  # Last value published for each state - only changed values are re-published
+
+    # =============================================================================
+    def increment(self, key, amount=1):
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    # =============================================================================
+    def set(self, key, value):
+        with self.lock:
+            self.values[key] = value
+
+    # =============================================================================
+    def high_water(self, key, value):
+        with self.lock:
+            if value > self.values.get(key, 0):
+                self.values[key] = value
+
+    # =============================================================================
+    def observe(self, key, milliseconds):
+        with self.lock:
+            observation = self.observations.get(key)
+            if observation is None:
+                self.observations[key] = [1, milliseconds, milliseconds]
+            else:
+                observation[0] += 1
+                observation[1] += milliseconds
+                if milliseconds > observation[2]:
+                    observation[2] = milliseconds
+
+    # =============================================================================
+    def snapshot(self):
+        """
+        Return the current values (including observation averages and maximums) and reset the observations.
+
+        -----
+        :return: dict of state id: value
+        """
+        with self.lock:
+            states = dict(self.values)
+            for key, (count, total, maximum) in self.observations.iteritems():
+                states[u"{0}_avg_ms".format(key)] = int(round(total / count))
+                states[u"{0}_max_ms".format(key)] = int(round(maximum))
+            self.observations = {}
+        return states
+
+    # =============================================================================
+    def publish(self, dev):
+        """
+        Update the Indigo device states whose values have changed since they were last published.
+
+        -----
+        :param dev: Indigo Touch Portal device
+        :return:
+        """
+        key_value_list = []
+        for key, value in self.snapshot().iteritems():
+            if key not in dev.states:
+                continue  # Not (yet) defined in Devices.xml
+            if self.published.get(key) != value:
+                self.published[key] = value
+                key_value_list.append({"key": key, "value": value})
+        if key_value_list:
+            dev.updateStatesOnServer(key_value_list)
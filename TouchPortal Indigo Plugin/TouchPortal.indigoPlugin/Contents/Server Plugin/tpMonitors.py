@@ -0,0 +1,105 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Touch Portal [tpMonitors] © Autolog & DaveL17 2020
+#
+
+# noinspection PyUnresolvedReferences
+# ============================== Native Imports ===============================
+import operator
+import threading
+
+# ============================== Plugin Imports ===============================
+from constants import *
+
+
+# =============================================================================
+def device_on_off_value(dev):
+    return "ON" if dev.onState else "OFF"
+
+
+# =============================================================================
+def device_brightness_value(dev):
+    return dev.brightness
+
+
+# =============================================================================
+def device_colour_rgb_value(dev):
+    red_level = int((dev.redLevel * 255.0) / 100.0)
+    green_level = int((dev.greenLevel * 255.0) / 100.0)
+    blue_level = int((dev.blueLevel * 255.0) / 100.0)
+    return ('#FF%02x%02x%02x' % (red_level, green_level, blue_level)).upper()
+
+
+# Device states mirrored in Touch Portal - monitor list flag: (TP state id, Indigo attributes it depends on, TP value)
+TP_MONITOR_DEVICE_STATES = (
+    (TP_MONITOR_ON_OFF, u"indigo_device_{0}_on_off", ("onState",), device_on_off_value),
+    (TP_MONITOR_BRIGHTNESS, u"indigo_device_{0}_brightness", ("brightness",), device_brightness_value),
+    (TP_MONITOR_RGB, u"indigo_device_{0}_colour_rgb", ("redLevel", "greenLevel", "blueLevel"), device_colour_rgb_value))
+
+
+# noinspection PyUnresolvedReferences,PyPep8Naming,PyPep8
+class TpMonitorIndex(object):
+
+    # This class indexes the Indigo devices and variables monitored by every Touch Portal device (desktop) so that a
+    # change can be sent to each desktop mirroring it. Each desktop's monitors come from entry_tp_generator.construct
+    # when the desktop starts and are removed when it stops; the other desktops' monitors are left untouched.
+    # The devices and variables dicts (Indigo id: tuple of monitor lists, one per desktop - see TP_MONITOR_...) are
+    # rebuilt and replaced in a single assignment whenever a desktop's monitors change, so deviceUpdated /
+    # variableUpdated and the TP Handler threads can read them without locking.
+    # As Indigo calls deviceUpdated for every device change, the monitored device ids are also compiled into a frozenset
+    # (to reject the rest at once) and each monitored device into comparators of just the attributes mirrored.
+
+    def __init__(self):
+
+        self.lock = threading.Lock()  # Serialises changes to the desktops' monitors
+        self.desktop_devices = {}  # Touch Portal device id: {Indigo device id: monitor list}
+        self.desktop_variables = {}  # Touch Portal device id: {Indigo variable id: monitor list}
+        self.devices = {}  # Indigo device id: (monitor list, ...)
+        self.variables = {}  # Indigo variable id: (monitor list, ...)
+        self.device_comparators = {}  # Indigo device id: ((attribute getter, TP value, TP state id, Touch Portal device ids), ...)
+        self.device_ids = frozenset()  # Monitored Indigo device ids
+
+    # =============================================================================
+    def subscribe(self, desktop_id, monitored_devices, monitored_variables):
+        """
+        Replace the devices and variables monitored by a Touch Portal device.
+
+        -----
+        :param desktop_id: Indigo Touch Portal device id
+        :param monitored_devices: {Indigo device id: monitor list}
+        :param monitored_variables: {Indigo variable id: monitor list}
+        :return:
+        """
+        with self.lock:
+            self.desktop_devices[desktop_id] = monitored_devices
+            self.desktop_variables[desktop_id] = monitored_variables
+            self.rebuild()
+
+    # =============================================================================
+    def unsubscribe(self, desktop_id):
+        with self.lock:
+            self.desktop_devices.pop(desktop_id, None)
+            self.desktop_variables.pop(desktop_id, None)
+            self.rebuild()
+
+    # =============================================================================
+    def rebuild(self):
+        # Called with the lock held
+        for desktop_monitors, index_name in ((self.desktop_devices, "devices"), (self.desktop_variables, "variables")):
+            index = {}
+            for desktop_id in sorted(desktop_monitors):
+                for indigo_id, monitor_list in desktop_monitors[desktop_id].iteritems():
+                    index[indigo_id] = index.get(indigo_id, ()) + (monitor_list,)
+            setattr(self, index_name, index)
+
+        device_comparators = {}
+        for indigo_id, monitors in self.devices.iteritems():
+            comparators = []
+            for monitor_flag, tp_state_id, attributes, tp_value in TP_MONITOR_DEVICE_STATES:
+                desktop_ids = tuple(monitor_list[TP_MONITOR_TP_DESKTOP_DEV_ID] for monitor_list in monitors if monitor_list[monitor_flag])
+                if desktop_ids:
+                    comparators.append((operator.attrgetter(*attributes), tp_value, tp_state_id.format(indigo_id), desktop_ids))
+            device_comparators[indigo_id] = tuple(comparators)
+        self.device_comparators = device_comparators
+        self.device_ids = frozenset(device_comparators)  # Replaced after the comparators so a member always has them
@@ -0,0 +1,298 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Touch Portal [tpQueue] © Autolog & DaveL17 2020
+#
+
+# noinspection PyUnresolvedReferences
+# ============================== Native Imports ===============================
+import collections
+import heapq
+import itertools
+import json
+import Queue
+import re
+import time
+
+# ============================== Plugin Imports ===============================
+from constants import *
+
+TP_MESSAGE_TYPE_RE = re.compile(r'"type"\s*:\s*"([^"]*)"')
+
+# Process wide arrival order of queue entries (next() on an itertools.count is atomic so needs no lock)
+tp_queue_sequence = itertools.count()
+
+
+# noinspection PyUnresolvedReferences,PyPep8Naming,PyPep8
+class TpQueueEntry(object):
+
+    # This class is an entry on a Touch Portal device queue (K_RECEIVE_FROM_SEND_TO_TP).
+    # Entries are ordered by priority and then by arrival (sequence) so entries of equal priority are
+    # processed first in first out - see TpBoundedPriorityQueue._put.
+
+    __slots__ = ("priority", "sequence", "command", "dev_id", "package", "message_class", "coalesce_key", "trace")
+
+    def __init__(self, priority, command, dev_id, package):
+
+        self.priority = priority
+        self.sequence = next(tp_queue_sequence)
+        self.command = command
+        self.dev_id = dev_id
+        self.package = package
+        self.message_class = None  # Set by TpBoundedPriorityQueue.put (see classify_queued_entry)
+        self.coalesce_key = None
+        self.trace = None  # TpTrace of an action message whilst tracing (see tpTrace)
+
+    def __repr__(self):
+        return u"[{0}, {1}, {2}, {3}, {4}]".format(self.priority, self.sequence, self.command, self.dev_id, self.package)
+
+
+# =============================================================================
+def received_tp_message_entry(dev_id, data, received_time, tracer=None):
+    """
+    Build the queue entry for a message received from Touch Portal Desktop.
+    The message is decoded once here and its type decides the queue priority (see TP_MESSAGE_PRIORITIES).
+    The decoded message is queued with the raw message so that the handler doesn't decode it again.
+
+    -----
+    :param dev_id: Indigo Touch Portal device id
+    :param data: message (without line terminator)
+    :param received_time: time the message was received from the socket
+    :param tracer: TpTracer if action messages are being traced
+    :return: TpQueueEntry with package [data, received_time, decoded message or None if invalid]
+    """
+    try:
+        converted_data = json.loads(data)
+        tp_type = converted_data.get("type")
+        tp_priority = TP_MESSAGE_PRIORITIES.get(tp_type, TP_MESSAGE_PRIORITY_DEFAULT)
+    except (ValueError, AttributeError):
+        converted_data = None  # Handler will log the invalid message
+        tp_type = None
+        tp_priority = TP_MESSAGE_PRIORITY_DEFAULT
+    entry = TpQueueEntry(tp_priority, CMD_PROCESS_RECEIVED_TP_MESSAGE, dev_id, [data, received_time, converted_data])
+    if tracer is not None and tp_type == "action":
+        entry.trace = tracer.start(converted_data.get("actionId"), received_time)
+        entry.trace.stamp(TP_TRACE_DECODED)
+    return entry
+
+
+# =============================================================================
+def classify_queued_entry(entry):
+    """
+    Determine the message class (see TP_QUEUE_POLICIES) and coalesce key of a queued entry.
+    Received messages are normally already decoded (see received_tp_message_entry) - if not, only the message
+    type is extracted (listChange messages, which are coalesced, are decoded for their list and instance ids).
+
+    -----
+    :param entry: TpQueueEntry
+    :return: (message class, coalesce key or None)
+    """
+    tp_command = entry.command
+    if tp_command == CMD_PROCESS_RECEIVED_TP_MESSAGE:
+        converted_data = entry.package[2] if len(entry.package) > 2 else None
+        if converted_data is not None:
+            tp_type = converted_data.get("type")
+        else:
+            type_match = TP_MESSAGE_TYPE_RE.search(entry.package[0])
+            tp_type = type_match.group(1) if type_match is not None else ""
+        if tp_type == "action":
+            return TP_MESSAGE_CLASS_ACTION, None
+        elif tp_type in TP_MESSAGE_TYPES_CONTROL:
+            return TP_MESSAGE_CLASS_CONTROL, None
+        elif tp_type == "listChange":
+            try:
+                if converted_data is None:
+                    converted_data = json.loads(entry.package[0])
+                return TP_MESSAGE_CLASS_LIST_CHANGE, (u"listChange", converted_data.get("listId"), converted_data.get("instanceId"))
+            except ValueError:
+                return TP_MESSAGE_CLASS_INFO, None  # Handler will log the invalid message
+        return TP_MESSAGE_CLASS_INFO, None
+    elif tp_command == CMD_PROCESS_REFRESH_TP_PLUGIN_STATES:
+        return TP_MESSAGE_CLASS_REFRESH, (u"refresh", entry.dev_id)
+    return TP_MESSAGE_CLASS_CONTROL, None
+
+
+# noinspection PyUnresolvedReferences,PyPep8Naming,PyPep8
+class TpBoundedPriorityQueue(Queue.PriorityQueue):
+
+    # This class is the per Touch Portal device 'receive from / send to Touch Portal' queue (K_RECEIVE_FROM_SEND_TO_TP).
+    # Its capacity is enforced per message class by the overload policies in TP_QUEUE_POLICIES. Control entries
+    # (stop sentinel, pair, Touch Portal Desktop's info / closePlugin messages) are never dropped and may exceed the
+    # capacity. Entries with a coalesce key are always coalesced, not only when at capacity (see TP_QUEUE_POLICY_COALESCE).
+
+    def __init__(self, capacity, metrics):
+
+        Queue.PriorityQueue.__init__(self)  # Unbounded at Queue level - capacity is enforced by put
+
+        self.capacity = capacity
+        self.metrics = metrics
+        self.class_entries = collections.defaultdict(collections.deque)  # message class: entries in arrival order
+        self.coalesce_entries = {}  # coalesce key: queued entry
+
+    # =============================================================================
+    def put(self, item, block=True, timeout=None):
+        """
+        Queue an entry applying the overload policy of its message class if the queue is at capacity.
+
+        -----
+        :param item: TpQueueEntry
+        :param block: False if the caller mustn't wait for space (the shared TP Selector thread serves every desktop) -
+                      the 'block' policy then drops the new entry at once
+        :param timeout: ignored - the wait is governed by the message class policy
+        :return:
+        """
+        message_class, coalesce_key = classify_queued_entry(item)
+        policy = TP_QUEUE_POLICIES.get(message_class, TP_QUEUE_POLICY_BLOCK)
+
+        with self.not_full:
+            if coalesce_key is not None and coalesce_key in self.coalesce_entries:
+                # Replace the data of the queued entry (superseded whether or not at capacity) - its position in the
+                # queue is unchanged
+                self.coalesce_entries[coalesce_key].package = item.package
+                self.metrics.increment("queue_coalesced")
+                return
+
+            if message_class != TP_MESSAGE_CLASS_CONTROL and self._qsize() >= self.capacity:
+                if policy == TP_QUEUE_POLICY_BLOCK:
+                    if block:
+                        # Wait a short time for the handler to make space (holds up the reader which applies back pressure)
+                        deadline = time.time() + TP_QUEUE_BLOCK_SECONDS
+                        while self._qsize() >= self.capacity:
+                            remaining = deadline - time.time()
+                            if remaining <= 0.0:
+                                break
+                            self.not_full.wait(remaining)
+                elif not self.drop_oldest_below(item.priority):
+                    # Nothing of a lower priority queued (e.g. a list change or info message that can make room for a
+                    # button press) - drop the oldest entry of this class instead
+                    self.drop_oldest(message_class)
+
+                if self._qsize() >= self.capacity:
+                    self.metrics.increment("queue_dropped")
+                    return  # Overloaded - new entry is dropped
+
+            item.message_class = message_class
+            item.coalesce_key = coalesce_key
+            if item.trace is not None:
+                item.trace.stamp(TP_TRACE_ENQUEUED)
+            self._put(item)
+            self.class_entries[message_class].append(item)
+            if coalesce_key is not None:
+                self.coalesce_entries[coalesce_key] = item
+            self.unfinished_tasks += 1
+            self.not_empty.notify()
+
+            self.metrics.increment("queue_enqueued")
+            self.metrics.high_water("queue_high_water", self._qsize())
+
+    # =============================================================================
+    def get(self, block=True, timeout=None):
+        """
+        Dequeue the next entry, shedding button presses that have gone stale whilst the handler was catching up.
+
+        -----
+        :param block:
+        :param timeout:
+        :return: TpQueueEntry
+        """
+        while True:
+            item = Queue.PriorityQueue.get(self, block, timeout)
+            if item.message_class == TP_MESSAGE_CLASS_ACTION and time.time() - item.package[1] > TP_QUEUE_STALE_PRESS_SECONDS:
+                self.task_done()
+                self.metrics.increment("queue_shed")
+                continue
+            return item
+
+    # =============================================================================
+    def get_batch(self, maximum):
+        """
+        Dequeue the next entry (blocking) and up to maximum - 1 further entries that are ready.
+
+        -----
+        :param maximum:
+        :return: list of TpQueueEntry in priority order
+        """
+        batch = [self.get(True)]
+        while len(batch) < maximum:
+            try:
+                batch.append(self.get(False))
+            except Queue.Empty:
+                break
+        return batch
+
+    # =============================================================================
+    def drop_oldest(self, message_class):
+        """
+        Remove the oldest queued entry of a message class. Must be called holding self.mutex.
+
+        -----
+        :param message_class:
+        :return: True if an entry was dropped
+        """
+        entries = self.class_entries.get(message_class)
+        if not entries:
+            return False
+        self.drop(entries[0])
+        return True
+
+    # =============================================================================
+    def drop_oldest_below(self, priority):
+        """
+        Remove the oldest queued entry (other than control entries) with a lower priority than given.
+        Must be called holding self.mutex.
+
+        -----
+        :param priority: queue priority of the entry being queued
+        :return: True if an entry was dropped
+        """
+        oldest_entry = None
+        for message_class, entries in self.class_entries.iteritems():
+            if message_class == TP_MESSAGE_CLASS_CONTROL:
+                continue
+            for entry in entries:  # In arrival order - only the first of a lower priority is a candidate
+                if entry.priority > priority:
+                    if oldest_entry is None or entry.sequence < oldest_entry.sequence:
+                        oldest_entry = entry
+                    break
+        if oldest_entry is None:
+            return False
+        self.drop(oldest_entry)
+        return True
+
+    # =============================================================================
+    def drop(self, entry):
+        # Must be called holding self.mutex
+        for index, heap_entry in enumerate(self.queue):
+            if heap_entry[2] is entry:
+                self.queue[index] = self.queue[-1]
+                self.queue.pop()
+                heapq.heapify(self.queue)
+                break
+        self.forget(entry)
+        self.unfinished_tasks -= 1
+        self.metrics.increment("queue_dropped")
+
+    # =============================================================================
+    def forget(self, entry):
+        message_class, coalesce_key = entry.message_class, entry.coalesce_key
+        entries = self.class_entries[message_class]
+        if entries and entries[0] is entry:
+            entries.popleft()
+        else:
+            for index, class_entry in enumerate(entries):
+                if class_entry is entry:
+                    del entries[index]
+                    break
+        if coalesce_key is not None and self.coalesce_entries.get(coalesce_key) is entry:
+            del self.coalesce_entries[coalesce_key]
+
+    # =============================================================================
+    def _put(self, item):
+        # The heap holds (priority, sequence, entry) - as sequences are unique, comparisons never reach the entry
+        heapq.heappush(self.queue, (item.priority, item.sequence, item))
+
+    # =============================================================================
+    def _get(self):
+        entry = heapq.heappop(self.queue)[2]
+        self.forget(entry)
+        return entry
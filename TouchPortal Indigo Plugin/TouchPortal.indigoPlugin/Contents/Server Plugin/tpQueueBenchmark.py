@@ -0,0 +1,147 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Touch Portal [tpQueueBenchmark] © Autolog & DaveL17 2020
+#
+# Standalone tool (not loaded by Indigo) that checks the ordering of the Touch Portal device queue (see tpQueue.py) and
+# times it under a mixed load of actions, info and listChange messages. The heap of TpQueueEntry objects is timed
+# against the list entries queued before TpQueueEntry, whose ties of equal priority were broken by comparing content.
+#
+# Usage: python tpQueueBenchmark.py [--messages n] [--repeat n] [--seed n]
+#   --messages is the number of messages queued (default 20000) - half actions, three tenths info and a fifth listChange.
+#   --repeat is the number of times each is timed - the fastest is reported (default 5).
+#
+
+# noinspection PyUnresolvedReferences
+# ============================== Native Imports ===============================
+import argparse
+import heapq
+import random
+import sys
+import time
+import types
+
+QUEUE_MESSAGE = '{{"type":"{0}","data":[{{"id":"indigo_device_name_on_off","value":"Device {1}"}}],"listId":"list_{2}","instanceId":"instance"}}'
+QUEUE_MESSAGE_TYPES = ["action"] * 5 + ["info"] * 3 + ["listChange"] * 2  # Mixed load - weighted choice of message type
+
+
+# =============================================================================
+def fastest(repeat, timed_function):
+    """
+    Time a function repeatedly.
+
+    -----
+    :param repeat: number of times timed
+    :param timed_function: callable
+    :return: fastest time in seconds
+    """
+    seconds = []
+    for _ in range(repeat):
+        start_time = time.time()
+        timed_function()
+        seconds.append(time.time() - start_time)
+    return max(min(seconds), 0.000001)
+
+
+# =============================================================================
+def check():
+    """
+    Check that entries of equal priority are dequeued in arrival order and ahead of lower priorities.
+
+    -----
+    :return: number of checks failed
+    """
+    from constants import CMD_STOP_THREAD, QUEUE_PRIORITY_STOP
+    from tpMetrics import TpMetrics
+    from tpQueue import TpBoundedPriorityQueue, TpQueueEntry, received_tp_message_entry
+
+    failed = 0
+    tp_queue = TpBoundedPriorityQueue(1000, TpMetrics())
+    for number in range(50):
+        tp_queue.put(received_tp_message_entry(1, '{{"type":"info","number":{0}}}'.format(50 - number), time.time()))
+    dequeued = [tp_queue.get().package[2]["number"] for _ in range(50)]
+    if dequeued != list(range(50, 0, -1)):
+        failed += 1
+        print(u"  FAILED: equal priority entries not dequeued in arrival order")
+
+    tp_queue.put(received_tp_message_entry(1, '{"type":"info"}', time.time()))
+    tp_queue.put(received_tp_message_entry(1, '{"type":"action"}', time.time()))
+    tp_queue.put(TpQueueEntry(QUEUE_PRIORITY_STOP, CMD_STOP_THREAD, None, []))
+    if tp_queue.get().command != CMD_STOP_THREAD or tp_queue.get().package[2]["type"] != "action":
+        failed += 1
+        print(u"  FAILED: entries not dequeued in priority order")
+
+    print(u"Checked queue ordering: {0}".format(u"all passed" if failed == 0 else u"{0} FAILED".format(failed)))
+    return failed
+
+
+# =============================================================================
+def benchmark(arguments):
+    """
+    Time queueing and dequeuing the mixed load.
+
+    -----
+    :param arguments: parsed command line arguments
+    :return:
+    """
+    from constants import CMD_PROCESS_RECEIVED_TP_MESSAGE
+    from tpMetrics import TpMetrics
+    from tpQueue import TpBoundedPriorityQueue, received_tp_message_entry
+
+    messages = [QUEUE_MESSAGE.format(random.choice(QUEUE_MESSAGE_TYPES), number, number % 50) for number in range(arguments.messages)]
+    received_time = time.time()
+    entries = [received_tp_message_entry(1, message, received_time) for message in messages]
+    list_entries = [[entry.priority, 0, CMD_PROCESS_RECEIVED_TP_MESSAGE, 1, entry.package] for entry in entries]
+
+    def push_pop_list_entries():
+        heap = []
+        for list_entry in list_entries:
+            heapq.heappush(heap, list_entry)
+        while heap:
+            heapq.heappop(heap)
+
+    def push_pop_queue_entries():
+        tp_queue = TpBoundedPriorityQueue(arguments.messages, TpMetrics())
+        for entry in entries:
+            tp_queue._put(entry)
+        while tp_queue.queue:
+            heapq.heappop(tp_queue.queue)
+
+    # The whole queue - classification, coalescing of listChange messages and the Queue locking
+    metrics = TpMetrics()
+
+    def put_get_queue_entries():
+        tp_queue = TpBoundedPriorityQueue(arguments.messages, metrics)
+        for message in messages:
+            tp_queue.put(received_tp_message_entry(1, message, received_time))
+        while not tp_queue.empty():
+            tp_queue.get()
+            tp_queue.task_done()
+
+    print(u"Queueing {0} mixed messages (fastest of {1})".format(arguments.messages, arguments.repeat))
+    for name, timed_function in ((u"Heap push / pop - list entries", push_pop_list_entries),
+                                 (u"Heap push / pop - TpQueueEntry", push_pop_queue_entries),
+                                 (u"Decode, put and get - whole queue", put_get_queue_entries)):
+        seconds = fastest(arguments.repeat, timed_function)
+        print(u"  {0:<34} {1:>8.1f} ms ({2:.0f} messages/second)".format(name, seconds * 1000.0, arguments.messages / seconds))
+    print(u"  listChange messages coalesced per run: {0}".format(metrics.values.get("queue_coalesced", 0) // arguments.repeat))
+
+
+# =============================================================================
+def main():
+    parser = argparse.ArgumentParser(description="Check and time the Touch Portal device queue.")
+    parser.add_argument("--messages", type=int, default=20000, help="messages queued (default 20000)")
+    parser.add_argument("--repeat", type=int, default=5, help="times each is timed - the fastest is reported (default 5)")
+    parser.add_argument("--seed", type=int, default=1, help="random seed of the message types")
+    arguments = parser.parse_args()
+
+    sys.modules["indigo"] = types.ModuleType("indigo")  # Imported by constants - not used by the queue
+    random.seed(arguments.seed)
+
+    failed = check()
+    benchmark(arguments)
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
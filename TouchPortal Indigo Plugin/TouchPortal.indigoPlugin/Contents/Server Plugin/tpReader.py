@@ -6,8 +6,11 @@
 
 # noinspection PyUnresolvedReferences
 # ============================== Native Imports ===============================
+import errno
 import json
 import logging
+import os
+import select
 import socket
 import sys
 import time
@@ -21,6 +24,42 @@ except ImportError:
 
 # ============================== Plugin Imports ===============================
 from constants import *
+from tpFramer import TpLineFramer
+from tpQueue import received_tp_message_entry, TpQueueEntry
+from tpReconnect import backoff_delay
+
+
+# =============================================================================
+def set_tp_socket_options(tp_socket, tp_device_globals):
+    """
+    Apply the TCP keepalive and TCP_NODELAY options configured for a Touch Portal device to its socket.
+    Keepalive lets the OS detect a Touch Portal Desktop that has gone away without closing the connection.
+
+    -----
+    :param tp_socket:
+    :param tp_device_globals: self.globals[K_TP][dev_id]
+    :return:
+    """
+    if tp_device_globals.get(K_TCP_NODELAY, TP_TCP_NODELAY_DEFAULT):
+        tp_socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+    if tp_device_globals.get(K_TCP_KEEPALIVE, TP_TCP_KEEPALIVE_DEFAULT):
+        tp_socket.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+        # Tune the keepalive timings where the OS allows it
+        if sys.platform == "darwin":  # Python 2.7 doesn't export the macOS TCP_KEEPALIVE, TCP_KEEPINTVL and TCP_KEEPCNT values
+            keepalive_options = ((0x10, TP_TCP_KEEPALIVE_IDLE_SECONDS),
+                                 (0x101, TP_TCP_KEEPALIVE_INTERVAL_SECONDS),
+                                 (0x102, TP_TCP_KEEPALIVE_COUNT))
+        else:
+            keepalive_options = ((getattr(socket, "TCP_KEEPIDLE", None), TP_TCP_KEEPALIVE_IDLE_SECONDS),
+                                 (getattr(socket, "TCP_KEEPINTVL", None), TP_TCP_KEEPALIVE_INTERVAL_SECONDS),
+                                 (getattr(socket, "TCP_KEEPCNT", None), TP_TCP_KEEPALIVE_COUNT))
+        for option, value in keepalive_options:
+            if option is not None:
+                try:
+                    tp_socket.setsockopt(socket.IPPROTO_TCP, option, value)
+                except socket.error:
+                    pass  # Not supported by this OS version - system defaults apply
 
 
 # noinspection PyUnresolvedReferences,PyPep8Naming,PyPep8
@@ -38,6 +77,19 @@ class ThreadTpReader(threading.Thread):
         self.tpr_logger.debug(u"Debugging Touch Portal Reader Thread")
         self.thread_stop = event
 
+        # Writing a byte to wakeup_send interrupts select() so that a stop is actioned immediately - see stop()
+        self.wakeup_receive, self.wakeup_send = socket.socketpair()
+        self.wakeup_receive.setblocking(0)
+        self.wakeup_send.setblocking(0)
+
+    # =============================================================================
+    def stop(self):
+        self.thread_stop.set()
+        try:
+            self.wakeup_send.send(b"\x00")
+        except socket.error:
+            pass  # Wakeup already pending (socket buffer full) or thread already ended
+
     # =============================================================================
     def handle_communication(self, dev):
         """
@@ -52,16 +104,29 @@ class ThreadTpReader(threading.Thread):
             dev_id = dev.id
             socket_error_message = ""
 
+            # Messages can straddle reads or arrive several to a read - the framer only returns complete messages
+            framer = TpLineFramer(self.globals[K_TP][dev_id].get(K_RECEIVE_BUFFER_SIZE, TP_RECEIVE_BUFFER_SIZE_DEFAULT),
+                                  self.globals[K_TP][dev_id].get(K_MAX_FRAME_SIZE, TP_MAX_FRAME_SIZE_DEFAULT))
+
+            # Connected - the TP Writer thread writes from now on but buffers state updates until Touch Portal Desktop
+            # has been paired (see process_receive_tp_message_info)
+            self.globals[K_THREADS][dev_id][K_THREAD_WRITER][K_THREAD].connection_established()
+
             self.globals[K_QUEUES][dev_id][K_RECEIVE_FROM_SEND_TO_TP].put(
-                [QUEUE_PRIORITY_HIGH, 0, CMD_PROCESS_SEND_TP_MESSAGE, dev_id,
-                 ['{"type":"pair", "id":"indigo_domotics_001"}']])
+                TpQueueEntry(QUEUE_PRIORITY_HIGH, CMD_PROCESS_SEND_TP_MESSAGE, dev_id,
+                             ['{"type":"pair", "id":"indigo_domotics_001"}']))
 
             while not self.thread_stop.is_set() and socket_error_message == "":
                 # noinspection PyPep8,PyBroadException
                 try:
                     # Start process to accept input from Touch Portal
                     try:
-                        data_lines = self.globals[K_SOCKETS][dev_id][K_TP_SOCKET].recv(1024)
+                        tp_socket = self.globals[K_SOCKETS][dev_id][K_TP_SOCKET]
+                        # Wait for input or a wakeup from stop() - the timeout is only a safety net
+                        readable, _, _ = select.select([tp_socket, self.wakeup_receive], [], [], self.globals[K_TP][dev_id][K_TIMEOUT])
+                        if tp_socket not in readable:
+                            continue  # Woken up (or timed out) - recheck self.thread_stop.is_set()
+                        bytes_read, data_list = framer.receive(tp_socket)
                     except socket.timeout:
                         pass  # The timeout, allows for checking self.thread_stop.is_set()
                     except socket.error as error_msg:
@@ -70,16 +135,20 @@ class ThreadTpReader(threading.Thread):
                                               .format(dev.name, sys.exc_traceback.tb_lineno, error_msg))
                         socket_error_message = u"'{0}'".format(error_msg)
                     else:
-                        if len(data_lines) == 0:
+                        if bytes_read == 0:
                             self.tpr_logger.warning(u"Communication with Touch Portal Desktop has been lost!")
                             socket_error_message = "Communication has been lost"
                         else:
-                            data_list = data_lines.splitlines()
+                            received_time = time.time()
+                            self.globals[K_TP][dev_id][K_LAST_RECEIVED] = received_time  # See check_tp_liveness in plugin
+                            capture = self.globals[K_TP][dev_id].get(K_CAPTURE)
+                            tracer = self.globals[K_TP][dev_id].get(K_TRACER)
                             for data in data_list:
                                 self.tpr_logger.debug(u"RECEIVED DATA BEING QUEUED: {0}".format(data))
+                                if capture is not None:
+                                    capture.record(TP_CAPTURE_INBOUND, data)
 
-                                self.globals[K_QUEUES][dev_id][K_RECEIVE_FROM_SEND_TO_TP].put(
-                                    [QUEUE_PRIORITY_HIGH, 0, CMD_PROCESS_RECEIVED_TP_MESSAGE, dev_id, [data]])
+                                self.globals[K_QUEUES][dev_id][K_RECEIVE_FROM_SEND_TO_TP].put(received_tp_message_entry(dev_id, data, received_time, tracer))
 
                 except StandardError as standard_error_message:
                     self.tpr_logger.error(u"StandardError detected in TP Reader Reader. Line '{0}' has error='{1}'"
@@ -91,6 +160,8 @@ class ThreadTpReader(threading.Thread):
                                           .format(sys.exc_traceback.tb_lineno, sys.exc_info()[0]))
                     socket_error_message = u"See Indigo Error Log"
 
+            self.globals[K_THREADS][dev_id][K_THREAD_WRITER][K_THREAD].connection_lost()  # Nothing is written to the closed socket
+
             dev.updateStateOnServer("onOffState", False, uiValue="Disconnected", clearErrorState=True)
             dev.updateStateImageOnServer(indigo.kStateImageSel.SensorOff)
 
@@ -99,10 +170,8 @@ class ThreadTpReader(threading.Thread):
                 dev.updateStateOnServer("connection_status", socket_error_message)
                 dev.setErrorStateOnServer("Connection Error")
 
-                # Initiate socket recovery process - See runConcurrentThread
-                self.globals[K_LOCK].acquire()  # Serialise update of 'recoveryInvoked' list
-                self.globals[K_RECOVERY_INVOKED].append(dev.id)  # Add deviceID to recover list
-                self.globals[K_LOCK].release()
+                # Initiate socket recovery process - wakes runConcurrentThread immediately
+                self.globals[K_RECONNECT_SCHEDULER].request(dev_id)
             else:
                 self.close_socket(dev)
 
@@ -158,13 +227,28 @@ class ThreadTpReader(threading.Thread):
                 if self.dev_id not in self.globals[K_SOCKETS]:
                     self.globals[K_SOCKETS][dev_id] = {}
                 try:
-                    self.globals[K_SOCKETS][dev_id][K_TP_SOCKET] = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-                    self.globals[K_SOCKETS][dev_id][K_TP_SOCKET].settimeout(self.globals[K_TP][dev_id][K_TIMEOUT])
-                    self.globals[K_SOCKETS][dev_id][K_TP_SOCKET].connect(
-                        (self.globals[K_TP][dev_id][K_HOST], self.globals[K_TP][dev_id][K_PORT]))
+                    tp_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+                    self.globals[K_SOCKETS][dev_id][K_TP_SOCKET] = tp_socket
+                    set_tp_socket_options(tp_socket, self.globals[K_TP][dev_id])
+
+                    # Connect without blocking so that a stop() abandons the connection attempt immediately
+                    tp_socket.setblocking(0)
+                    socket_error_code = tp_socket.connect_ex((self.globals[K_TP][dev_id][K_HOST], self.globals[K_TP][dev_id][K_PORT]))
+                    if socket_error_code in (errno.EINPROGRESS, errno.EALREADY, errno.EWOULDBLOCK):
+                        _, writable, _ = select.select([self.wakeup_receive], [tp_socket], [], self.globals[K_TP][dev_id][K_TIMEOUT])
+                        if tp_socket in writable:
+                            socket_error_code = tp_socket.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+                        elif self.thread_stop.is_set():
+                            socket_error_code = errno.EINTR
+                        else:
+                            socket_error_code = errno.ETIMEDOUT
+                    if socket_error_code not in (0, errno.EISCONN):
+                        raise socket.error(socket_error_code, os.strerror(socket_error_code))
+
+                    tp_socket.settimeout(self.globals[K_TP][dev_id][K_TIMEOUT])  # The TP Writer thread uses sendall on this socket
                 except socket.error as socket_error:
                     socket_error_code = socket_error.errno
-                    if socket_error_code == 61:
+                    if socket_error_code == errno.ECONNREFUSED:
                         socket_error_message = u"Connection failed"
                         socket_error_message_long = u"Connection attempt to Touch Portal Desktop failed; Is it running?"
                     else:
@@ -181,6 +265,13 @@ class ThreadTpReader(threading.Thread):
             dev.updateStateImageOnServer(indigo.kStateImageSel.SensorOn)
             dev.updateStateOnServer("connection_status", "Connected")
 
+            self.globals[K_TP][dev_id][K_LAST_RECEIVED] = time.time()
+            self.globals[K_TP][dev_id][K_LIVENESS_PROBE_SENT] = None
+
+            reconnect_seconds = self.globals[K_RECONNECT_SCHEDULER].connected(dev_id)
+            if reconnect_seconds is not None:
+                dev.updateStateOnServer("reconnect_seconds", round(reconnect_seconds, 1))
+
             return True, "OK"  # Connected OK
 
         except StandardError as standard_error_message:
@@ -202,14 +293,9 @@ class ThreadTpReader(threading.Thread):
 
             self.tpr_logger.debug(u"Touch Portal Reader Thread initialised")
 
-            self.globals[K_TP][dev_id][K_SOCKET_RETRY_SECONDS] = int(dev.pluginProps.get("socketRetrySeconds",
-                                                                     TP_SOCKET_RETRY_DEFAULT))
-            self.globals[K_TP][dev_id][K_SOCKET_RETRY_SILENT_AFTER] = int(dev.pluginProps.get("socketRetrySilentAfter",
-                                                                          TP_SOCKET_RETRY_SILENT_AFTER_DEFAULT))
-
             retry_count = 0
             retry_visible_limit = int(self.globals[K_TP][dev_id][K_SOCKET_RETRY_SILENT_AFTER])
-            retry_delay = int(self.globals[K_TP][dev_id][K_SOCKET_RETRY_SECONDS])
+            retry_delay = int(self.globals[K_TP][dev_id][K_SOCKET_RETRY_SECONDS])  # Maximum delay between retries
 
             self.tpr_logger.debug(u"RETRY [Before While Loop]: Count = {0}, Limit = {1}, Delay = {2}"
                                   .format(retry_count, retry_visible_limit, retry_delay))
@@ -228,7 +314,8 @@ class ThreadTpReader(threading.Thread):
                     if retry_count == 0:
                         self.tpr_logger.warning(socket_error_message_long)
                         self.tpr_logger.warning(
-                            u"Will attempt to reconnect to Touch Portal Desktop every {0} seconds".format(retry_delay))
+                            u"Will attempt to reconnect to Touch Portal Desktop at increasing intervals of up to {0} seconds"
+                            .format(retry_delay))
                     else:
                         self.tpr_logger.warning(u"Connection attempt {0}: {1}"
                                                 .format(retry_count, socket_error_message_long))
@@ -238,17 +325,23 @@ class ThreadTpReader(threading.Thread):
                             u"Suppressing retry connection messages (logging limit {0} has been reached)"
                             .format(retry_visible_limit))
 
+                backoff_seconds = backoff_delay(retry_count, TP_RECONNECT_BACKOFF_BASE_SECONDS, retry_delay)
                 retry_count += 1
-                self.tpr_logger.debug(u"RETRY [In While Loop]: Count = {0}, Limit = {1}, Delay = {2}"
-                                      .format(retry_count, retry_visible_limit, retry_delay))
-                time.sleep(retry_delay)  # Sleep and then continue While 'not connected' loop
+                self.tpr_logger.debug(u"RETRY [In While Loop]: Count = {0}, Limit = {1}, Delay = {2:.1f}"
+                                      .format(retry_count, retry_visible_limit, backoff_seconds))
+                self.thread_stop.wait(backoff_seconds)  # Wait (unless stopped) and then continue While 'not connected' loop
 
             if not self.thread_stop.is_set():
                 self.tpr_logger.info(u"'{0}' now connected to Touch Portal Desktop".format(dev.name))
                 self.handle_communication(dev)
+            else:
+                self.close_socket(dev)  # Stopped during a connection attempt
 
         except StandardError as standard_error_message:
             self.tpr_logger.error(u"StandardError detected in TP Reader Thread - Run. Line '{0}' has error='{1}'"
                                   .format(sys.exc_traceback.tb_lineno, standard_error_message))
 
+        self.wakeup_receive.close()
+        self.wakeup_send.close()
+
         self.tpr_logger.debug(u"Touch Portal Reader Thread Ended")
@@ -0,0 +1,135 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Touch Portal [tpReconnect] © Autolog & DaveL17 2020
+#
+
+# noinspection PyUnresolvedReferences
+# ============================== Native Imports ===============================
+import random
+import threading
+import time
+
+# ============================== Plugin Imports ===============================
+from constants import *
+
+
+# =============================================================================
+def backoff_delay(attempt, base_seconds, cap_seconds):
+    """
+    Capped exponential backoff with jitter.
+    The delay doubles with each attempt up to the cap and is then randomised between half and all of
+    that value so that several Touch Portal devices don't all retry at the same moment.
+
+    -----
+    :param attempt: number of previous attempts (0 = first retry)
+    :param base_seconds: delay before the first retry
+    :param cap_seconds: maximum delay
+    :return: seconds to wait before the next attempt
+    """
+    delay = min(float(cap_seconds), base_seconds * (2 ** min(attempt, 16)))
+    return random.uniform(delay / 2.0, delay)
+
+
+# noinspection PyUnresolvedReferences,PyPep8Naming,PyPep8
+class TpReconnectScheduler(object):
+
+    # This class schedules the recovery of Touch Portal devices whose connection has been lost.
+    # Connection loss wakes runConcurrentThread immediately and each device is recovered independently.
+
+    def __init__(self):
+
+        self.lock = threading.Lock()
+        self.wakeup_event = threading.Event()
+        self.pending = {}  # dev_id: time recovery is due
+        self.attempts = {}  # dev_id: recoveries since the connection was last stable
+        self.disconnected_at = {}  # dev_id: time the connection was lost
+        self.connected_at = {}  # dev_id: time the connection was last established
+
+    # =============================================================================
+    def request(self, dev_id):
+        """
+        Connection lost - schedule recovery (immediately unless the connection keeps dropping).
+
+        -----
+        :param dev_id:
+        :return:
+        """
+        now = time.time()
+        with self.lock:
+            if now - self.connected_at.get(dev_id, 0.0) >= TP_RECONNECT_STABLE_SECONDS:
+                self.attempts[dev_id] = 0  # Connection was stable, so this is a fresh failure
+            attempt = self.attempts.get(dev_id, 0)
+            if attempt == 0:
+                self.pending[dev_id] = now
+            else:
+                self.pending[dev_id] = now + backoff_delay(attempt - 1, TP_RECONNECT_BACKOFF_BASE_SECONDS, TP_RECONNECT_BACKOFF_CAP_SECONDS)
+            self.attempts[dev_id] = attempt + 1
+            if dev_id not in self.disconnected_at:
+                self.disconnected_at[dev_id] = now
+        self.wakeup_event.set()
+
+    # =============================================================================
+    def cancel(self, dev_id):
+        """
+        Device stopped or disconnected by the user - forget any outstanding recovery.
+
+        -----
+        :param dev_id:
+        :return:
+        """
+        with self.lock:
+            self.pending.pop(dev_id, None)
+            self.attempts.pop(dev_id, None)
+            self.disconnected_at.pop(dev_id, None)
+
+    # =============================================================================
+    def connected(self, dev_id):
+        """
+        Connection established.
+
+        -----
+        :param dev_id:
+        :return: seconds taken to reconnect or None if the connection had not been lost
+        """
+        now = time.time()
+        with self.lock:
+            self.connected_at[dev_id] = now
+            disconnected_at = self.disconnected_at.pop(dev_id, None)
+        if disconnected_at is None:
+            return None
+        return now - disconnected_at
+
+    # =============================================================================
+    def wait(self, timeout):
+        """
+        Wait until a recovery is due, a recovery is requested or the timeout expires.
+
+        -----
+        :param timeout: maximum seconds to wait
+        :return:
+        """
+        with self.lock:
+            if self.pending:
+                timeout = max(0.0, min(timeout, min(self.pending.itervalues()) - time.time()))
+        self.wakeup_event.wait(timeout)
+        self.wakeup_event.clear()
+
+    # =============================================================================
+    def wakeup(self):
+        self.wakeup_event.set()
+
+    # =============================================================================
+    def due(self):
+        """
+        Remove and return the devices whose recovery is now due.
+
+        -----
+        :return: list of dev_ids
+        """
+        now = time.time()
+        with self.lock:
+            due_dev_ids = [dev_id for dev_id, due_time in self.pending.iteritems() if due_time <= now]
+            for dev_id in due_dev_ids:
+                del self.pending[dev_id]
+        return due_dev_ids
@@ -0,0 +1,234 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Touch Portal [tpReconnectBenchmark] © Autolog & DaveL17 2020
+#
+# Standalone tool (not loaded by Indigo) that times disconnecting a Touch Portal device (plugin.tp_disconnect) and
+# reconnecting it (plugin.tp_connect) until Touch Portal Desktop receives the pair message. A local listener stands
+# in for Touch Portal Desktop and the plugin runs against a fake 'indigo' module (see tpReplay.py).
+#
+# Usage: python tpReconnectBenchmark.py [--cycles n] [--io-engine T|S] [--polling] [--seed n] [--verbose]
+#   --cycles is the number of disconnect / reconnect cycles timed (default 5).
+#   --io-engine is the plugin's 'I/O Engine' - T (reader thread per desktop, default) or S (shared selector).
+#   --polling emulates how the threads stopped before they were woken by stop(): the TP Reader thread only notices
+#     its stop event when its socket wait times out (K_TIMEOUT seconds) and the TP Handler thread only when its
+#     3 second queue poll times out (emulated by queueing its stop sentinel after a random part of 3 seconds).
+#
+
+# noinspection PyUnresolvedReferences
+# ============================== Native Imports ===============================
+import argparse
+import logging
+import random
+import socket
+import sys
+import threading
+import time
+
+from tpReplay import build_fake_indigo
+
+RECONNECT_TP_DEVICE_ID = 1  # Indigo device id of the fake Touch Portal device
+RECONNECT_HANDLER_POLL_SECONDS = 3.0  # Queue poll timeout of the TP Handler thread before it was woken by stop()
+RECONNECT_PAIR_TIMEOUT_SECONDS = 30  # Give up waiting for the pair message after this long
+RECONNECT_INFO_MESSAGE = b'{"type":"info","sdkVersion":2,"tpVersionString":"2.3.010","tpVersionCode":203010,"pluginVersion":1}\n'
+
+
+# noinspection PyUnresolvedReferences,PyPep8Naming,PyPep8
+class FakeTouchPortalDesktop(threading.Thread):
+
+    # This class stands in for Touch Portal Desktop - it accepts the plugin's connections, answers each pair
+    # message with an info message and records when the pair message was received.
+
+    def __init__(self):
+        threading.Thread.__init__(self)
+
+        self.listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.listener.bind(("127.0.0.1", 0))
+        self.listener.listen(5)
+        self.port = self.listener.getsockname()[1]
+        self.paired_condition = threading.Condition()
+        self.pair_times = []
+        self.setDaemon(True)
+
+    # =============================================================================
+    def run(self):
+        while True:
+            connection, _ = self.listener.accept()
+            connection_thread = threading.Thread(target=self.serve, args=(connection,))
+            connection_thread.setDaemon(True)
+            connection_thread.start()
+
+    # =============================================================================
+    def serve(self, connection):
+        received = b""
+        try:
+            while True:
+                data = connection.recv(4096)
+                if not data:
+                    break
+                received += data
+                while b"\n" in received:
+                    message, received = received.split(b"\n", 1)
+                    if b'"pair"' in message:
+                        with self.paired_condition:
+                            self.pair_times.append(time.time())
+                            self.paired_condition.notify_all()
+                        connection.sendall(RECONNECT_INFO_MESSAGE)
+        except socket.error:
+            pass
+        connection.close()
+
+    # =============================================================================
+    def wait_for_pair(self, since, timeout):
+        """
+        Wait for a pair message received after a given time.
+
+        -----
+        :param since: time
+        :param timeout: seconds
+        :return: time the pair message was received or None if timed out
+        """
+        deadline = time.time() + timeout
+        with self.paired_condition:
+            while True:
+                pair_times = [pair_time for pair_time in self.pair_times if pair_time >= since]
+                if pair_times:
+                    return pair_times[0]
+                remaining = deadline - time.time()
+                if remaining <= 0.0:
+                    return None
+                self.paired_condition.wait(remaining)
+
+
+# =============================================================================
+def benchmark(arguments):
+    """
+    Time the disconnect / reconnect cycles and report the wall time of each phase.
+
+    -----
+    :param arguments: parsed command line arguments
+    :return: exit code
+    """
+    indigo = build_fake_indigo(0.0)
+    sys.modules["indigo"] = indigo  # Must be installed before the plugin modules are imported
+
+    from constants import (CMD_STOP_THREAD, K_COALESCE_COMMANDS, K_DEBUG, K_DESKTOP_STATES, K_DUPLICATE_PRESS_MS,
+                           K_HOST, K_INDIGO_WORKER_COUNT, K_IO_ENGINE, K_LAST_RECEIVED, K_LIVENESS_PROBE_SENT,
+                           K_LIVENESS_TIMEOUT, K_MAX_FRAME_SIZE, K_METRICS, K_MONITOR_INDEX, K_PORT, K_QUEUES,
+                           K_QUEUE_CAPACITY, K_RECEIVE_BUFFER_SIZE, K_RECEIVE_FROM_SEND_TO_TP, K_RECONNECT_SCHEDULER,
+                           K_SELECTOR, K_SHOW_MESSAGES, K_SHOW_VARIABLE_VALUE, K_SNAPSHOT_CACHE, K_SOCKETS,
+                           K_SOCKET_RETRY_SECONDS, K_SOCKET_RETRY_SILENT_AFTER, K_TCP_KEEPALIVE, K_TCP_NODELAY,
+                           K_THREADS, K_TIMEOUT, K_TP, K_TP_PLUGIN_INFO, K_TP_PLUGIN_VERSION, K_TRACER,
+                           QUEUE_PRIORITY_STOP, TP_DUPLICATE_PRESS_MS_DEFAULT, TP_INDIGO_WORKERS_DEFAULT,
+                           TP_LIVENESS_TIMEOUT_DEFAULT, TP_MAX_FRAME_SIZE_DEFAULT, TP_QUEUE_CAPACITY_DEFAULT,
+                           TP_RECEIVE_BUFFER_SIZE_DEFAULT, TP_SOCKET_RETRY_DEFAULT,
+                           TP_SOCKET_RETRY_SILENT_AFTER_DEFAULT, TP_SOCKET_TIMEOUT_DEFAULT)
+    import plugin
+    from tpHandler import ThreadTpHandler
+    from tpMetrics import TpMetrics
+    from tpMonitors import TpMonitorIndex
+    from tpQueue import TpQueueEntry
+    from tpReader import ThreadTpReader
+    from tpReconnect import TpReconnectScheduler
+    from tpSnapshots import TpSnapshotCache
+    from tpWriter import TpDesktopStates
+
+    random.seed(arguments.seed)
+
+    if arguments.polling:
+        def polling_reader_stop(reader):
+            reader.thread_stop.set()  # Noticed when the socket wait times out
+
+        def polling_handler_stop(handler):
+            handler.thread_stop.set()
+            handler_queue = handler.globals[K_QUEUES][handler.dev_id][K_RECEIVE_FROM_SEND_TO_TP]
+            sentinel_timer = threading.Timer(random.uniform(0.0, RECONNECT_HANDLER_POLL_SECONDS), handler_queue.put,
+                                             [TpQueueEntry(QUEUE_PRIORITY_STOP, CMD_STOP_THREAD, handler.dev_id, [])])
+            sentinel_timer.setDaemon(True)
+            sentinel_timer.start()
+
+        ThreadTpReader.stop = polling_reader_stop
+        ThreadTpHandler.stop = polling_handler_stop
+
+    desktop = FakeTouchPortalDesktop()
+    desktop.start()
+
+    tp_device = indigo.FakeIndigoObject(RECONNECT_TP_DEVICE_ID, u"Touch Portal Reconnect")
+    indigo.devices[RECONNECT_TP_DEVICE_ID] = tp_device
+
+    # Plugin.__init__ needs an Indigo server - the globals are set up as by Plugin.__init__ and deviceStartComm
+    tp_plugin = plugin.Plugin.__new__(plugin.Plugin)
+    tp_plugin.logger = logging.getLogger("Plugin")
+    metrics = TpMetrics()
+    tp_plugin.globals = {
+        K_TP: {RECONNECT_TP_DEVICE_ID: {
+            K_HOST: "127.0.0.1", K_PORT: desktop.port, K_TIMEOUT: TP_SOCKET_TIMEOUT_DEFAULT,
+            K_RECEIVE_BUFFER_SIZE: int(TP_RECEIVE_BUFFER_SIZE_DEFAULT), K_MAX_FRAME_SIZE: int(TP_MAX_FRAME_SIZE_DEFAULT),
+            K_IO_ENGINE: arguments.io_engine, K_METRICS: metrics, K_TRACER: None,
+            K_DESKTOP_STATES: TpDesktopStates(metrics), K_SHOW_VARIABLE_VALUE: False,
+            K_TCP_KEEPALIVE: False, K_TCP_NODELAY: True, K_LIVENESS_TIMEOUT: int(TP_LIVENESS_TIMEOUT_DEFAULT), K_LAST_RECEIVED: time.time(), K_LIVENESS_PROBE_SENT: None,
+            K_QUEUE_CAPACITY: int(TP_QUEUE_CAPACITY_DEFAULT),
+            K_INDIGO_WORKER_COUNT: int(TP_INDIGO_WORKERS_DEFAULT),
+            K_COALESCE_COMMANDS: False, K_DUPLICATE_PRESS_MS: int(TP_DUPLICATE_PRESS_MS_DEFAULT),
+            K_SOCKET_RETRY_SECONDS: int(TP_SOCKET_RETRY_DEFAULT), K_SOCKET_RETRY_SILENT_AFTER: int(TP_SOCKET_RETRY_SILENT_AFTER_DEFAULT)},
+            K_MONITOR_INDEX: TpMonitorIndex(), K_SNAPSHOT_CACHE: TpSnapshotCache()},
+        K_DEBUG: {K_SHOW_MESSAGES: False},
+        K_TP_PLUGIN_INFO: {K_TP_PLUGIN_VERSION: 1},
+        K_RECONNECT_SCHEDULER: TpReconnectScheduler(),
+        K_SELECTOR: {},
+        K_THREADS: {},
+        K_QUEUES: {},
+        K_SOCKETS: {}
+    }
+    tp_plugin.compile_tp_registry(RECONNECT_TP_DEVICE_ID, None)
+
+    # Initial connection - not timed
+    connect_time = time.time()
+    if not tp_plugin.tp_connect(tp_device) or desktop.wait_for_pair(connect_time, RECONNECT_PAIR_TIMEOUT_SECONDS) is None:
+        print(u"Initial connection to the fake Touch Portal Desktop failed")
+        return 1
+
+    disconnect_ms, reconnect_ms, total_ms = [], [], []
+    for _ in range(arguments.cycles):
+        time.sleep(0.1)  # Let the connection settle so that each cycle starts from an idle connection
+        start_time = time.time()
+        tp_plugin.tp_disconnect(tp_device)
+        disconnected_time = time.time()
+        if not tp_plugin.tp_connect(tp_device):
+            print(u"Reconnection to the fake Touch Portal Desktop failed")
+            return 1
+        pair_time = desktop.wait_for_pair(disconnected_time, RECONNECT_PAIR_TIMEOUT_SECONDS)
+        if pair_time is None:
+            print(u"Pair message not received within {0} seconds of reconnecting".format(RECONNECT_PAIR_TIMEOUT_SECONDS))
+            return 1
+        disconnect_ms.append((disconnected_time - start_time) * 1000.0)
+        reconnect_ms.append((pair_time - disconnected_time) * 1000.0)
+        total_ms.append((pair_time - start_time) * 1000.0)
+
+    tp_plugin.tp_disconnect(tp_device)
+
+    print(u"Timed {0} disconnect / reconnect cycles (I/O engine '{1}', threads stopped by {2})".format(
+        arguments.cycles, arguments.io_engine, u"polling (emulated)" if arguments.polling else u"stop()"))
+    for name, samples in ((u"Disconnect", disconnect_ms), (u"Reconnect to pair", reconnect_ms), (u"Total", total_ms)):
+        print(u"  {0:<20} {1:>10.1f} ms average {2:>10.1f} ms maximum".format(name, sum(samples) / len(samples), max(samples)))
+    return 0
+
+
+# =============================================================================
+def main():
+    parser = argparse.ArgumentParser(description="Time disconnecting and reconnecting a Touch Portal device.")
+    parser.add_argument("--cycles", type=int, default=5, help="disconnect / reconnect cycles timed (default 5)")
+    parser.add_argument("--io-engine", choices=["T", "S"], default="T", help="T = reader thread per desktop (default), S = shared selector")
+    parser.add_argument("--polling", action="store_true", help="emulate the threads noticing a stop by polling (before stop() woke them)")
+    parser.add_argument("--seed", type=int, default=1, help="random seed of the emulated handler polls")
+    parser.add_argument("--verbose", action="store_true", help="show plugin debug logging")
+    arguments = parser.parse_args()
+
+    logging.basicConfig(level=logging.DEBUG if arguments.verbose else logging.WARNING, format="%(name)s %(levelname)s %(message)s")
+
+    return benchmark(arguments)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
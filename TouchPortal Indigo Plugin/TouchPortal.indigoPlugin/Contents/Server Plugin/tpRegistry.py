@@ -0,0 +1,120 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Touch Portal [tpRegistry] © Autolog & DaveL17 2020
+#
+
+# noinspection PyUnresolvedReferences
+# ============================== Native Imports ===============================
+import json
+
+# ============================== Plugin Imports ===============================
+from constants import *
+
+
+# noinspection PyUnresolvedReferences,PyPep8Naming,PyPep8
+class TpRegistryItem(object):
+
+    # This class is one published Touch Portal item (Indigo device, action group or variable) of a Touch Portal device
+
+    __slots__ = ("tp_name", "mode", "indigo_id", "data")
+
+    def __init__(self, tp_name, mode, indigo_id, data):
+
+        self.tp_name = tp_name
+        self.mode = mode  # TP_REGISTRY_MODE_DEVICE, _ACTION_GROUP or _VARIABLE
+        self.indigo_id = indigo_id  # None = id missing, 0 = id invalid
+        self.data = data  # Entry as stored in the 'tp_devices' plugin property
+
+
+# noinspection PyUnresolvedReferences,PyPep8Naming,PyPep8
+class TpRegistry(object):
+
+    # This class is the compiled form of a Touch Portal device's published items (its 'tp_devices' plugin property).
+    # It is built once - when the device starts or its config dialog is saved - and never changed afterwards, so the
+    # TP Handler thread can look up the item of a button press by name without decoding JSON or fetching the plugin
+    # properties from Indigo. A new registry replaces the old one in a single assignment (see plugin.compile_tp_registry).
+    # The items supporting each kind of action are indexed by capability together with the JSON value array of the
+    # Touch Portal list offering them, so that a list refresh needs no filtering or encoding (see choices).
+
+    def __init__(self, tp_devices):
+
+        self.items = {}  # Lowercase TP name: TpRegistryItem
+        self.capabilities = dict((capability, []) for capability in TP_REGISTRY_CHOICES)  # Capability: TP names
+        for tp_name_key, tp_data in tp_devices.iteritems():
+            mode = tp_data.get("mode")
+            indigo_id = None
+            id_key = TP_REGISTRY_ID_KEYS.get(mode)
+            if id_key is not None and id_key in tp_data:
+                try:
+                    indigo_id = int(tp_data[id_key])
+                except (TypeError, ValueError):
+                    indigo_id = 0  # Invalid - never known to Indigo
+            tp_item = TpRegistryItem(tp_data.get("tp_name", tp_name_key), mode, indigo_id, tp_data)
+            self.items[tp_name_key.lower()] = tp_item
+            for capability in self.item_capabilities(tp_item):
+                self.capabilities[capability].append(tp_item.tp_name)
+
+        self.choices = {}  # Capability: JSON value array of a choiceUpdate message
+        for capability, tp_names in self.capabilities.iteritems():
+            tp_names.sort(key=lambda tp_name: tp_name.lower())
+            select_choice, no_choice, refresh_choice = TP_REGISTRY_CHOICES[capability]
+            self.choices[capability] = json.dumps(([select_choice] + tp_names if tp_names else [no_choice]) + [refresh_choice])
+
+    # =============================================================================
+    @staticmethod
+    def item_capabilities(tp_item):
+        """
+        Determine the capabilities (kinds of action supported) of a published item.
+
+        -----
+        :param tp_item: TpRegistryItem
+        :return: list of TP_REGISTRY_CAPABILITY_...
+        """
+        tp_data = tp_item.data
+        if tp_item.mode == TP_REGISTRY_MODE_DEVICE:
+            capabilities = []
+            if bool(tp_data.get("supports_on_off_state", False)):
+                capabilities.append(TP_REGISTRY_CAPABILITY_DEVICE_ON_OFF)
+            if bool(tp_data.get("supports_brightness_state", False)):
+                capabilities.append(TP_REGISTRY_CAPABILITY_DEVICE_BRIGHTNESS)
+            if bool(tp_data.get("supports_colourRGB_state", False)):
+                capabilities.append(TP_REGISTRY_CAPABILITY_DEVICE_RGB)
+            return capabilities
+        elif tp_item.mode == TP_REGISTRY_MODE_ACTION_GROUP:
+            return [TP_REGISTRY_CAPABILITY_ACTION_GROUP]
+        elif tp_item.mode == TP_REGISTRY_MODE_VARIABLE:
+            capabilities = []
+            if bool(tp_data.get("supports_variable_tp_text_state", False)):
+                capabilities.append(TP_REGISTRY_CAPABILITY_VARIABLE_TEXT)
+            if bool(tp_data.get("supports_variable_tp_true_false_state", False)):
+                capabilities.append(TP_REGISTRY_CAPABILITY_VARIABLE_TRUE_FALSE)
+            return capabilities
+        return []
+
+    # =============================================================================
+    @classmethod
+    def from_json(cls, tp_devices_json):
+        """
+        Compile a registry from the 'tp_devices' plugin property.
+
+        -----
+        :param tp_devices_json: JSON dict of the published items (None or "" = no items)
+        :return: TpRegistry
+        """
+        return cls(json.loads(tp_devices_json) if tp_devices_json else {})
+
+    # =============================================================================
+    def __len__(self):
+        return len(self.items)
+
+    # =============================================================================
+    def get(self, tp_name):
+        """
+        Look up a published item by its TP name (case is ignored).
+
+        -----
+        :param tp_name: TP name as sent by Touch Portal Desktop
+        :return: TpRegistryItem or None if not published
+        """
+        return self.items.get(tp_name.lower())
@@ -0,0 +1,433 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Touch Portal [tpReplay] © Autolog & DaveL17 2020
+#
+# Standalone tool (not loaded by Indigo) that replays a Touch Portal traffic capture (see tpCapture.py) through
+# the Touch Portal Handler against a fake 'indigo' module and reports throughput and latency histograms.
+#
+# Usage: python tpReplay.py <capture file> [--speed n] [--burst] [--tp-devices file] [--indigo-call-ms n] [--indigo-lookup-ms n]
+#                            [--indigo-workers n] [--trace] [--verbose]
+#   --speed 1 replays at the original pacing, 10 at ten times the pacing and 0 (default) as fast as possible.
+#   --burst queues every message before the handler is started (the queue is sized to hold them all).
+#   --tp-devices is a JSON file containing the 'tp_devices' plugin property of the captured Touch Portal device.
+#     If omitted, Indigo devices / action groups / variables are created for every name found in the capture.
+#   --indigo-call-ms simulates the time taken by each Indigo command (e.g. indigo.device.turnOn).
+#   --indigo-lookup-ms simulates the time taken to look up an Indigo object (e.g. indigo.devices[dev_id]).
+#   --indigo-workers is the number of Indigo command threads (0 runs the commands on the handler thread).
+#
+
+# noinspection PyUnresolvedReferences
+# ============================== Native Imports ===============================
+import argparse
+import json
+import logging
+import sys
+import threading
+import time
+import types
+
+REPLAY_TP_DEVICE_ID = 1  # Indigo device id of the fake Touch Portal Desktop device
+REPLAY_FIRST_INDIGO_ID = 1001  # First Indigo id allocated to devices / action groups / variables found in the capture
+REPLAY_DRAIN_TIMEOUT_SECONDS = 300  # Give up waiting for the handler to process the replayed messages after this long
+HISTOGRAM_BUCKETS_MS = [0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 25.0, 50.0, 100.0, 250.0, 500.0, 1000.0, 2500.0]
+
+# TP action data ids that name an Indigo device, action group or variable - used to create them from the capture
+TP_NAME_DATA_IDS = {
+    "indigo_device_name_on_off": "D",
+    "indigo_device_name_brightness": "D",
+    "indigo_device_name_rgb": "D",
+    "indigo_action_group_name": "A",
+    "indigo_variable_name_text": "V",
+    "indigo_variable_name_true_false": "V"
+}
+
+
+# =============================================================================
+def build_fake_indigo(indigo_call_seconds, indigo_lookup_seconds=0.0):
+    """
+    Build a module with just enough of the Indigo API for the Touch Portal Handler (and for plugin.py to be imported
+    by tpReconnectBenchmark.py and tpBenchmark.py).
+
+    -----
+    :param indigo_call_seconds: time each Indigo command takes
+    :param indigo_lookup_seconds: time each look up of an Indigo object takes
+    :return: module
+    """
+    indigo = types.ModuleType("indigo")
+
+    class FakeIndigoObject(object):
+        def __init__(self, object_id, name):
+            self.id = object_id
+            self.name = name
+            self.enabled = True
+            self.pluginProps = {}
+            self.states = {}
+            self.onState = False
+            self.brightness = 0
+            self.redLevel = self.greenLevel = self.blueLevel = 0
+            self.supportsRGB = self.supportsColor = True
+            self.value = "false"
+            self.readOnly = False
+
+        def updateStateOnServer(self, key, value, uiValue=None, clearErrorState=False):
+            self.states[key] = value
+
+        def updateStatesOnServer(self, key_value_list):
+            for key_value in key_value_list:
+                self.states[key_value["key"]] = key_value["value"]
+
+        def updateStateImageOnServer(self, image):
+            pass
+
+        def setErrorStateOnServer(self, error):
+            pass
+
+        def replacePluginPropsOnServer(self, plugin_props):
+            self.pluginProps = plugin_props
+
+    class FakeIndigoCollection(dict):
+        def __getitem__(self, object_id):
+            if indigo_lookup_seconds > 0.0:
+                time.sleep(indigo_lookup_seconds)
+            return dict.__getitem__(self, object_id)
+
+        def iter(self, filter_string=""):
+            return iter(self.values())
+
+    class FakeIndigoCommands(object):
+        # Every command (e.g. indigo.device.turnOn) is counted and takes indigo_call_seconds
+        calls = {}
+        lock = threading.Lock()
+
+        def __init__(self, namespace):
+            self.namespace = namespace
+
+        def __getattr__(self, command):
+            command_name = "indigo.{0}.{1}".format(self.namespace, command)
+
+            def fake_command(object_id, *args, **kwargs):
+                if indigo_call_seconds > 0.0:
+                    time.sleep(indigo_call_seconds)
+                if command_name == "indigo.variable.updateValue":
+                    indigo.variables[object_id].value = kwargs.get("value", args[0] if args else "")
+                with FakeIndigoCommands.lock:
+                    FakeIndigoCommands.calls[command_name] = FakeIndigoCommands.calls.get(command_name, 0) + 1
+            return fake_command
+
+    class FakeStateImageSel(object):
+        def __getattr__(self, name):
+            return name
+
+    class FakePluginBase(object):
+        def __del__(self):
+            pass
+
+        def deviceUpdated(self, orig_dev, new_dev):
+            pass
+
+        def variableUpdated(self, orig_var, new_var):
+            pass
+
+    indigo.FakeIndigoObject = FakeIndigoObject
+    indigo.FakeIndigoCommands = FakeIndigoCommands
+    indigo.devices = FakeIndigoCollection()
+    indigo.actionGroups = FakeIndigoCollection()
+    indigo.variables = FakeIndigoCollection()
+    indigo.device = FakeIndigoCommands("device")
+    indigo.dimmer = FakeIndigoCommands("dimmer")
+    indigo.actionGroup = FakeIndigoCommands("actionGroup")
+    indigo.variable = FakeIndigoCommands("variable")
+    indigo.kStateImageSel = FakeStateImageSel()
+    indigo.PluginBase = FakePluginBase
+    return indigo
+
+
+# =============================================================================
+def load_capture(capture_path):
+    """
+    Read a capture file.
+
+    -----
+    :param capture_path:
+    :return: list of (seconds since capture started, direction, message)
+    """
+    captured = []
+    with open(capture_path, "rb") as capture_file:
+        for line in capture_file:
+            line = line.rstrip("\r\n")
+            try:
+                offset, direction, message = line.split(" ", 2)
+                captured.append((float(offset), direction, message))
+            except ValueError:
+                continue  # Not a capture line
+    return captured
+
+
+# =============================================================================
+def create_tp_devices(indigo, messages):
+    """
+    Create a fake Indigo device / action group / variable for every name in the captured actions.
+
+    -----
+    :param indigo: fake indigo module
+    :param messages: captured inbound messages
+    :return: tp_devices dict as stored in the Touch Portal device's 'tp_devices' plugin property
+    """
+    tp_devices = {}
+    next_id = REPLAY_FIRST_INDIGO_ID
+    for message in messages:
+        try:
+            converted_data = json.loads(message)
+        except ValueError:
+            continue
+        if converted_data.get("type") != "action":
+            continue
+        for data_entry in converted_data.get("data", []):
+            mode = TP_NAME_DATA_IDS.get(data_entry.get("id"))
+            tp_name = data_entry.get("value")
+            if mode is None or not tp_name or tp_name.lower() in tp_devices:
+                continue
+            tp_data = {"tp_name": tp_name, "mode": mode}
+            if mode == "D":
+                indigo.devices[next_id] = indigo.FakeIndigoObject(next_id, tp_name)
+                tp_data.update({"dev_id": next_id, "supports_on_off_state": True,
+                                "supports_brightness_state": True, "supports_colourRGB_state": True})
+            elif mode == "A":
+                indigo.actionGroups[next_id] = indigo.FakeIndigoObject(next_id, tp_name)
+                tp_data["action_group_id"] = next_id
+            else:
+                indigo.variables[next_id] = indigo.FakeIndigoObject(next_id, tp_name)
+                tp_data.update({"variable_id": next_id, "supports_variable_tp_text_state": True,
+                                "supports_variable_tp_true_false_state": True})
+            tp_devices[tp_name.lower()] = tp_data
+            next_id += 1
+    return tp_devices
+
+
+# =============================================================================
+def percentile(sorted_samples, percent):
+    if not sorted_samples:
+        return 0.0
+    return sorted_samples[min(len(sorted_samples) - 1, int(len(sorted_samples) * percent / 100.0))]
+
+
+# =============================================================================
+def print_histogram(title, samples):
+    """
+    Print a latency histogram with percentiles.
+
+    -----
+    :param title:
+    :param samples: milliseconds
+    :return:
+    """
+    samples = sorted(samples)
+    print(u"\n{0} ({1} messages)".format(title, len(samples)))
+    if not samples:
+        return
+    print(u"  p50 = {0:.3f} ms, p90 = {1:.3f} ms, p99 = {2:.3f} ms, max = {3:.3f} ms".format(
+        percentile(samples, 50), percentile(samples, 90), percentile(samples, 99), samples[-1]))
+    counts = [0] * (len(HISTOGRAM_BUCKETS_MS) + 1)
+    for sample in samples:
+        bucket = 0
+        while bucket < len(HISTOGRAM_BUCKETS_MS) and sample > HISTOGRAM_BUCKETS_MS[bucket]:
+            bucket += 1
+        counts[bucket] += 1
+    largest_count = max(counts)
+    for bucket, count in enumerate(counts):
+        if bucket < len(HISTOGRAM_BUCKETS_MS):
+            label = u"<= {0:>7} ms".format(HISTOGRAM_BUCKETS_MS[bucket])
+        else:
+            label = u" > {0:>7} ms".format(HISTOGRAM_BUCKETS_MS[-1])
+        print(u"  {0} {1:>8} {2}".format(label, count, "#" * int(round(40.0 * count / largest_count))))
+
+
+# =============================================================================
+def replay(arguments):
+    indigo = build_fake_indigo(arguments.indigo_call_ms / 1000.0, arguments.indigo_lookup_ms / 1000.0)
+    sys.modules["indigo"] = indigo  # Must be installed before the plugin modules are imported
+
+    from constants import (K_DEBUG, K_DESKTOP_STATES, K_DUPLICATE_PRESS_MS, K_INDIGO_WORKERS, K_METRICS, K_MONITOR_INDEX, K_QUEUES,
+                           K_RECEIVE_FROM_SEND_TO_TP, K_SHOW_MESSAGES, K_SHOW_VARIABLE_VALUE, K_SNAPSHOT_CACHE, K_SOCKETS, K_THREAD, K_THREAD_WRITER, K_THREADS, K_TP,
+                           K_TP_PLUGIN_INFO, K_TP_PLUGIN_VERSION, K_TP_REGISTRY, K_TP_SOCKET, K_TRACER, TP_CAPTURE_INBOUND,
+                           TP_CAPTURE_OUTBOUND, TP_QUEUE_CAPACITY_DEFAULT, TP_TRACE_RING_SIZE)
+    from tpHandler import ThreadTpHandler
+    from tpRegistry import TpRegistry
+    from tpWriter import ThreadTpWriter, TpDesktopStates
+    from tpMetrics import TpMetrics
+    from tpMonitors import TpMonitorIndex
+    from tpQueue import TpBoundedPriorityQueue, received_tp_message_entry
+    from tpSnapshots import TpSnapshotCache
+    from tpTrace import TpTracer
+    from tpWorkers import TpIndigoWorkerPool
+
+    class ReplayMetrics(TpMetrics):
+        # Keeps every observation so that histograms can be reported
+        def __init__(self):
+            TpMetrics.__init__(self)
+            self.samples = {}
+
+        def observe(self, key, milliseconds):
+            TpMetrics.observe(self, key, milliseconds)
+            with self.lock:
+                self.samples.setdefault(key, []).append(milliseconds)
+
+    class ReplaySocket(object):
+        # Stands in for the Touch Portal Desktop socket - counts what the handler sends
+        def __init__(self):
+            self.messages_sent = 0
+            self.bytes_sent = 0
+
+        def sendall(self, data):
+            self.messages_sent += data.count("\n")
+            self.bytes_sent += len(data)
+
+    captured = load_capture(arguments.capture_file)
+    inbound = [(offset, message) for offset, direction, message in captured if direction == TP_CAPTURE_INBOUND]
+    captured_outbound_count = len([direction for offset, direction, message in captured if direction == TP_CAPTURE_OUTBOUND])
+    if not inbound:
+        print(u"No inbound messages found in '{0}'".format(arguments.capture_file))
+        return 1
+
+    if arguments.tp_devices is not None:
+        with open(arguments.tp_devices, "rb") as tp_devices_file:
+            tp_devices = json.load(tp_devices_file)
+        for tp_data in tp_devices.values():
+            for id_key, collection in (("dev_id", indigo.devices), ("action_group_id", indigo.actionGroups), ("variable_id", indigo.variables)):
+                if id_key in tp_data:
+                    collection[int(tp_data[id_key])] = indigo.FakeIndigoObject(int(tp_data[id_key]), tp_data["tp_name"])
+    else:
+        tp_devices = create_tp_devices(indigo, [message for offset, message in inbound])
+
+    tp_device = indigo.FakeIndigoObject(REPLAY_TP_DEVICE_ID, "Touch Portal Replay")
+    tp_device.pluginProps["tp_devices"] = json.dumps(tp_devices)
+    indigo.devices[REPLAY_TP_DEVICE_ID] = tp_device
+
+    metrics = ReplayMetrics()
+    replay_socket = ReplaySocket()
+    snapshot_cache = TpSnapshotCache()
+    plugin_globals = {
+        K_TP: {REPLAY_TP_DEVICE_ID: {K_SHOW_VARIABLE_VALUE: False, K_METRICS: metrics, K_DUPLICATE_PRESS_MS: arguments.duplicate_press_ms,
+                                     K_TP_REGISTRY: TpRegistry.from_json(tp_device.pluginProps["tp_devices"]),
+                                     K_DESKTOP_STATES: TpDesktopStates(metrics)},
+               K_MONITOR_INDEX: TpMonitorIndex(), K_SNAPSHOT_CACHE: snapshot_cache},
+        K_DEBUG: {K_SHOW_MESSAGES: False},
+        K_TP_PLUGIN_INFO: {K_TP_PLUGIN_VERSION: 0},
+        K_SOCKETS: {REPLAY_TP_DEVICE_ID: {K_TP_SOCKET: replay_socket}},
+        K_QUEUES: {REPLAY_TP_DEVICE_ID: {K_RECEIVE_FROM_SEND_TO_TP: TpBoundedPriorityQueue(
+            max(int(TP_QUEUE_CAPACITY_DEFAULT), len(inbound)) if arguments.burst else int(TP_QUEUE_CAPACITY_DEFAULT), metrics)}}
+    }
+
+    tracer = TpTracer(max(TP_TRACE_RING_SIZE, len(inbound))) if arguments.trace else None
+    plugin_globals[K_TP][REPLAY_TP_DEVICE_ID][K_TRACER] = tracer
+
+    if arguments.indigo_workers > 0:
+        plugin_globals[K_TP][REPLAY_TP_DEVICE_ID][K_INDIGO_WORKERS] = TpIndigoWorkerPool(arguments.indigo_workers, metrics, REPLAY_TP_DEVICE_ID)
+
+    writer = ThreadTpWriter(plugin_globals, threading.Event(), REPLAY_TP_DEVICE_ID)
+    plugin_globals[K_THREADS] = {REPLAY_TP_DEVICE_ID: {K_THREAD_WRITER: {K_THREAD: writer}}}
+    writer.setDaemon(True)
+    writer.start()
+    writer.connection_established()  # The replay socket stands in for a connected and paired Touch Portal Desktop
+    writer.paired()
+
+    handler = ThreadTpHandler(plugin_globals, threading.Event(), REPLAY_TP_DEVICE_ID)
+
+    # Time how long the handler takes to process each message
+    processed = []
+    process_receive_tp_message = handler.process_receive_tp_message
+
+    def timed_process_receive_tp_message(dev, data_received, converted_data=None):
+        start_time = time.time()
+        process_receive_tp_message(dev, data_received, converted_data)
+        processed.append((time.time() - start_time) * 1000.0)
+    handler.process_receive_tp_message = timed_process_receive_tp_message
+
+    handler.setDaemon(True)
+    if not arguments.burst:
+        handler.start()
+
+    replay_queue = plugin_globals[K_QUEUES][REPLAY_TP_DEVICE_ID][K_RECEIVE_FROM_SEND_TO_TP]
+    first_offset = inbound[0][0]
+    replay_start_time = time.time()
+    for offset, message in inbound:
+        if arguments.speed > 0.0 and not arguments.burst:
+            delay = replay_start_time + (offset - first_offset) / arguments.speed - time.time()
+            if delay > 0.0:
+                time.sleep(delay)
+        replay_queue.put(received_tp_message_entry(REPLAY_TP_DEVICE_ID, message, time.time(), tracer))  # As queued by tpReader
+    if arguments.burst:
+        replay_start_time = time.time()  # Time the handler draining the queued burst
+        handler.start()
+
+    # Wait for the handler to process everything that wasn't dropped / coalesced / shed by the queue
+    drain_deadline = time.time() + REPLAY_DRAIN_TIMEOUT_SECONDS
+    while time.time() < drain_deadline:
+        with metrics.lock:
+            not_processed = metrics.values.get("queue_dropped", 0) + metrics.values.get("queue_coalesced", 0) + metrics.values.get("queue_shed", 0)
+        if len(processed) + not_processed >= len(inbound):
+            break
+        time.sleep(0.001)
+    handler.stop()
+    handler.join(5)
+    if arguments.indigo_workers > 0:
+        plugin_globals[K_TP][REPLAY_TP_DEVICE_ID][K_INDIGO_WORKERS].stop(REPLAY_DRAIN_TIMEOUT_SECONDS)  # Runs the queued Indigo commands
+    while writer.waiting() and time.time() < drain_deadline:  # Let the writer send what the handler queued
+        time.sleep(0.001)
+    writer.stop()
+    writer.join(5)
+    replay_seconds = time.time() - replay_start_time
+
+    captured_seconds = inbound[-1][0] - first_offset
+    print(u"Replayed '{0}'".format(arguments.capture_file))
+    print(u"  Inbound messages:     {0} (captured over {1:.3f} seconds)".format(len(inbound), captured_seconds))
+    print(u"  Processed:            {0}".format(len(processed)))
+    print(u"  Dropped / Coalesced / Shed: {0} / {1} / {2}".format(metrics.values.get("queue_dropped", 0),
+                                                                metrics.values.get("queue_coalesced", 0),
+                                                                metrics.values.get("queue_shed", 0)))
+    print(u"  Duplicate presses ignored: {0}".format(metrics.values.get("actions_duplicates_suppressed", 0)))
+    print(u"  Indigo cache hits / misses: {0} / {1}".format(*snapshot_cache.statistics()))
+    print(u"  Replay time:          {0:.3f} seconds at speed {1}".format(replay_seconds, arguments.speed if arguments.speed > 0.0 else "max"))
+    print(u"  Throughput:           {0:.1f} messages/second".format(len(processed) / max(replay_seconds, 0.000001)))
+    print(u"  Outbound messages:    {0} ({1} bytes) - {2} in capture".format(replay_socket.messages_sent, replay_socket.bytes_sent, captured_outbound_count))
+    for command_name, count in sorted(indigo.FakeIndigoCommands.calls.items()):
+        print(u"  {0:<30} {1}".format(command_name, count))
+
+    print_histogram(u"Queue latency (received -> handler)", metrics.samples.get("receive_latency", []))
+    print_histogram(u"Processing time (handler)", processed)
+    for key in sorted(metrics.samples.keys()):
+        if key.startswith(u"indigo_"):  # e.g. 'indigo_action_group_wait' - see TpIndigoWorkerPool
+            command_type, measurement = key[len(u"indigo_"):].rsplit(u"_", 1)
+            print_histogram(u"Indigo {0} command {1}".format(command_type.replace(u"_", u" "), measurement), metrics.samples[key])
+    if tracer is not None:
+        print(u"\nAction latency traces")
+        for line in tracer.report():
+            print(u"  {0}".format(line))
+    return 0
+
+
+# =============================================================================
+def main():
+    parser = argparse.ArgumentParser(description="Replay a Touch Portal traffic capture through the Touch Portal Handler.")
+    parser.add_argument("capture_file", help="capture file written when 'Capture Touch Portal Traffic' is enabled")
+    parser.add_argument("--speed", type=float, default=0.0, help="1 = original pacing, n = n times faster, 0 = as fast as possible (default)")
+    parser.add_argument("--tp-devices", default=None, help="JSON file of the Touch Portal device's 'tp_devices' plugin property")
+    parser.add_argument("--burst", action="store_true", help="queue every message before starting the handler")
+    parser.add_argument("--indigo-call-ms", type=float, default=0.0, help="simulated duration of each Indigo command in milliseconds")
+    parser.add_argument("--indigo-lookup-ms", type=float, default=0.0, help="simulated duration of each Indigo object look up in milliseconds")
+    parser.add_argument("--indigo-workers", type=int, default=4, help="Indigo command threads (0 = run on the handler thread)")
+    parser.add_argument("--duplicate-press-ms", type=int, default=0,
+                        help="ignore identical toggles within n milliseconds (as 'Ignore Duplicate Presses Within') - "
+                             "off by default as replaying faster than captured brings presses closer together")
+    parser.add_argument("--trace", action="store_true", help="trace the latency of each action (as 'Trace Action Latency')")
+    parser.add_argument("--verbose", action="store_true", help="show plugin debug logging")
+    arguments = parser.parse_args()
+
+    logging.basicConfig(level=logging.DEBUG if arguments.verbose else logging.WARNING, format="%(name)s %(levelname)s %(message)s")
+
+    return replay(arguments)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
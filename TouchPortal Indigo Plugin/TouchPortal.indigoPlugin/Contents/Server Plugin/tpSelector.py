@@ -0,0 +1,396 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Touch Portal [tpSelector] © Autolog & DaveL17 2020
+#
+
+# noinspection PyUnresolvedReferences
+# ============================== Native Imports ===============================
+import errno
+import logging
+import Queue
+import select
+import socket
+import sys
+import threading
+import time
+
+# ============================== Custom Imports ===============================
+try:
+    import indigo
+except ImportError:
+    pass
+
+# ============================== Plugin Imports ===============================
+from constants import *
+from tpFramer import TpLineFramer
+from tpQueue import received_tp_message_entry, TpQueueEntry
+from tpReconnect import backoff_delay
+from tpReader import set_tp_socket_options
+
+# Connection states
+CONNECTION_WAITING = 0  # Waiting to (re)attempt connection
+CONNECTION_CONNECTING = 1  # Non-blocking connect in progress
+CONNECTION_CONNECTED = 2  # Connected and reading
+
+
+class TpSelectorConnection(object):
+
+    # Working storage for one Touch Portal Desktop connection managed by the shared selector
+
+    def __init__(self, dev_id):
+
+        self.dev_id = dev_id
+        self.state = CONNECTION_WAITING
+        self.tp_socket = None
+        self.framer = None
+        self.next_attempt = 0.0
+        self.connect_deadline = 0.0
+        self.retry_count = 0
+
+
+# noinspection PyUnresolvedReferences,PyPep8Naming,PyPep8
+class ThreadTpSelector(threading.Thread):
+
+    # This class reads from every Touch Portal Desktop connection on a single thread
+
+    def __init__(self, pluginGlobals, event):
+
+        threading.Thread.__init__(self)
+
+        self.globals = pluginGlobals
+        self.tps_logger = logging.getLogger("Plugin.TP_SELECTOR")
+        self.tps_logger.debug(u"Debugging Touch Portal Selector Thread")
+        self.thread_stop = event
+
+        self.requests = Queue.Queue()  # Register / Unregister requests from other threads
+        self.connections = {}  # Only accessed by the selector thread
+
+        # Writing a byte to wakeup_send interrupts select() so that requests are actioned immediately
+        self.wakeup_receive, self.wakeup_send = socket.socketpair()
+        self.wakeup_receive.setblocking(0)
+        self.wakeup_send.setblocking(0)
+
+    # =============================================================================
+    def register(self, dev_id):
+        """
+        Start (or restart) managing the connection for a Touch Portal device.
+
+        -----
+        :param dev_id:
+        :return:
+        """
+        self.requests.put((SELECTOR_REGISTER, dev_id))
+        self.wakeup()
+
+    # =============================================================================
+    def unregister(self, dev_id):
+        """
+        Stop managing the connection for a Touch Portal device and close its socket.
+
+        -----
+        :param dev_id:
+        :return:
+        """
+        self.requests.put((SELECTOR_UNREGISTER, dev_id))
+        self.wakeup()
+
+    # =============================================================================
+    def stop(self):
+        self.thread_stop.set()
+        self.wakeup()
+
+    # =============================================================================
+    def wakeup(self):
+        try:
+            self.wakeup_send.send(b"\x00")
+        except socket.error:
+            pass  # Wakeup already pending (socket buffer full) or selector closed
+
+    # =============================================================================
+    def process_requests(self):
+        """
+        Action the Register / Unregister requests queued by other threads.
+        """
+        try:
+            while True:
+                request, dev_id = self.requests.get_nowait()
+                if dev_id in self.connections:
+                    self.close_connection(self.connections[dev_id])
+                    del self.connections[dev_id]
+                if request == SELECTOR_REGISTER:
+                    self.connections[dev_id] = TpSelectorConnection(dev_id)
+                    self.tps_logger.debug(u"Touch Portal device '{0}' registered with selector".format(indigo.devices[dev_id].name))
+        except Queue.Empty:
+            pass
+
+    # =============================================================================
+    def start_connection(self, connection):
+        """
+        Begin a non-blocking connection to Touch Portal Desktop.
+
+        -----
+        :param connection:
+        :return:
+        """
+        dev_id = connection.dev_id
+        try:
+            if dev_id not in self.globals[K_SOCKETS]:
+                self.globals[K_SOCKETS][dev_id] = {}
+            connection.tp_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            connection.tp_socket.setblocking(0)
+            set_tp_socket_options(connection.tp_socket, self.globals[K_TP][dev_id])
+            self.globals[K_SOCKETS][dev_id][K_TP_SOCKET] = connection.tp_socket
+            error_code = connection.tp_socket.connect_ex((self.globals[K_TP][dev_id][K_HOST], self.globals[K_TP][dev_id][K_PORT]))
+        except socket.error as socket_error:
+            error_code = socket_error.errno
+
+        if error_code in (0, errno.EISCONN):
+            self.connection_established(connection)
+        elif error_code in (errno.EINPROGRESS, errno.EALREADY, errno.EWOULDBLOCK):
+            connection.state = CONNECTION_CONNECTING
+            connection.connect_deadline = time.time() + self.globals[K_TP][dev_id][K_TIMEOUT]
+        else:
+            self.connection_failed(connection, error_code)
+
+    # =============================================================================
+    def complete_connection(self, connection):
+        """
+        Non-blocking connect has finished (socket is writable) - check whether it succeeded.
+
+        -----
+        :param connection:
+        :return:
+        """
+        error_code = connection.tp_socket.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+        if error_code == 0:
+            self.connection_established(connection)
+        else:
+            self.connection_failed(connection, error_code)
+
+    # =============================================================================
+    def connection_established(self, connection):
+        dev_id = connection.dev_id
+        dev = indigo.devices[dev_id]
+
+        # Revert to timeout mode so that the TP Writer thread can continue to use sendall on this socket
+        connection.tp_socket.settimeout(self.globals[K_TP][dev_id][K_TIMEOUT])
+        connection.framer = TpLineFramer(self.globals[K_TP][dev_id].get(K_RECEIVE_BUFFER_SIZE, TP_RECEIVE_BUFFER_SIZE_DEFAULT),
+                                         self.globals[K_TP][dev_id].get(K_MAX_FRAME_SIZE, TP_MAX_FRAME_SIZE_DEFAULT))
+        connection.state = CONNECTION_CONNECTED
+        connection.retry_count = 0
+
+        dev.updateStateOnServer("onOffState", True, uiValue="Connected", clearErrorState=True)
+        dev.updateStateImageOnServer(indigo.kStateImageSel.SensorOn)
+        dev.updateStateOnServer("connection_status", "Connected")
+
+        self.globals[K_TP][dev_id][K_LAST_RECEIVED] = time.time()
+        self.globals[K_TP][dev_id][K_LIVENESS_PROBE_SENT] = None
+
+        reconnect_seconds = self.globals[K_RECONNECT_SCHEDULER].connected(dev_id)
+        if reconnect_seconds is not None:
+            dev.updateStateOnServer("reconnect_seconds", round(reconnect_seconds, 1))
+
+        self.tps_logger.info(u"'{0}' now connected to Touch Portal Desktop".format(dev.name))
+
+        # Connected - the TP Writer thread writes from now on but buffers state updates until Touch Portal Desktop
+        # has been paired (see process_receive_tp_message_info)
+        self.globals[K_THREADS][dev_id][K_THREAD_WRITER][K_THREAD].connection_established()
+
+        self.globals[K_QUEUES][dev_id][K_RECEIVE_FROM_SEND_TO_TP].put(
+            TpQueueEntry(QUEUE_PRIORITY_HIGH, CMD_PROCESS_SEND_TP_MESSAGE, dev_id,
+                         ['{"type":"pair", "id":"indigo_domotics_001"}']))
+
+    # =============================================================================
+    def connection_failed(self, connection, error_code):
+        """
+        Connection attempt failed - schedule a retry as per the tpReader retry semantics.
+
+        -----
+        :param connection:
+        :param error_code:
+        :return:
+        """
+        dev_id = connection.dev_id
+        dev = indigo.devices[dev_id]
+
+        self.close_connection(connection)
+
+        if error_code == errno.ECONNREFUSED:
+            socket_error_message = u"Connection failed"
+            socket_error_message_long = u"Connection attempt to Touch Portal Desktop failed; Is it running?"
+        else:
+            socket_error_message = u"Connection failed: {0}".format(error_code)
+            socket_error_message_long = u"Connection to Touch Portal Desktop failed with error: {0}".format(errno.errorcode.get(error_code, error_code))
+
+        dev.updateStateOnServer("connection_status", socket_error_message)
+        dev.setErrorStateOnServer("Connection Error")
+
+        retry_visible_limit = int(self.globals[K_TP][dev_id][K_SOCKET_RETRY_SILENT_AFTER])
+        retry_delay = int(self.globals[K_TP][dev_id][K_SOCKET_RETRY_SECONDS])  # Maximum delay between retries
+
+        if retry_visible_limit >= connection.retry_count:
+            if connection.retry_count == 0:
+                self.tps_logger.warning(socket_error_message_long)
+                self.tps_logger.warning(
+                    u"Will attempt to reconnect to Touch Portal Desktop at increasing intervals of up to {0} seconds"
+                    .format(retry_delay))
+            else:
+                self.tps_logger.warning(u"Connection attempt {0}: {1}"
+                                        .format(connection.retry_count, socket_error_message_long))
+
+            if retry_visible_limit == connection.retry_count:
+                self.tps_logger.warning(
+                    u"Suppressing retry connection messages (logging limit {0} has been reached)"
+                    .format(retry_visible_limit))
+
+        connection.state = CONNECTION_WAITING
+        connection.next_attempt = time.time() + backoff_delay(connection.retry_count, TP_RECONNECT_BACKOFF_BASE_SECONDS, retry_delay)
+        connection.retry_count += 1
+
+    # =============================================================================
+    def connection_lost(self, connection, socket_error_message):
+        """
+        Established connection has been lost - hand over to the socket recovery process.
+
+        -----
+        :param connection:
+        :param socket_error_message:
+        :return:
+        """
+        dev_id = connection.dev_id
+        dev = indigo.devices[dev_id]
+
+        self.close_connection(connection)
+        del self.connections[dev_id]
+
+        dev.updateStateOnServer("onOffState", False, uiValue="Disconnected", clearErrorState=True)
+        dev.updateStateImageOnServer(indigo.kStateImageSel.SensorOff)
+        dev.updateStateOnServer("connection_status", socket_error_message)
+        dev.setErrorStateOnServer("Connection Error")
+
+        # Initiate socket recovery process - wakes runConcurrentThread immediately
+        self.globals[K_RECONNECT_SCHEDULER].request(dev_id)
+
+    # =============================================================================
+    def close_connection(self, connection):
+        if connection.tp_socket is None:
+            return
+        if connection.state == CONNECTION_CONNECTED:
+            tp_writer = self.globals[K_THREADS].get(connection.dev_id, {}).get(K_THREAD_WRITER, {}).get(K_THREAD)
+            if tp_writer is not None:
+                tp_writer.connection_lost()  # Nothing is written to the closed socket
+        try:
+            if connection.state == CONNECTION_CONNECTED:
+                connection.tp_socket.shutdown(socket.SHUT_RDWR)
+        except socket.error:
+            pass  # Ignore Shutdown Socket error - the peer may have already gone
+        try:
+            connection.tp_socket.close()
+        except socket.error as error_msg:
+            self.tps_logger.debug(u"Ignoring Close Socket error for device '{0}': '{1}'"
+                                  .format(indigo.devices[connection.dev_id].name, error_msg))
+        connection.tp_socket = None
+
+    # =============================================================================
+    def read_connection(self, connection):
+        """
+        Socket is readable - queue the complete messages received.
+
+        -----
+        :param connection:
+        :return:
+        """
+        dev_id = connection.dev_id
+        try:
+            bytes_read, data_list = connection.framer.receive(connection.tp_socket)
+        except socket.timeout:
+            return  # Nothing to read after all
+        except socket.error as error_msg:
+            self.tps_logger.error(u"Socket error detected in Touch Portal Plugin [Device '{0}']. Error='{1}'"
+                                  .format(indigo.devices[dev_id].name, error_msg))
+            self.connection_lost(connection, u"'{0}'".format(error_msg))
+            return
+
+        if bytes_read == 0:
+            self.tps_logger.warning(u"Communication with Touch Portal Desktop has been lost!")
+            self.connection_lost(connection, "Communication has been lost")
+            return
+
+        received_time = time.time()
+        self.globals[K_TP][dev_id][K_LAST_RECEIVED] = received_time  # See check_tp_liveness in plugin
+        capture = self.globals[K_TP][dev_id].get(K_CAPTURE)
+        tracer = self.globals[K_TP][dev_id].get(K_TRACER)
+        for data in data_list:
+            self.tps_logger.debug(u"RECEIVED DATA BEING QUEUED: {0}".format(data))
+            if capture is not None:
+                capture.record(TP_CAPTURE_INBOUND, data)
+
+            # Never waits for queue space - a desktop whose handler is falling behind mustn't hold up the other desktops
+            self.globals[K_QUEUES][dev_id][K_RECEIVE_FROM_SEND_TO_TP].put(received_tp_message_entry(dev_id, data, received_time, tracer), False)
+
+    # =============================================================================
+    def run(self):
+        """
+        Run thread.
+        """
+        self.tps_logger.debug(u"Touch Portal Selector Thread initialised")
+
+        while not self.thread_stop.is_set():
+            # noinspection PyPep8,PyBroadException
+            try:
+                self.process_requests()
+
+                # Start any connection attempts that are due and time out any that have taken too long
+                now = time.time()
+                for connection in self.connections.values():
+                    if connection.state == CONNECTION_WAITING and connection.next_attempt <= now:
+                        self.start_connection(connection)
+                    elif connection.state == CONNECTION_CONNECTING and connection.connect_deadline <= now:
+                        self.connection_failed(connection, errno.ETIMEDOUT)
+
+                read_list = [self.wakeup_receive]
+                write_list = []
+                socket_connections = {}
+                wait_until = None
+                for connection in self.connections.values():
+                    if connection.state == CONNECTION_CONNECTED:
+                        read_list.append(connection.tp_socket)
+                        socket_connections[connection.tp_socket] = connection
+                    elif connection.state == CONNECTION_CONNECTING:
+                        write_list.append(connection.tp_socket)
+                        socket_connections[connection.tp_socket] = connection
+                        if wait_until is None or connection.connect_deadline < wait_until:
+                            wait_until = connection.connect_deadline
+                    elif wait_until is None or connection.next_attempt < wait_until:
+                        wait_until = connection.next_attempt
+
+                timeout = None if wait_until is None else max(0.0, wait_until - time.time())
+
+                readable, writable, _ = select.select(read_list, write_list, [], timeout)
+
+                for tp_socket in writable:
+                    self.complete_connection(socket_connections[tp_socket])
+
+                for tp_socket in readable:
+                    if tp_socket is self.wakeup_receive:
+                        try:
+                            while self.wakeup_receive.recv(4096):
+                                pass  # Drain wakeup bytes
+                        except socket.error:
+                            pass
+                    elif socket_connections[tp_socket].state == CONNECTION_CONNECTED:
+                        self.read_connection(socket_connections[tp_socket])
+
+            except StandardError as standard_error_message:
+                self.tps_logger.error(u"StandardError detected in TP Selector Thread. Line '{0}' has error='{1}'"
+                                      .format(sys.exc_traceback.tb_lineno, standard_error_message))
+                time.sleep(1)  # Avoid a tight error loop
+
+        for connection in self.connections.values():
+            self.close_connection(connection)
+        self.connections = {}
+        self.wakeup_receive.close()
+        self.wakeup_send.close()
+
+        self.tps_logger.debug(u"Touch Portal Selector Thread Ended")
@@ -0,0 +1,131 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Touch Portal [tpSnapshots] © Autolog & DaveL17 2020
+#
+
+# noinspection PyUnresolvedReferences
+# ============================== Native Imports ===============================
+import threading
+
+# ============================== Custom Imports ===============================
+try:
+    import indigo
+except ImportError:
+    pass
+
+# ============================== Plugin Imports ===============================
+from constants import *
+
+
+# noinspection PyUnresolvedReferences,PyPep8Naming,PyPep8
+class TpSnapshot(object):
+
+    # This class is an Indigo device, variable or action group reduced to the fields used by the plugin. Attributes
+    # are named as in the Indigo object so that either can be passed to the same code (e.g. TP_MONITOR_DEVICE_STATES);
+    # those the Indigo object doesn't have are None.
+
+    __slots__ = ("id", "name", "onState", "brightness", "redLevel", "greenLevel", "blueLevel", "supportsRGB",
+                 "supportsColor", "readOnly", "value")
+
+    def __init__(self, indigo_object):
+
+        for attribute in self.__slots__:
+            setattr(self, attribute, getattr(indigo_object, attribute, None))
+
+
+# noinspection PyUnresolvedReferences,PyPep8Naming,PyPep8
+class TpSnapshotCache(object):
+
+    # This class caches snapshots of the Indigo devices, variables and action groups used by the TP Handler threads
+    # so that validating an action or refreshing states doesn't fetch the Indigo object from the server each time.
+    # A snapshot is fetched the first time it is needed and then kept up to date by the plugin's Indigo change
+    # callbacks (deviceUpdated, variableUpdated, actionGroupUpdated); it is dropped when the object is created or
+    # deleted. Only objects already cached (or being fetched) are updated - checked under the lock, so that a change
+    # made whilst an object is being fetched by a TP Handler or Indigo command thread is not lost. A change to any other
+    # object costs a frozenset lookup and no lock (see watched).
+
+    def __init__(self):
+
+        self.lock = threading.Lock()  # Serialises the hit / miss counters and the changes made by the Indigo callbacks
+        self.snapshots = dict((collection, {}) for collection in TP_SNAPSHOT_COLLECTIONS)  # Collection: {Indigo id: TpSnapshot}
+        self.fetching = set()  # (collection, Indigo id) being fetched - a change meanwhile is cached rather than lost
+        self.watched = dict((collection, frozenset()) for collection in TP_SNAPSHOT_COLLECTIONS)  # Collection: Indigo ids cached or being fetched
+        self.hits = 0
+        self.misses = 0
+
+    # =============================================================================
+    def get(self, collection, indigo_id):
+        """
+        Return the snapshot of an Indigo object, fetching it from Indigo if not cached.
+
+        -----
+        :param collection: TP_SNAPSHOT_DEVICES, _VARIABLES or _ACTION_GROUPS
+        :param indigo_id: Indigo id
+        :return: TpSnapshot or None if not known to Indigo
+        """
+        snapshots = self.snapshots[collection]
+        snapshot = snapshots.get(indigo_id)
+        with self.lock:
+            if snapshot is not None:
+                self.hits += 1
+                return snapshot
+            self.misses += 1
+
+            fetching_key = (collection, indigo_id)
+            self.fetching.add(fetching_key)
+            self.watch(collection)
+        snapshot = None
+        try:
+            indigo_objects = getattr(indigo, collection)
+            if indigo_id not in indigo_objects:
+                return None  # Not cached so that the object is found once created
+            snapshot = TpSnapshot(indigo_objects[indigo_id])
+        finally:
+            with self.lock:
+                self.fetching.discard(fetching_key)
+                if snapshot is not None:
+                    snapshot = snapshots.setdefault(indigo_id, snapshot)  # A change cached meanwhile is newer than the fetch
+                self.watch(collection)
+        return snapshot
+
+    # =============================================================================
+    def watch(self, collection):
+        # Must be called holding self.lock - replaces (rather than changes) the frozenset so that update can test it
+        # without the lock
+        self.watched[collection] = frozenset(self.snapshots[collection]).union(
+            indigo_id for fetching_collection, indigo_id in self.fetching if fetching_collection == collection)
+
+    # =============================================================================
+    def update(self, collection, indigo_object):
+        """
+        Replace the snapshot of a changed Indigo object (if cached).
+
+        -----
+        :param collection: TP_SNAPSHOT_DEVICES, _VARIABLES or _ACTION_GROUPS
+        :param indigo_object: Indigo object as changed
+        :return:
+        """
+        if indigo_object.id not in self.watched[collection]:
+            return  # Neither cached nor being fetched - the lock isn't needed
+        snapshots = self.snapshots[collection]
+        with self.lock:  # Checked and replaced together so that a change made whilst the object is fetched isn't lost
+            if indigo_object.id in snapshots or (collection, indigo_object.id) in self.fetching:
+                snapshots[indigo_object.id] = TpSnapshot(indigo_object)
+
+    # =============================================================================
+    def invalidate(self, collection, indigo_id):
+        with self.lock:
+            if self.snapshots[collection].pop(indigo_id, None) is not None:
+                self.watch(collection)
+
+    # =============================================================================
+    def statistics(self):
+        """
+        Return the lookups since the plugin started.
+
+        -----
+        :return: (hits, misses)
+        """
+        with self.lock:
+            return self.hits, self.misses
@@ -0,0 +1,150 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Touch Portal [tpTrace] © Autolog & DaveL17 2020
+#
+
+# noinspection PyUnresolvedReferences
+# ============================== Native Imports ===============================
+import collections
+import math
+import threading
+import time
+
+# ============================== Plugin Imports ===============================
+from constants import *
+
+
+# =============================================================================
+def percentile(sorted_values, percent):
+    # Nearest rank percentile of a sorted (non-empty) list
+    return sorted_values[max(0, min(len(sorted_values) - 1, int(math.ceil(percent / 100.0 * len(sorted_values))) - 1))]
+
+
+# noinspection PyUnresolvedReferences,PyPep8Naming,PyPep8
+class TpTrace(object):
+
+    # This class is the trace of one Touch Portal action (button press) - the time it reached each stage from being
+    # received to its Indigo command ending and the resulting state update being sent (see TP_TRACE_STAGES).
+
+    __slots__ = ("tracer", "action_id", "stamps")
+
+    def __init__(self, tracer, action_id, received_time):
+
+        self.tracer = tracer
+        self.action_id = action_id
+        self.stamps = [None] * TP_TRACE_STAMP_COUNT
+        self.stamps[TP_TRACE_RECEIVED] = received_time
+
+    # =============================================================================
+    def stamp(self, stage_stamp):
+        self.stamps[stage_stamp] = time.time()
+
+    # =============================================================================
+    def finished(self, target_id):
+        """
+        The Indigo command of the action has ended - record the trace.
+
+        -----
+        :param target_id: Indigo id of the device, action group or variable actioned
+        :return:
+        """
+        self.stamps[TP_TRACE_INDIGO_END] = time.time()
+        self.tracer.record(self, target_id)
+
+
+# noinspection PyUnresolvedReferences,PyPep8Naming,PyPep8
+class TpTracer(object):
+
+    # This class keeps the most recent traces of a Touch Portal device's actions in a ring buffer so that the time
+    # spent in each stage can be reported as percentiles (see report and publish). Tracing is optional as it adds a
+    # little work to every action - see the device's 'Trace Action Latency' option.
+
+    def __init__(self, ring_size):
+
+        self.lock = threading.Lock()
+        self.ring = collections.deque(maxlen=ring_size)  # Most recent finished traces
+        self.awaiting_echo = {}  # Indigo target id: trace waiting for the resulting state update to be sent
+
+    # =============================================================================
+    def start(self, action_id, received_time):
+        return TpTrace(self, action_id, received_time)
+
+    # =============================================================================
+    def record(self, trace, target_id):
+        with self.lock:
+            self.ring.append(trace)
+            self.awaiting_echo[target_id] = trace
+
+    # =============================================================================
+    def echo(self, target_id):
+        """
+        A state update has been sent for an Indigo device or variable - complete the trace of the action that
+        changed it (if any).
+
+        -----
+        :param target_id: Indigo id of the device or variable
+        :return:
+        """
+        with self.lock:
+            trace = self.awaiting_echo.pop(target_id, None)
+            if trace is not None and time.time() - trace.stamps[TP_TRACE_INDIGO_END] <= TP_TRACE_ECHO_SECONDS:
+                trace.stamp(TP_TRACE_ECHOED)
+
+    # =============================================================================
+    def percentiles(self):
+        """
+        Calculate the percentiles of each stage and of the total time of each action id from the traces in the ring.
+
+        -----
+        :return: ({stage: (count, p50, p95, p99)}, {action id: (count, p50, p95, p99)}) - times in milliseconds
+        """
+        with self.lock:
+            traces = [list(trace.stamps) + [trace.action_id] for trace in self.ring]
+            self.awaiting_echo = dict((target_id, trace) for target_id, trace in self.awaiting_echo.iteritems()
+                                      if time.time() - trace.stamps[TP_TRACE_INDIGO_END] <= TP_TRACE_ECHO_SECONDS)
+
+        stage_times = collections.defaultdict(list)
+        action_times = collections.defaultdict(list)
+        for stamps in traces:
+            for stage, from_stamp, to_stamp in TP_TRACE_STAGES:
+                if stamps[from_stamp] is not None and stamps[to_stamp] is not None:
+                    stage_times[stage].append((stamps[to_stamp] - stamps[from_stamp]) * 1000.0)
+            action_times[stamps[-1]].append((stamps[TP_TRACE_INDIGO_END] - stamps[TP_TRACE_RECEIVED]) * 1000.0)
+
+        results = []
+        for times in (stage_times, action_times):
+            result = {}
+            for key, values in times.iteritems():
+                values.sort()
+                result[key] = (len(values), percentile(values, 50), percentile(values, 95), percentile(values, 99))
+            results.append(result)
+        return results[0], results[1]
+
+    # =============================================================================
+    def publish(self, metrics):
+        stage_percentiles, _ = self.percentiles()
+        for stage, _, _ in TP_TRACE_STAGES:
+            count, p50, p95, p99 = stage_percentiles.get(stage, (0, 0.0, 0.0, 0.0))
+            metrics.set(u"trace_{0}_p50_ms".format(stage), round(p50, 1))
+            metrics.set(u"trace_{0}_p95_ms".format(stage), round(p95, 1))
+            metrics.set(u"trace_{0}_p99_ms".format(stage), round(p99, 1))
+
+    # =============================================================================
+    def report(self):
+        """
+        Report the stage and action id percentiles as lines of text.
+
+        -----
+        :return: list of lines
+        """
+        stage_percentiles, action_percentiles = self.percentiles()
+        lines = [u"{0:<40} {1:>7} {2:>10} {3:>10} {4:>10}".format(u"Stage", u"Count", u"p50 ms", u"p95 ms", u"p99 ms")]
+        for stage, _, _ in TP_TRACE_STAGES:
+            if stage in stage_percentiles:
+                lines.append(u"{0:<40} {1:>7} {2:>10.2f} {3:>10.2f} {4:>10.2f}".format(stage, *stage_percentiles[stage]))
+        lines.append(u"")
+        lines.append(u"{0:<40} {1:>7} {2:>10} {3:>10} {4:>10}".format(u"Action (received -> Indigo command ended)", u"Count", u"p50 ms", u"p95 ms", u"p99 ms"))
+        for action_id in sorted(action_percentiles):
+            lines.append(u"{0:<40} {1:>7} {2:>10.2f} {3:>10.2f} {4:>10.2f}".format(u"{0}".format(action_id), *action_percentiles[action_id]))
+        return lines
@@ -0,0 +1,116 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Touch Portal [tpWorkers] © Autolog & DaveL17 2020
+#
+
+# noinspection PyUnresolvedReferences
+# ============================== Native Imports ===============================
+import logging
+import Queue
+import sys
+import threading
+import time
+
+# ============================== Plugin Imports ===============================
+from constants import *
+
+
+# noinspection PyUnresolvedReferences,PyPep8Naming,PyPep8
+class TpIndigoWorkerPool(object):
+
+    # This class runs the Indigo commands of a Touch Portal device's actions (e.g. indigo.actionGroup.execute) so that
+    # a slow command doesn't hold up the TP Handler thread. Each worker has its own queue and every command for the
+    # same Indigo device, action group or variable goes to the same worker, so commands for a target run in the order
+    # they were received whilst commands for different targets run concurrently.
+    # A command can be merged into the last command queued for its target (e.g. successive brightness sets) as long
+    # as that command hasn't started - see submit.
+
+    def __init__(self, worker_count, metrics, dev_id):
+
+        self.tpw_logger = logging.getLogger("Plugin.TP_HANDLER")
+        self.metrics = metrics
+        self.worker_queues = []
+        self.workers = []
+        self.lock = threading.Lock()
+        self.last_queued = {}  # target_id: last work queued for the target whilst it has not started
+
+        for worker_number in range(max(1, worker_count)):
+            worker_queue = Queue.Queue()
+            worker = threading.Thread(target=self.run_worker, args=(worker_queue,),
+                                      name=u"TpIndigoWorker-{0}-{1}".format(dev_id, worker_number))
+            worker.setDaemon(True)  # Forces thread to close if plugin is reloaded
+            self.worker_queues.append(worker_queue)
+            self.workers.append(worker)
+            worker.start()
+
+    # =============================================================================
+    def submit(self, target_id, command_type, command, args, coalesce_key=None, coalesce=None, trace=None):
+        """
+        Queue an Indigo command to be run by the worker for its target.
+        If the last command queued for the target hasn't started and has the same coalesce key, the two are merged
+        by calling coalesce(queued command, queued args, command, args) which returns the merged (command, args) or
+        None if they can't be merged.
+
+        -----
+        :param target_id: Indigo id of the device, action group or variable (ids are unique across all three)
+        :param command_type: TP_INDIGO_COMMAND_TYPE_DEVICE, _ACTION_GROUP or _VARIABLE - metrics are kept by type
+        :param command: callable
+        :param args: tuple of arguments of the callable
+        :param coalesce_key: commands with the same key can be merged (None = never merged)
+        :param coalesce: callable merging two commands
+        :param trace: TpTrace of the action (whilst tracing) - not recorded if the command is merged
+        :return:
+        """
+        with self.lock:
+            queued_work = self.last_queued.get(target_id)
+            if coalesce_key is not None and queued_work is not None and queued_work[5] == coalesce_key:
+                merged = coalesce(queued_work[2], queued_work[3], command, args)
+                if merged is not None:
+                    queued_work[2], queued_work[3] = merged
+                    self.metrics.increment("indigo_commands_coalesced")
+                    return
+
+            work = [target_id, command_type, command, args, time.time(), coalesce_key, trace]
+            self.last_queued[target_id] = work
+        self.worker_queues[hash(target_id) % len(self.worker_queues)].put(work)
+
+    # =============================================================================
+    def run_worker(self, worker_queue):
+        while True:
+            work = worker_queue.get()
+            if work is None:
+                break  # Stop sentinel - see stop
+            with self.lock:
+                target_id, command_type, command, args, submitted_time, coalesce_key, trace = work
+                if self.last_queued.get(target_id) is work:
+                    del self.last_queued[target_id]  # Started - can no longer be merged with
+
+            start_time = time.time()
+            self.metrics.observe(u"indigo_{0}_wait".format(command_type), (start_time - submitted_time) * 1000.0)
+            if trace is not None:
+                trace.stamps[TP_TRACE_INDIGO_START] = start_time
+            try:
+                command(*args)
+            except StandardError as standard_error_message:
+                self.tpw_logger.error(u"StandardError detected in TP Indigo Worker Thread. Line '{0}' has error='{1}'"
+                                      .format(sys.exc_traceback.tb_lineno, standard_error_message))
+            if trace is not None:
+                trace.finished(target_id)
+            self.metrics.observe(u"indigo_{0}_execute".format(command_type), (time.time() - start_time) * 1000.0)
+
+    # =============================================================================
+    def stop(self, timeout=None):
+        """
+        Stop the workers once the commands already queued have been run.
+
+        -----
+        :param timeout: seconds to wait for the workers to finish (None = don't wait)
+        :return:
+        """
+        for worker_queue in self.worker_queues:
+            worker_queue.put(None)
+        if timeout is not None:
+            deadline = time.time() + timeout
+            for worker in self.workers:
+                worker.join(max(0.0, deadline - time.time()))
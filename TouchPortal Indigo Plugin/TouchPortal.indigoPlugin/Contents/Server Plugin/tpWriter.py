@@ -0,0 +1,370 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Touch Portal [tpWriter] © Autolog & DaveL17 2020
+#
+
+# noinspection PyUnresolvedReferences
+# ============================== Native Imports ===============================
+import collections
+import errno
+import json
+import logging
+import socket
+import sys
+import threading
+import time
+
+# ============================== Plugin Imports ===============================
+from constants import *
+
+# Errors of a write to a connection which has been lost (or is being closed) - see ThreadTpWriter.write_failed
+TP_WRITER_CONNECTION_LOST_ERRNOS = (errno.EPIPE, errno.ENOTCONN, errno.ECONNRESET, errno.ECONNABORTED, errno.ETIMEDOUT, errno.EBADF)
+
+
+# noinspection PyUnresolvedReferences,PyPep8Naming,PyPep8
+class TpDesktopStates(object):
+
+    # This class is what a Touch Portal Desktop has been sent of the plugin's states: the latest value of each state
+    # (so unchanged updates are not resent). Whilst the desktop is disconnected updates are only recorded. A reconnection
+    # can't tell whether Touch Portal Desktop itself has been restarted and lost every state value, so the latest value of
+    # every state is sent each time it has been paired. It lasts for as long as the Indigo Touch Portal device is started
+    # so that it survives the reconnections which replace the TP Writer thread.
+
+    def __init__(self, metrics):
+
+        self.lock = threading.Lock()  # Used by the TP Writer thread and every thread sending state updates
+        self.metrics = metrics
+        self.sent = {}  # Touch Portal state id: latest value sent (or to be sent once paired)
+        self.connected = False  # Updates are only sent once Touch Portal Desktop has been paired - see paired
+
+    # =============================================================================
+    def update(self, state_id, state_value):
+        """
+        Record a state update.
+
+        -----
+        :param state_id: Touch Portal state id
+        :param state_value: value (string)
+        :return: True if the update should be sent now, False if unchanged or recorded whilst disconnected
+        """
+        with self.lock:
+            if self.sent.get(state_id) == state_value:
+                self.metrics.increment("state_cache_hits")
+                return False
+            self.sent[state_id] = state_value
+            self.metrics.increment("state_cache_misses")
+            if self.connected:
+                return True
+            self.metrics.increment("states_buffered")
+            return False
+
+    # =============================================================================
+    def clear(self):
+        with self.lock:
+            self.sent.clear()
+
+    # =============================================================================
+    def disconnected(self):
+        with self.lock:
+            self.connected = False
+
+    # =============================================================================
+    def paired(self):
+        """
+        Touch Portal Desktop has been paired - updates are sent from now on.
+
+        -----
+        :return: [(state id, value)] the latest value of every state, to be sent
+        """
+        with self.lock:
+            self.connected = True
+            return self.sent.items()
+
+
+# noinspection PyUnresolvedReferences,PyPep8Naming,PyPep8
+class ThreadTpWriter(threading.Thread):
+
+    # This class owns the write side of a Touch Portal device's socket. Every message to be sent to Touch Portal
+    # Desktop is queued by send() (from the handler, Indigo callbacks, etc.) and the thread writes all the messages
+    # waiting with a single sendall, so callers never block on a slow desktop and writes can't interleave.
+    # Messages are queued in one of two lanes: interactive messages (responses to the user, state changes) are always
+    # written first whilst bulk messages (refreshes of every state) are written in paced chunks in between.
+    # State updates go through the device's TpDesktopStates so that unchanged values are not resent and every state is
+    # sent again when Touch Portal Desktop has been paired after a reconnection - see send_state_update and paired.
+    # Nothing is written until the TP Reader / Selector thread has established the connection - see connection_established.
+
+    def __init__(self, pluginGlobals, event, touchPortalDeviceId):
+
+        threading.Thread.__init__(self)
+
+        self.globals = pluginGlobals
+        self.dev_id = touchPortalDeviceId
+        self.tpw_logger = logging.getLogger("Plugin.TP_WRITER")
+        self.tpw_logger.debug(u"Debugging Touch Portal Writer Thread")
+        self.thread_stop = event
+
+        self.outbound_condition = threading.Condition()
+        self.outbound = []  # Interactive messages waiting to be sent (without line terminators): [message, queued time]
+        self.outbound_bulk = collections.OrderedDict()  # Bulk messages waiting: state id (or unique key): [message, queued time]
+        self.bulk_write_time = 0.0  # Earliest time for the next bulk write - see TP_OUTBOUND_BULK_PACE_SECONDS
+        self.corked = 0  # Whilst non-zero, messages are held so that they are written together - see cork
+        self.established = False  # Messages are held until the connection has been established - see connection_established
+        self.desktop_states = self.globals[K_TP][touchPortalDeviceId][K_DESKTOP_STATES]
+
+    # =============================================================================
+    def clear_state_cache(self):
+        """
+        Forget the state values sent so that the next update of every state is sent.
+        Called when a refresh of the plugin states is requested.
+
+        -----
+        :return:
+        """
+        self.desktop_states.clear()
+
+    # =============================================================================
+    def cork(self):
+        """
+        Hold the messages queued from now on until uncork is called, so that they are written together.
+        Used by the TP Handler thread around each batch of queue entries it processes.
+
+        -----
+        :return:
+        """
+        with self.outbound_condition:
+            self.corked += 1
+
+    # =============================================================================
+    def uncork(self):
+        with self.outbound_condition:
+            self.corked -= 1
+            self.outbound_condition.notify()
+
+    # =============================================================================
+    def connection_established(self):
+        """
+        Write messages from now on but only record state updates until Touch Portal Desktop has been paired (see paired).
+        Called by the TP Reader / Selector thread once its connection attempt has completed, before the pair message is
+        queued. Messages held until now weren't meant for this connection and are dropped - the latest value of each
+        state is sent once paired.
+
+        -----
+        :return:
+        """
+        self.desktop_states.disconnected()
+        with self.outbound_condition:
+            held_messages = [queued[0] for queued in self.outbound + self.outbound_bulk.values()]
+            self.outbound, self.outbound_bulk = [], collections.OrderedDict()
+            self.established = True
+            self.outbound_condition.notify()
+        if held_messages:
+            self.tpw_logger.debug(u"Connection established: {0} message(s) held whilst connecting not sent".format(len(held_messages)))
+
+    # =============================================================================
+    def connection_lost(self):
+        """
+        Hold messages (and only record state updates) until the connection has been established again.
+        Called by the TP Reader / Selector thread when it closes the connection and by this thread when a write fails.
+
+        -----
+        :return:
+        """
+        self.desktop_states.disconnected()
+        with self.outbound_condition:
+            self.established = False
+
+    # =============================================================================
+    def paired(self):
+        """
+        Send the latest value of every state (in the bulk lane) now that Touch Portal Desktop has been paired - it may
+        have been restarted whilst disconnected and have lost them.
+
+        -----
+        :return:
+        """
+        queued_time = time.time()
+        with self.outbound_condition:
+            # Queued before any update made from now on, so that an older value can't be written after a newer one
+            states = self.desktop_states.paired()
+            for state_id, state_value in states:
+                self.queue(json.dumps({"type": "stateUpdate", "id": state_id, "value": state_value}),
+                           TP_OUTBOUND_LANE_BULK, state_id, queued_time)
+            self.outbound_condition.notify()
+        if states:
+            metrics = self.globals[K_TP][self.dev_id].get(K_METRICS)
+            if metrics is not None:
+                metrics.increment("states_flushed", len(states))
+        self.tpw_logger.debug(u"Touch Portal Desktop paired: {0} state update(s) sent".format(len(states)))
+
+    # =============================================================================
+    def queue(self, message_to_send, lane, state_id, queued_time):
+        """
+        Queue a message in a lane. Must be called holding self.outbound_condition.
+
+        -----
+        :param message_to_send: message without its line terminator
+        :param lane: TP_OUTBOUND_LANE_INTERACTIVE or TP_OUTBOUND_LANE_BULK
+        :param state_id: Touch Portal state id if a stateUpdate message, otherwise None
+        :param queued_time:
+        :return:
+        """
+        if lane == TP_OUTBOUND_LANE_BULK:
+            # A state already waiting in the bulk lane keeps its place but takes the new value
+            self.outbound_bulk[state_id if state_id is not None else object()] = [message_to_send, queued_time]
+        else:
+            self.outbound.append([message_to_send, queued_time])
+            if state_id is not None and state_id in self.outbound_bulk:
+                # Sending the bulk update after this one would put the state back to an older value
+                del self.outbound_bulk[state_id]
+                metrics = self.globals[K_TP][self.dev_id].get(K_METRICS)
+                if metrics is not None:
+                    metrics.increment("outbound_bulk_superseded")
+
+    # =============================================================================
+    def send(self, message_to_send, lane=TP_OUTBOUND_LANE_INTERACTIVE, state_id=None):
+        """
+        Queue a message to be sent to Touch Portal Desktop.
+
+        -----
+        :param message_to_send: message without its line terminator
+        :param lane: TP_OUTBOUND_LANE_INTERACTIVE or TP_OUTBOUND_LANE_BULK
+        :param state_id: Touch Portal state id if a stateUpdate message
+        :return:
+        """
+        with self.outbound_condition:
+            self.queue(message_to_send, lane, state_id, time.time())
+            self.outbound_condition.notify()
+
+    # =============================================================================
+    def send_state_update(self, state_id, state_value, lane=TP_OUTBOUND_LANE_INTERACTIVE):
+        """
+        Queue a stateUpdate message for a Touch Portal state unless its value is unchanged since it was last sent.
+        Whilst Touch Portal Desktop is disconnected the update is only recorded, to be sent once paired (see TpDesktopStates).
+
+        -----
+        :param state_id: Touch Portal state id
+        :param state_value: value - sent as a string
+        :param lane: TP_OUTBOUND_LANE_INTERACTIVE or TP_OUTBOUND_LANE_BULK
+        :return: True if the message was queued, False if it was unchanged or only recorded
+        """
+        state_value = u"{0}".format(state_value)
+        with self.outbound_condition:
+            # Recorded and queued together so that updates of a state from different threads are queued in the order
+            # recorded - otherwise the last value recorded could be overwritten by an earlier one and never corrected
+            if not self.desktop_states.update(state_id, state_value):
+                return False
+            self.queue(json.dumps({"type": "stateUpdate", "id": state_id, "value": state_value}), lane, state_id, time.time())
+            self.outbound_condition.notify()
+        return True
+
+    # =============================================================================
+    def waiting(self):
+        with self.outbound_condition:
+            return len(self.outbound) + len(self.outbound_bulk)
+
+    # =============================================================================
+    def stop(self):
+        self.thread_stop.set()
+        with self.outbound_condition:
+            self.outbound_condition.notify()
+
+    # =============================================================================
+    def handle_communication(self):
+        """
+        Write the queued messages to the Touch Portal Desktop socket.
+
+        -----
+        :return:
+        """
+        dev_id = self.dev_id
+
+        while True:
+            with self.outbound_condition:
+                while not self.thread_stop.is_set():
+                    if self.corked or not self.established:
+                        self.outbound_condition.wait()  # Woken by uncork / connection_established
+                    elif self.outbound:
+                        lane, lane_depth = TP_OUTBOUND_LANE_INTERACTIVE, len(self.outbound)
+                        queued_messages, self.outbound = self.outbound, []
+                        break
+                    elif self.outbound_bulk:
+                        wait_seconds = self.bulk_write_time - time.time()
+                        if wait_seconds <= 0.0:
+                            lane, lane_depth = TP_OUTBOUND_LANE_BULK, len(self.outbound_bulk)
+                            queued_messages = [self.outbound_bulk.popitem(last=False)[1]
+                                               for _ in range(min(TP_OUTBOUND_BULK_CHUNK, lane_depth))]
+                            self.bulk_write_time = time.time() + TP_OUTBOUND_BULK_PACE_SECONDS
+                            break
+                        self.outbound_condition.wait(wait_seconds)  # Woken early by an interactive message
+                    else:
+                        self.outbound_condition.wait()
+                if self.thread_stop.is_set():
+                    break  # The state updates not sent are sent on reconnection
+
+            messages_to_send = [queued[0] for queued in queued_messages]
+            written = False
+            # noinspection PyPep8,PyBroadException
+            try:
+                encoded_messages = [message.encode("utf-8") if isinstance(message, unicode) else message for message in messages_to_send]
+                self.globals[K_SOCKETS][dev_id][K_TP_SOCKET].sendall(b"".join([b"{0}\n".format(message) for message in encoded_messages]))
+                written = True
+
+                metrics = self.globals[K_TP][dev_id].get(K_METRICS)
+                if metrics is not None:
+                    metrics.increment("outbound_messages", len(encoded_messages))
+                    metrics.increment("outbound_writes")
+                    metrics.high_water(u"outbound_{0}_high_water".format(lane), lane_depth)
+                    sent_time = time.time()
+                    for queued in queued_messages:
+                        metrics.observe(u"outbound_{0}_latency".format(lane), (sent_time - queued[1]) * 1000.0)
+                capture = self.globals[K_TP][dev_id].get(K_CAPTURE)
+                if capture is not None:
+                    for message in encoded_messages:
+                        capture.record(TP_CAPTURE_OUTBOUND, message)
+                self.tpw_logger.debug(u"Sent {0} message(s) to Touch Portal Desktop: {1}".format(len(encoded_messages), messages_to_send))
+
+            except socket.error as socket_error_info:  # Includes socket.timeout - Touch Portal Desktop has stopped reading
+                self.write_failed()
+                if isinstance(socket_error_info, socket.timeout) or socket_error_info.errno in TP_WRITER_CONNECTION_LOST_ERRNOS:
+                    self.tpw_logger.debug(u"Connection to Touch Portal Desktop lost whilst sending {0} message(s): '{1}'"
+                                          .format(len(messages_to_send), socket_error_info))
+                else:
+                    self.tpw_logger.error(
+                        u"Socket Error detected in TP Writer Thread. Line '{0}' has error='{1}'.".format(
+                            sys.exc_traceback.tb_lineno, socket_error_info))
+            except StandardError as standard_error_message:
+                if not written:
+                    self.write_failed()  # e.g. the socket has gone
+                self.tpw_logger.error(u"StandardError detected in TP Writer Thread. Line '{0}' has error='{1}'".format(sys.exc_traceback.tb_lineno, standard_error_message))
+
+    # =============================================================================
+    def write_failed(self):
+        """
+        Treat a failed write as a lost connection (the state updates not sent are sent once Touch Portal Desktop has been
+        paired again) and shut the socket down so that the TP Reader / Selector thread sees the connection close and the
+        socket recovery process runs.
+
+        -----
+        :return:
+        """
+        self.connection_lost()
+        try:
+            self.globals[K_SOCKETS][self.dev_id][K_TP_SOCKET].shutdown(socket.SHUT_RDWR)
+        except (socket.error, KeyError):
+            pass  # Already closed by the TP Reader / Selector thread
+
+    # =============================================================================
+    def run(self):
+        """
+        Run thread.
+        """
+        try:
+            self.tpw_logger.debug(u"Touch Portal Writer Thread initialised")
+
+            self.handle_communication()
+
+        except StandardError as standard_error_message:
+            self.tpw_logger.error(u"StandardError detected in TP Writer Thread. Line '{0}' has error='{1}'".format(sys.exc_traceback.tb_lineno, standard_error_message))
+
+        self.tpw_logger.debug(u"Touch Portal Writer Thread Ended")